@@ -0,0 +1,152 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional, Tuple
+import os
+import threading
+import time
+
+from sqlalchemy.orm import Session
+
+from database import dialect_insert
+from models import CustomerAffinity
+
+# Khách hàng nhắn lại trong khoảng này sau lần giao gần nhất được xem là cùng
+# một cuộc hội thoại và đi thẳng tới nhân viên đang phụ trách
+AFFINITY_WINDOW_SECONDS = float(os.getenv("AFFINITY_WINDOW_SECONDS", "1800"))
+# Cache trong process; TTL giới hạn độ cũ khi process khác giao lại khách hàng
+AFFINITY_CACHE_SIZE = int(os.getenv("AFFINITY_CACHE_SIZE", "10000"))
+AFFINITY_CACHE_TTL_SECONDS = float(os.getenv("AFFINITY_CACHE_TTL_SECONDS", "60"))
+
+
+class AffinityCache:
+    """
+    Cache LRU + TTL ánh xạ customer_id -> nhân viên phụ trách hiện tại.
+
+    Chỉ chứa giá trị đã commit; mục hết hạn sớm hơn nếu cửa sổ hội thoại
+    (AFFINITY_WINDOW_SECONDS) kết thúc trước TTL.
+    """
+
+    def __init__(self, capacity: int = AFFINITY_CACHE_SIZE, ttl_seconds: float = AFFINITY_CACHE_TTL_SECONDS):
+        self.capacity = capacity
+        self.ttl_seconds = ttl_seconds
+        # customer_id -> (user_id, thời điểm hết hạn theo monotonic clock)
+        self._entries: "OrderedDict[int, Tuple[int, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Số tin nhắn đi thẳng tới nhân viên phụ trách / phải chấm điểm lại
+        self.sticky_routes = 0
+        self.scored_routes = 0
+
+    def get(self, customer_id: int) -> Optional[int]:
+        with self._lock:
+            entry = self._entries.get(customer_id)
+            if entry is None or entry[1] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[customer_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(customer_id)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, customer_id: int, user_id: int, window_left: Optional[float] = None) -> None:
+        ttl = self.ttl_seconds if window_left is None else min(self.ttl_seconds, window_left)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[customer_id] = (user_id, time.monotonic() + ttl)
+            self._entries.move_to_end(customer_id)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def record_routes(self, sticky: int, scored: int) -> None:
+        with self._lock:
+            self.sticky_routes += sticky
+            self.scored_routes += scored
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            routes = self.sticky_routes + self.scored_routes
+            return {
+                "size": len(self._entries),
+                "capacity": self.capacity,
+                "ttl_seconds": self.ttl_seconds,
+                "window_seconds": AFFINITY_WINDOW_SECONDS,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "sticky_routes": self.sticky_routes,
+                "scored_routes": self.scored_routes,
+                "sticky_rate": round(self.sticky_routes / routes, 4) if routes else None,
+            }
+
+
+# Cache dùng chung trong process
+affinity_cache = AffinityCache()
+
+
+def lookup_affinities(db: Session, customer_ids: Iterable[int]) -> Dict[int, int]:
+    """
+    Nhân viên phụ trách của các khách hàng còn trong cửa sổ hội thoại:
+    tra cache trước, phần còn thiếu đọc bằng một truy vấn theo khóa chính.
+    """
+    result: Dict[int, int] = {}
+    missing = []
+    for customer_id in dict.fromkeys(customer_ids):
+        user_id = affinity_cache.get(customer_id)
+        if user_id is None:
+            missing.append(customer_id)
+        else:
+            result[customer_id] = user_id
+    if not missing:
+        return result
+
+    now = datetime.utcnow()
+    rows = db.query(
+        CustomerAffinity.customer_id,
+        CustomerAffinity.user_id,
+        CustomerAffinity.last_assigned_at
+    ).filter(
+        CustomerAffinity.customer_id.in_(missing),
+        CustomerAffinity.last_assigned_at >= now - timedelta(seconds=AFFINITY_WINDOW_SECONDS)
+    ).all()
+    for customer_id, user_id, last_assigned_at in rows:
+        result[customer_id] = user_id
+        window_left = AFFINITY_WINDOW_SECONDS - (now - last_assigned_at).total_seconds()
+        affinity_cache.put(customer_id, user_id, window_left)
+    return result
+
+
+def record_affinities(db: Session, assignments: Dict[int, int]) -> None:
+    """
+    Ghi customer_id -> nhân viên vừa được giao (upsert) trong transaction của
+    người gọi. Cache chỉ được cập nhật sau khi commit (remember_affinities).
+    """
+    if not assignments:
+        return
+    now = datetime.utcnow()
+    stmt = dialect_insert(db, CustomerAffinity)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[CustomerAffinity.customer_id],
+        set_={"user_id": stmt.excluded.user_id, "last_assigned_at": stmt.excluded.last_assigned_at}
+    )
+    db.execute(stmt, [
+        {"customer_id": customer_id, "user_id": user_id, "last_assigned_at": now}
+        for customer_id, user_id in assignments.items()
+    ])
+
+
+def remember_affinities(assignments: Dict[int, int]) -> None:
+    """Đưa các affinity vừa commit vào cache"""
+    for customer_id, user_id in assignments.items():
+        affinity_cache.put(customer_id, user_id)
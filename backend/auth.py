@@ -4,11 +4,13 @@ from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
 import os
 from dotenv import load_dotenv
 
-from database import get_db
+from database import get_async_db
 from models import User
 from schemas import TokenData
 
@@ -86,12 +88,13 @@ def decode_access_token(token: str) -> TokenData:
             detail="Could not validate credentials"
         )
 
-def authenticate_user(db: Session, email: str, password: str) -> Optional[User]:
+async def authenticate_user(db: AsyncSession, email: str, password: str) -> Optional[User]:
     """Authenticate a user by email and password"""
-    user = db.query(User).filter(User.email == email).first()
+    user = (await db.scalars(select(User).where(User.email == email))).first()
     if not user:
         return None
-    if not verify_password(password, user.password_hash):
+    # bcrypt tốn CPU cỡ trăm ms, chạy ngoài event loop
+    if not await run_in_threadpool(verify_password, password, user.password_hash):
         return None
     if not user.is_active:
         return None
@@ -99,13 +102,13 @@ def authenticate_user(db: Session, email: str, password: str) -> Optional[User]:
 
 async def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ) -> User:
     """Get the current authenticated user"""
     token = credentials.credentials
     token_data = decode_access_token(token)
     
-    user = db.query(User).filter(User.email == token_data.email).first()
+    user = (await db.scalars(select(User).where(User.email == token_data.email))).first()
     if user is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -0,0 +1,156 @@
+"""
+Đo độ trễ webhook khi có truy vấn thống kê chậm chạy cùng lúc (mixed load).
+
+Webhook chạy theo hai cách:
+- legacy: Session đồng bộ trong async def (như trước), mỗi câu lệnh SQL
+  chặn event loop
+- async: webhook /api/webhook/zalo hiện tại (AsyncSession + run_sync)
+
+Lần chạy cuối đặt chu kỳ kiểm tra cache từ khóa / lịch trực về 0 để mọi
+webhook đều đọc version và tranh nhau làm mới cache ngay trên event loop.
+
+Truy vấn thống kê chậm cũng chạy theo hai cách: Session đồng bộ (như các
+endpoint admin / manager hiện tại) và AsyncSession (sau khi chuyển đổi).
+Mặc định chạy trên file SQLite tạm; script xóa và tạo lại
+toàn bộ bảng, chỉ trỏ BENCH_DATABASE_URL tới database dành riêng cho benchmark:
+    python bench_async.py
+    BENCH_DATABASE_URL=postgresql://.../omnichat_bench BENCH_WEBHOOKS=500 python bench_async.py
+"""
+import asyncio
+import logging
+import os
+import statistics
+import time
+
+os.environ["DATABASE_URL"] = os.getenv("BENCH_DATABASE_URL", "sqlite:////tmp/omnichat_bench.db")
+# Đo luồng xử lý trực tiếp của webhook, không qua hàng đợi ingestion
+os.environ["WEBHOOK_INGESTION_MODE"] = "sync"
+
+import httpx
+from fastapi import Depends
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+import keyword_cache
+import shift_roster
+from database import Base, SessionLocal, engine, get_async_db, get_db
+from ingestion import InboundEvent, process_inbound_event
+from main import app
+from models import CacheVersion, Department, Keyword, User
+
+BENCH_WEBHOOKS = int(os.getenv("BENCH_WEBHOOKS", "200"))
+BENCH_CONCURRENCY = int(os.getenv("BENCH_CONCURRENCY", "20"))
+BENCH_SLOW_REQUESTS = int(os.getenv("BENCH_SLOW_REQUESTS", "10"))
+
+logging.getLogger("ingestion").setLevel(logging.ERROR)
+logging.getLogger("routers.webhook").setLevel(logging.ERROR)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+@app.post("/bench/legacy-webhook")
+async def legacy_webhook(payload: dict, db: Session = Depends(get_db)):
+    process_inbound_event(db, InboundEvent(
+        platform="zalo",
+        sender_id=payload["sender"]["id"],
+        text=payload["message"]["text"],
+        external_id=payload["message_id"]
+    ))
+    return {"status": "success"}
+
+
+def _slow_statement(dialect_name: str):
+    if dialect_name == "postgresql":
+        return text("SELECT pg_sleep(0.2)")
+    return text(
+        "WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n WHERE x < 1000000) "
+        "SELECT count(*) FROM n"
+    )
+
+
+@app.get("/bench/slow-report")
+async def slow_report(db: Session = Depends(get_db)):
+    db.execute(_slow_statement(db.get_bind().dialect.name))
+    return {"status": "ok"}
+
+
+@app.get("/bench/slow-report-async")
+async def slow_report_async(db: AsyncSession = Depends(get_async_db)):
+    await db.execute(_slow_statement(db.bind.dialect.name))
+    return {"status": "ok"}
+
+
+def seed() -> None:
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    db = SessionLocal()
+    db.add_all([CacheVersion(name="keywords", version=0), CacheVersion(name="roster", version=0)])
+    department = Department(name="Kinh doanh")
+    db.add(department)
+    db.flush()
+    for index in range(20):
+        db.add(User(
+            email=f"bench.staff{index}@omnichat.com",
+            password_hash="bench",
+            full_name=f"Bench Staff {index}",
+            role="staff",
+            department_id=department.id
+        ))
+    db.add(Keyword(keyword="mua hàng", department_id=department.id, priority=3))
+    db.commit()
+    db.close()
+
+
+async def run(label: str, webhook_path: str, report_path: str) -> None:
+    seed()
+    latencies = []
+    semaphore = asyncio.Semaphore(BENCH_CONCURRENCY)
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        async def send_webhook(index: int) -> None:
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.post(webhook_path, json={
+                    "event_name": "user_send_text",
+                    "sender": {"id": f"bench-{index % 50}"},
+                    "message": {"text": "Tôi muốn mua hàng, giá bao nhiêu?"},
+                    "message_id": f"{webhook_path}-{index}"
+                })
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - started)
+
+        async def send_slow_report() -> None:
+            (await client.get(report_path)).raise_for_status()
+
+        started = time.perf_counter()
+        await asyncio.gather(
+            *(send_webhook(index) for index in range(BENCH_WEBHOOKS)),
+            *(send_slow_report() for _ in range(BENCH_SLOW_REQUESTS))
+        )
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(
+        f"{label:<28} webhooks/s={BENCH_WEBHOOKS / elapsed:.1f} "
+        f"p50_ms={statistics.median(latencies) * 1000:.1f} "
+        f"p95_ms={p95 * 1000:.1f} "
+        f"max_ms={latencies[-1] * 1000:.1f}"
+    )
+
+
+async def main() -> None:
+    print(
+        f"{BENCH_WEBHOOKS} webhook (đồng thời {BENCH_CONCURRENCY}) "
+        f"+ {BENCH_SLOW_REQUESTS} truy vấn thống kê chậm"
+    )
+    await run("legacy webhook + sync report", "/bench/legacy-webhook", "/bench/slow-report")
+    await run("async webhook + sync report", "/api/webhook/zalo", "/bench/slow-report")
+    await run("async webhook + async report", "/api/webhook/zalo", "/bench/slow-report-async")
+    keyword_cache.KEYWORD_CACHE_CHECK_SECONDS = 0
+    shift_roster.ROSTER_CACHE_CHECK_SECONDS = 0
+    await run("async webhook, cache refresh", "/api/webhook/zalo", "/bench/slow-report-async")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,133 @@
+"""
+Đo số transaction và số round trip SQL cho mỗi tin nhắn đến.
+
+So sánh luồng cũ (commit sau từng bước: customer, message, assignment + KPI,
+notification) với luồng hiện tại (một transaction cho mỗi sự kiện).
+
+Mặc định chạy trên SQLite in-memory. Script xóa và tạo lại toàn bộ bảng,
+chỉ trỏ BENCH_DATABASE_URL tới một database dành riêng cho benchmark:
+    python bench_ingestion.py
+    BENCH_DATABASE_URL=postgresql://.../omnichat_bench BENCH_MESSAGES=500 python bench_ingestion.py
+"""
+import logging
+import os
+import time
+
+os.environ["DATABASE_URL"] = os.getenv("BENCH_DATABASE_URL", "sqlite://")
+
+from sqlalchemy import event
+
+from database import Base, SessionLocal, engine
+from ingestion import InboundEvent, PLATFORM_LABELS, process_inbound_event
+from keyword_analyzer import KeywordAnalyzer
+from models import CacheVersion, Customer, Department, Keyword, Message, Notification, User
+
+BENCH_MESSAGES = int(os.getenv("BENCH_MESSAGES", "200"))
+
+logging.getLogger("ingestion").setLevel(logging.ERROR)
+
+counters = {"round_trips": 0, "transactions": 0}
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    counters["round_trips"] += 1
+
+
+@event.listens_for(engine, "commit")
+def _count_commit(conn):
+    counters["transactions"] += 1
+
+
+def seed() -> None:
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    db = SessionLocal()
+    db.add_all([CacheVersion(name="keywords", version=0), CacheVersion(name="roster", version=0)])
+    department = Department(name="Kinh doanh")
+    db.add(department)
+    db.flush()
+    for index in range(20):
+        db.add(User(
+            email=f"bench.staff{index}@omnichat.com",
+            password_hash="bench",
+            full_name=f"Bench Staff {index}",
+            role="staff",
+            department_id=department.id
+        ))
+    db.add(Keyword(keyword="mua hàng", department_id=department.id, priority=3))
+    db.commit()
+    db.close()
+
+
+def legacy_process(db, event: InboundEvent) -> None:
+    """Luồng cũ: mỗi bước một commit + refresh"""
+    customer = db.query(Customer).filter(Customer.zalo_id == event.sender_id).first()
+    if not customer:
+        customer = Customer(
+            zalo_id=event.sender_id,
+            platform=event.platform,
+            name=f"Khách hàng {PLATFORM_LABELS[event.platform]} {event.sender_id}"
+        )
+        db.add(customer)
+        db.commit()
+        db.refresh(customer)
+
+    new_message = Message(
+        customer_id=customer.id,
+        content=event.text,
+        platform=event.platform,
+        external_id=event.external_id,
+        direction="incoming",
+        status="pending"
+    )
+    db.add(new_message)
+    db.commit()
+    db.refresh(new_message)
+
+    assignment = KeywordAnalyzer(db).auto_assign_message(new_message)
+    db.commit()
+    if assignment:
+        db.refresh(assignment)
+        db.add(Notification(
+            user_id=assignment.assigned_to,
+            title="Tin nhắn mới được giao",
+            message=f"Bạn có tin nhắn mới từ {customer.name}: {event.text[:50]}...",
+            type="message",
+            link=f"/staff/messages/{new_message.id}"
+        ))
+        db.commit()
+
+
+def run(label: str, process) -> None:
+    seed()
+    db = SessionLocal()
+    # Làm nóng cache từ khóa / lịch trực để chỉ đo chi phí của từng tin nhắn
+    KeywordAnalyzer(db).find_best_staff("mua hàng")
+    db.close()
+
+    counters["round_trips"] = 0
+    counters["transactions"] = 0
+    started = time.perf_counter()
+    for index in range(BENCH_MESSAGES):
+        db = SessionLocal()
+        process(db, InboundEvent(
+            platform="zalo",
+            sender_id=f"bench-{index}",
+            text="Tôi muốn mua hàng, giá bao nhiêu?",
+            external_id=f"bench-msg-{index}"
+        ))
+        db.close()
+    elapsed = time.perf_counter() - started
+
+    print(
+        f"{label:<8} transactions/msg={counters['transactions'] / BENCH_MESSAGES:.2f} "
+        f"round_trips/msg={counters['round_trips'] / BENCH_MESSAGES:.2f} "
+        f"ms/msg={elapsed / BENCH_MESSAGES * 1000:.2f}"
+    )
+
+
+if __name__ == "__main__":
+    print(f"{BENCH_MESSAGES} tin nhắn mới, mỗi tin từ một khách hàng mới")
+    run("before", legacy_process)
+    run("after", process_inbound_event)
@@ -0,0 +1,70 @@
+from typing import Dict
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import func
+
+from database import dialect_insert
+from models import CacheVersion
+
+# Tên các cache dùng chung trong process
+KEYWORD_CACHE = "keywords"
+ROSTER_CACHE = "roster"
+
+# Số lần bump đã commit trong chính process này, giúp cache tự làm mới ngay
+# mà không phải chờ tới lần kiểm tra version kế tiếp
+_local_bumps: Dict[str, int] = {}
+_local_lock = threading.Lock()
+
+# Khóa trong Session.info chứa các cache đã bump nhưng transaction chưa kết thúc
+_PENDING_BUMPS = "pending_cache_bumps"
+
+
+def get_cache_version(db: Session, name: str) -> int:
+    """Đọc version hiện tại của một cache (0 nếu chưa có dòng version)"""
+    version = db.query(CacheVersion.version).filter(CacheVersion.name == name).scalar()
+    return int(version or 0)
+
+
+def get_local_bump_count(name: str) -> int:
+    """Số lần cache bị bump bởi các transaction đã commit trong process này"""
+    return _local_bumps.get(name, 0)
+
+
+def _record_local_bump(name: str) -> None:
+    with _local_lock:
+        _local_bumps[name] = _local_bumps.get(name, 0) + 1
+
+
+def _record_pending_bumps(session: Session) -> None:
+    for name in session.info.pop(_PENDING_BUMPS, ()):
+        _record_local_bump(name)
+
+
+def _discard_pending_bumps(session: Session, previous_transaction) -> None:
+    # Rollback savepoint không hủy thay đổi của transaction ngoài
+    if not previous_transaction.nested:
+        session.info.pop(_PENDING_BUMPS, None)
+
+
+def bump_cache_version(db: Session, name: str) -> None:
+    """
+    Tăng version của cache trong cùng transaction với thay đổi dữ liệu.
+
+    Các worker khác nhận ra version mới ở lần kiểm tra định kỳ; process hiện tại
+    được báo ngay sau khi transaction commit, và không được báo nếu transaction
+    bị rollback.
+    """
+    stmt = dialect_insert(db, CacheVersion)
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=[CacheVersion.name],
+        set_={"version": CacheVersion.version + 1, "updated_at": func.now()}
+    ), {"name": name, "version": 1})
+
+    # Mỗi session chỉ gắn một cặp listener; không gỡ listener bên trong chính
+    # sự kiện vì SQLAlchemy đang duyệt danh sách listener đó
+    if not event.contains(db, "after_commit", _record_pending_bumps):
+        event.listen(db, "after_commit", _record_pending_bumps)
+        event.listen(db, "after_soft_rollback", _discard_pending_bumps)
+    db.info.setdefault(_PENDING_BUMPS, []).append(name)
@@ -0,0 +1,108 @@
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import bindparam, case, func, select, update
+from sqlalchemy.orm import Session
+
+from database import dialect_insert
+from models import Conversation, Message
+
+# Độ dài đoạn trích tin nhắn cuối lưu trong bảng conversations
+PREVIEW_LENGTH = 255
+
+
+def _open_conversations(db: Session, pairs: List[Tuple[int, int]], reopen: bool) -> None:
+    """Tạo dòng (khách hàng, nhân viên) nếu chưa có; reopen=True mở lại dòng đã đóng"""
+    if not pairs:
+        return
+    stmt = dialect_insert(db, Conversation)
+    if reopen:
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Conversation.customer_id, Conversation.user_id],
+            set_={"status": "open"}
+        )
+    else:
+        stmt = stmt.on_conflict_do_nothing(index_elements=[Conversation.customer_id, Conversation.user_id])
+    db.execute(stmt, [
+        {"customer_id": customer_id, "user_id": user_id, "status": "open", "unread_count": 0}
+        for customer_id, user_id in pairs
+    ])
+
+
+def _apply_last_messages(db: Session, messages: List[Message], reader_id: Optional[int] = None) -> None:
+    """
+    Cập nhật tin nhắn cuối cho mọi dòng hội thoại của khách hàng (một lệnh
+    executemany, một tham số cho mỗi khách hàng) và cộng số tin đến chưa đọc;
+    dòng của reader_id (nhân viên vừa trả lời) được đặt về 0.
+    """
+    latest: Dict[int, List] = {}
+    for message in messages:
+        if message.customer_id is None:
+            continue
+        entry = latest.setdefault(message.customer_id, [message, 0])
+        entry[0] = message
+        if message.direction == "incoming":
+            entry[1] += 1
+    if not latest:
+        return
+
+    table = Conversation.__table__
+    db.connection().execute(
+        update(table)
+        .where(table.c.customer_id == bindparam("b_customer_id"))
+        .values(
+            last_message_id=bindparam("b_message_id"),
+            last_message_preview=bindparam("b_preview"),
+            # created_at do DB sinh: đọc theo khóa chính ngay trong lệnh UPDATE
+            last_message_at=select(Message.created_at).where(
+                Message.id == bindparam("b_message_id")
+            ).scalar_subquery(),
+            last_direction=bindparam("b_direction"),
+            unread_count=case(
+                (table.c.user_id == bindparam("b_reader_id"), 0),
+                else_=table.c.unread_count + bindparam("b_incoming")
+            ),
+            updated_at=func.now()
+        ),
+        [
+            {
+                "b_customer_id": customer_id,
+                "b_message_id": message.id,
+                "b_preview": message.content[:PREVIEW_LENGTH],
+                "b_direction": message.direction,
+                "b_reader_id": reader_id,
+                "b_incoming": incoming,
+            }
+            for customer_id, (message, incoming) in sorted(latest.items())
+        ]
+    )
+
+
+def record_incoming(db: Session, entries: List[Tuple[Message, Optional[int]]]) -> None:
+    """
+    Ghi tin nhắn đến (đã flush) vào bảng conversations trong transaction của
+    người gọi. entries: (tin nhắn, nhân viên được giao hoặc None) theo thứ tự
+    nhận; hội thoại của nhân viên được giao được mở (lại).
+    """
+    pairs = list(dict.fromkeys(
+        (message.customer_id, assigned_to)
+        for message, assigned_to in entries
+        if message.customer_id and assigned_to
+    ))
+    _open_conversations(db, pairs, reopen=True)
+    _apply_last_messages(db, [message for message, _ in entries])
+
+
+def record_outgoing(db: Session, message: Message, user_id: int) -> None:
+    """Ghi tin nhắn nhân viên gửi (đã flush); hội thoại của nhân viên đó coi như đã đọc"""
+    _open_conversations(db, [(message.customer_id, user_id)], reopen=False)
+    _apply_last_messages(db, [message], reader_id=user_id)
+
+
+def set_conversation_status(db: Session, customer_id: int, user_id: int, status: str) -> None:
+    """Đổi trạng thái open / closed khi nhân viên xử lý; tin đến được coi như đã đọc"""
+    db.execute(
+        update(Conversation)
+        .where(Conversation.customer_id == customer_id, Conversation.user_id == user_id)
+        .values(status=status, unread_count=0)
+        .execution_options(synchronize_session=False)
+    )
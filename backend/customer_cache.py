@@ -0,0 +1,138 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Iterable, Optional, Set, Tuple
+import os
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+from models import Customer
+
+# Số (platform, sender) tối đa giữ trong cache và thời gian sống của một mục.
+# TTL giới hạn độ cũ khi khách hàng bị sửa / xóa ở process khác.
+CUSTOMER_CACHE_SIZE = int(os.getenv("CUSTOMER_CACHE_SIZE", "10000"))
+CUSTOMER_CACHE_TTL_SECONDS = float(os.getenv("CUSTOMER_CACHE_TTL_SECONDS", "300"))
+
+
+@dataclass(frozen=True)
+class CachedCustomer:
+    """Phần thông tin khách hàng mà luồng webhook cần: ID và tên hiển thị"""
+    id: int
+    name: Optional[str]
+
+
+CacheKey = Tuple[str, str]
+
+
+class CustomerCache:
+    """
+    Cache LRU + TTL ánh xạ (platform, sender_id) -> khách hàng, dùng chung cho
+    webhook Zalo, Meta và Telegram.
+
+    Chỉ chứa khách hàng đã commit (đọc từ DB), không chứa khách hàng vừa tạo
+    trong transaction chưa commit. Mục bị xóa khi khách hàng được sửa hoặc xóa
+    qua ORM (xem các listener bên dưới) nhờ chỉ mục ngược customer_id -> keys.
+    """
+
+    def __init__(self, capacity: int = CUSTOMER_CACHE_SIZE, ttl_seconds: float = CUSTOMER_CACHE_TTL_SECONDS):
+        self.capacity = capacity
+        self.ttl_seconds = ttl_seconds
+        # key -> (khách hàng, thời điểm hết hạn theo monotonic clock)
+        self._entries: "OrderedDict[CacheKey, Tuple[CachedCustomer, float]]" = OrderedDict()
+        self._keys_by_customer: Dict[int, Set[CacheKey]] = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, platform: str, sender_id: str) -> Optional[CachedCustomer]:
+        key = (platform, sender_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            customer, expires_at = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return customer
+
+    def put(self, platform: str, sender_id: str, customer: CachedCustomer) -> None:
+        key = (platform, sender_id)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (customer, time.monotonic() + self.ttl_seconds)
+            self._keys_by_customer.setdefault(customer.id, set()).add(key)
+            while len(self._entries) > self.capacity:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate_customers(self, customer_ids: Iterable[int]) -> None:
+        """Xóa mọi mục trỏ tới các khách hàng đã bị sửa / xóa"""
+        with self._lock:
+            for customer_id in customer_ids:
+                for key in self._keys_by_customer.pop(customer_id, ()):
+                    self._entries.pop(key, None)
+                    self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_customer.clear()
+
+    def _remove(self, key: CacheKey) -> None:
+        customer, _ = self._entries.pop(key)
+        keys = self._keys_by_customer.get(customer.id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_customer[customer.id]
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "capacity": self.capacity,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+
+# Cache dùng chung trong process
+customer_cache = CustomerCache()
+
+
+def _invalidate_on_change(mapper, connection, target: Customer) -> None:
+    # Xóa ngay khi flush, và xóa lại sau commit để loại giá trị cũ mà request
+    # khác có thể đã nạp vào giữa lúc flush và commit
+    customer_id = target.id
+    customer_cache.invalidate_customers([customer_id])
+    session = object_session(target)
+    if session is not None:
+        event.listen(
+            session, "after_commit",
+            lambda session: customer_cache.invalidate_customers([customer_id]),
+            once=True
+        )
+
+
+event.listen(Customer, "after_update", _invalidate_on_change)
+event.listen(Customer, "after_delete", _invalidate_on_change)
@@ -0,0 +1,150 @@
+from dataclasses import asdict
+from datetime import datetime, timedelta
+from typing import Any, List, Optional
+import asyncio
+import json
+import logging
+import os
+
+from starlette.concurrency import run_in_threadpool
+
+from database import SessionLocal
+from ingestion import InboundEvent, process_inbound_batch
+from models import WebhookDeadLetter
+
+logger = logging.getLogger(__name__)
+
+# Chu kỳ quét dead letter đến hạn và số dòng xử lý mỗi lần quét
+DEAD_LETTER_POLL_SECONDS = float(os.getenv("DEAD_LETTER_POLL_SECONDS", "10"))
+DEAD_LETTER_BATCH_SIZE = int(os.getenv("DEAD_LETTER_BATCH_SIZE", "50"))
+# Backoff lũy thừa: base * 2^(lần thử - 1), tối đa max; hết số lần thử thì "dead"
+DEAD_LETTER_MAX_ATTEMPTS = int(os.getenv("DEAD_LETTER_MAX_ATTEMPTS", "8"))
+DEAD_LETTER_RETRY_BASE_SECONDS = float(os.getenv("DEAD_LETTER_RETRY_BASE_SECONDS", "30"))
+DEAD_LETTER_RETRY_MAX_SECONDS = float(os.getenv("DEAD_LETTER_RETRY_MAX_SECONDS", "3600"))
+
+
+def _retry_delay(attempts: int) -> timedelta:
+    seconds = DEAD_LETTER_RETRY_BASE_SECONDS * 2 ** max(attempts - 1, 0)
+    return timedelta(seconds=min(seconds, DEAD_LETTER_RETRY_MAX_SECONDS))
+
+
+def serialize_events(events: List[InboundEvent]) -> str:
+    return json.dumps([asdict(event) for event in events], ensure_ascii=False)
+
+
+def deserialize_events(payload: str) -> List[InboundEvent]:
+    return [InboundEvent(**event) for event in json.loads(payload)]
+
+
+def record_dead_letter(
+    platform: str,
+    raw_payload: Any,
+    events: Optional[List[InboundEvent]],
+    error: str
+) -> None:
+    """
+    Lưu sự kiện webhook không xử lý được bằng session riêng (session của
+    request có thể đang lỗi). Không có sự kiện đã parse thì không thể thử lại,
+    dòng được đánh dấu "dead" ngay để admin xem payload gốc.
+    """
+    db = SessionLocal()
+    try:
+        db.add(WebhookDeadLetter(
+            platform=platform,
+            raw_payload=json.dumps(raw_payload, ensure_ascii=False) if raw_payload is not None else None,
+            events=serialize_events(events) if events else None,
+            error=error,
+            attempts=0,
+            status="pending" if events else "dead",
+            next_attempt_at=datetime.utcnow() + _retry_delay(1)
+        ))
+        db.commit()
+    finally:
+        db.close()
+    logger.warning(f"Stored {platform} webhook in dead-letter queue: {error}")
+
+
+def retry_due_dead_letters(limit: int = DEAD_LETTER_BATCH_SIZE) -> int:
+    """
+    Thử lại các dead letter đến hạn. Dòng được khóa (SKIP LOCKED) để nhiều
+    worker không xử lý trùng; tin nhắn đã lưu ở lần thử trước bị ràng buộc
+    unique (platform, external_id) bỏ qua nên thử lại là idempotent.
+
+    Returns:
+        Số dead letter đã xử lý thành công
+    """
+    db = SessionLocal()
+    resolved = 0
+    try:
+        now = datetime.utcnow()
+        due = db.query(WebhookDeadLetter).filter(
+            WebhookDeadLetter.status == "pending",
+            WebhookDeadLetter.next_attempt_at <= now
+        ).order_by(WebhookDeadLetter.next_attempt_at).limit(limit).with_for_update(skip_locked=True).all()
+
+        for dead_letter in due:
+            dead_letter.attempts += 1
+            work = SessionLocal()
+            try:
+                process_inbound_batch(work, deserialize_events(dead_letter.events))
+            except Exception as e:
+                dead_letter.error = f"{type(e).__name__}: {e}"
+                if dead_letter.attempts >= DEAD_LETTER_MAX_ATTEMPTS:
+                    dead_letter.status = "dead"
+                    logger.error(f"Dead letter {dead_letter.id} gave up after {dead_letter.attempts} attempts")
+                else:
+                    dead_letter.next_attempt_at = datetime.utcnow() + _retry_delay(dead_letter.attempts)
+            else:
+                dead_letter.status = "resolved"
+                dead_letter.resolved_at = datetime.utcnow()
+                resolved += 1
+            finally:
+                work.close()
+
+        db.commit()
+    finally:
+        db.close()
+    return resolved
+
+
+class DeadLetterScheduler:
+    """Task nền định kỳ thử lại dead letter đến hạn"""
+
+    def __init__(self, poll_seconds: float = DEAD_LETTER_POLL_SECONDS):
+        self.poll_seconds = poll_seconds
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+
+    async def start(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run(), name="dead-letter-scheduler")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    def wake(self) -> None:
+        """Quét ngay (sau khi admin replay), không chờ hết chu kỳ"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                resolved = await run_in_threadpool(retry_due_dead_letters)
+                if resolved:
+                    logger.info(f"Replayed {resolved} dead-lettered webhook events")
+            except Exception:
+                logger.exception("Dead-letter retry pass failed")
+
+
+# Scheduler dùng chung trong process
+dead_letter_scheduler = DeadLetterScheduler()
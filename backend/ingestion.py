@@ -0,0 +1,413 @@
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple, Union
+import logging
+
+from sqlalchemy import insert, select, update
+from sqlalchemy.orm import Session
+
+from affinity import remember_affinities
+from conversations import PREVIEW_LENGTH, record_incoming
+from customer_cache import CachedCustomer, customer_cache
+from database import dialect_insert
+from models import Conversation, Customer, CustomerIdentity, Message, MessageAssignment, Notification
+from keyword_analyzer import KeywordAnalyzer
+from realtime import realtime_hub
+from workload_tracker import workload_tracker
+
+logger = logging.getLogger(__name__)
+
+# Cột định danh cũ trên bảng customers, vẫn được ghi song song với
+# customer_identities cho các chỗ đang đọc trực tiếp (gửi tin Telegram, ...)
+CUSTOMER_ID_COLUMNS = {
+    "zalo": Customer.zalo_id,
+    "facebook": Customer.meta_id,
+    "telegram": Customer.telegram_id,
+}
+
+PLATFORM_LABELS = {
+    "zalo": "Zalo",
+    "facebook": "Facebook",
+    "telegram": "Telegram",
+}
+
+NOTIFICATION_TITLES = {
+    "telegram": "Tin nhắn mới từ Telegram",
+}
+
+
+@dataclass(frozen=True)
+class InboundEvent:
+    """Một tin nhắn đến đã được tách ra từ payload webhook của nền tảng"""
+    platform: str
+    sender_id: str
+    text: str
+    external_id: Optional[str] = None
+
+    @property
+    def dedup_key(self) -> Optional[Tuple[str, str]]:
+        """Khóa chống trùng (platform, external_id); None nếu nền tảng không gửi ID"""
+        if self.external_id is None:
+            return None
+        return self.platform, self.external_id
+
+
+def _insert_messages(db: Session, rows: List[dict]) -> List[Message]:
+    """
+    INSERT ... ON CONFLICT (platform, external_id) DO NOTHING RETURNING.
+
+    Trả về các tin nhắn thực sự được tạo; bản trùng (webhook gửi lại) bị bỏ qua
+    ngay trong DB mà không cần SELECT kiểm tra trước.
+    """
+    stmt = dialect_insert(db, Message).on_conflict_do_nothing(
+        index_elements=[Message.platform, Message.external_id]
+    ).returning(Message)
+    if not rows:
+        return []
+    return list(db.scalars(stmt, rows))
+
+
+def _message_row(customer: Union[Customer, CachedCustomer], text: str, platform: str, external_id: Optional[str]) -> dict:
+    return {
+        "customer_id": customer.id,
+        "content": text,
+        "platform": platform,
+        "external_id": external_id,
+        "direction": "incoming",
+        "status": "pending",
+    }
+
+
+def find_or_create_customer(db: Session, platform: str, sender_id: str) -> CachedCustomer:
+    """Tìm khách hàng theo ID trên nền tảng, tạo mới (flush, chưa commit) nếu chưa có"""
+    return resolve_customers(db, platform, [sender_id])[sender_id]
+
+
+def ingest_message(
+    db: Session,
+    customer: Union[Customer, CachedCustomer],
+    text: str,
+    platform: str,
+    external_id: Optional[str] = None
+) -> Tuple[Optional[Message], Optional[MessageAssignment]]:
+    """
+    Lưu tin nhắn đến, tự động giao việc, tạo thông báo cho nhân viên được giao
+    và cập nhật bảng tóm tắt hội thoại.
+
+    Chỉ flush để lấy ID; toàn bộ thay đổi nằm trong transaction của người gọi.
+    Trả về (None, None) nếu (platform, external_id) đã được lưu trước đó.
+    """
+    inserted = _insert_messages(db, [_message_row(customer, text, platform, external_id)])
+    if not inserted:
+        return None, None
+    new_message = inserted[0]
+
+    # Tự động giao việc
+    analyzer = KeywordAnalyzer(db)
+    assignment = analyzer.auto_assign_message(new_message)
+
+    if assignment:
+        # Tạo thông báo cho staff được giao
+        notification = Notification(
+            user_id=assignment.assigned_to,
+            title=NOTIFICATION_TITLES.get(platform, "Tin nhắn mới được giao"),
+            message=f"Bạn có tin nhắn mới từ {customer.name}: {text[:50]}...",
+            type="message",
+            link=f"/staff/messages/{new_message.id}"
+        )
+        db.add(notification)
+
+    record_incoming(db, [(new_message, assignment.assigned_to if assignment else None)])
+    return new_message, assignment
+
+
+def commit_ingestion(
+    db: Session,
+    message: Message,
+    assignment: Optional[MessageAssignment]
+) -> None:
+    """Commit một sự kiện đã lưu; rollback toàn bộ nếu commit lỗi"""
+    _commit_and_report(db, [(message, assignment)])
+
+
+def _commit_and_report(
+    db: Session,
+    results: List[Tuple[Message, Optional[MessageAssignment]]]
+) -> None:
+    # Đọc ID trước khi commit để không phải nạp lại object bị expire
+    assigned = [
+        (message.id, message.customer_id, assignment.assigned_to if assignment else None)
+        for message, assignment in results
+    ]
+    try:
+        events = _realtime_events(db, results)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    # Chỉ đẩy sự kiện khi dữ liệu đã commit
+    realtime_hub.publish(events)
+
+    remember_affinities({
+        customer_id: assigned_to
+        for _, customer_id, assigned_to in assigned
+        if customer_id and assigned_to
+    })
+    for message_id, _, assigned_to in assigned:
+        if assigned_to:
+            workload_tracker.assignment_opened(assigned_to, message_id)
+            logger.info(f"Message {message_id} auto-assigned to user {assigned_to}")
+        else:
+            logger.warning(f"Could not auto-assign message {message_id}")
+
+
+def _realtime_events(
+    db: Session,
+    results: List[Tuple[Message, Optional[MessageAssignment]]]
+) -> List[Tuple[int, dict]]:
+    """
+    Sự kiện WebSocket cho các tin nhắn vừa lưu, dựng trước khi commit:
+    nhân viên được giao nhận "assignment" + "notification", nhân viên khác có
+    hội thoại với khách hàng nhận "message". Không có ai kết nối thì không
+    chạm DB.
+    """
+    watchers = realtime_hub.subscribed_users()
+    if not watchers:
+        return []
+
+    customer_ids = {message.customer_id for message, _ in results if message.customer_id}
+    followers: Dict[int, List[int]] = {}
+    if customer_ids:
+        rows = db.execute(select(Conversation.customer_id, Conversation.user_id).where(
+            Conversation.customer_id.in_(customer_ids)
+        ))
+        for customer_id, user_id in rows:
+            if user_id in watchers:
+                followers.setdefault(customer_id, []).append(user_id)
+
+    events = []
+    for message, assignment in results:
+        payload = {
+            "message_id": message.id,
+            "customer_id": message.customer_id,
+            "platform": message.platform,
+            "preview": message.content[:PREVIEW_LENGTH],
+        }
+        assigned_to = assignment.assigned_to if assignment else None
+        if assigned_to in watchers:
+            events.append((assigned_to, {"type": "assignment", **payload}))
+            events.append((assigned_to, {
+                "type": "notification",
+                "title": NOTIFICATION_TITLES.get(message.platform, "Tin nhắn mới được giao"),
+                "link": f"/staff/messages/{message.id}",
+            }))
+        for user_id in followers.get(message.customer_id, ()):
+            if user_id != assigned_to:
+                events.append((user_id, {"type": "message", **payload}))
+    return events
+
+
+def process_inbound_event(db: Session, event: InboundEvent) -> Optional[MessageAssignment]:
+    """
+    Lưu một sự kiện webhook trong đúng một transaction:
+    khách hàng, tin nhắn, giao việc + KPI và thông báo
+
+    Returns:
+        MessageAssignment nếu giao được, None nếu không tìm được nhân viên
+        hoặc sự kiện là bản gửi lại của tin nhắn đã lưu
+    """
+    try:
+        customer = find_or_create_customer(db, event.platform, event.sender_id)
+        new_message, assignment = ingest_message(
+            db, customer, event.text, event.platform, event.external_id
+        )
+    except Exception:
+        db.rollback()
+        raise
+
+    if new_message is None:
+        db.rollback()
+        logger.info(f"Duplicate {event.platform} message {event.external_id} ignored")
+        return None
+
+    commit_ingestion(db, new_message, assignment)
+    return assignment
+
+
+def _claim_identities(db: Session, platform: str, sender_ids: List[str]) -> List[Tuple[int, str, Optional[int]]]:
+    """
+    INSERT ... ON CONFLICT DO UPDATE ... RETURNING trên customer_identities.
+
+    Một lệnh duy nhất trả về (id, external_user_id, customer_id) cho mọi sender,
+    kể cả định danh đã có. customer_id NULL nghĩa là transaction này vừa tạo
+    định danh và phải gắn khách hàng; dòng đã bị khóa nên webhook đồng thời
+    của cùng sender sẽ chờ và nhận đúng khách hàng đó thay vì tạo trùng.
+    """
+    stmt = dialect_insert(db, CustomerIdentity).values([
+        {"platform": platform, "external_user_id": sender_id}
+        for sender_id in sender_ids
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[CustomerIdentity.platform, CustomerIdentity.external_user_id],
+        set_={"platform": stmt.excluded.platform}
+    ).returning(CustomerIdentity.id, CustomerIdentity.external_user_id, CustomerIdentity.customer_id)
+    return db.execute(stmt).all()
+
+
+def resolve_customers(db: Session, platform: str, sender_ids: List[str]) -> Dict[str, CachedCustomer]:
+    """
+    Tìm khách hàng của nhiều sender: trước hết trong customer_cache, phần còn
+    lại qua customer_identities; tạo hàng loạt khách hàng còn thiếu (flush,
+    chưa commit)
+    """
+    id_column = CUSTOMER_ID_COLUMNS[platform]
+
+    customers: Dict[str, CachedCustomer] = {}
+    # Thứ tự cố định để các lô đồng thời khóa định danh theo cùng thứ tự
+    missing = []
+    for sender_id in sorted(set(sender_ids)):
+        cached = customer_cache.get(platform, sender_id)
+        if cached is not None:
+            customers[sender_id] = cached
+        else:
+            missing.append(sender_id)
+    if not missing:
+        return customers
+
+    identities = _claim_identities(db, platform, missing)
+    customer_ids = {
+        sender_id: customer_id
+        for _, sender_id, customer_id in identities
+        if customer_id is not None
+    }
+
+    if customer_ids:
+        by_id = {
+            customer_id: CachedCustomer(id=customer_id, name=name)
+            for customer_id, name in db.query(Customer.id, Customer.name).filter(
+                Customer.id.in_(set(customer_ids.values()))
+            )
+        }
+        for sender_id, customer_id in customer_ids.items():
+            customers[sender_id] = by_id[customer_id]
+            # Định danh đã có customer_id là dữ liệu đã commit, an toàn để cache
+            customer_cache.put(platform, sender_id, by_id[customer_id])
+
+    unclaimed = [
+        (identity_id, sender_id)
+        for identity_id, sender_id, customer_id in identities
+        if customer_id is None
+    ]
+    if unclaimed:
+        new_customers = []
+        for _, sender_id in unclaimed:
+            customer = Customer(
+                platform=platform,
+                name=f"Khách hàng {PLATFORM_LABELS[platform]} {sender_id}"
+            )
+            setattr(customer, id_column.key, sender_id)
+            new_customers.append(customer)
+        db.add_all(new_customers)
+        db.flush()
+
+        # Khách hàng mới chưa commit nên không đưa vào cache; lần sau sẽ được cache
+        for (_, sender_id), customer in zip(unclaimed, new_customers):
+            customers[sender_id] = CachedCustomer(id=customer.id, name=customer.name)
+        db.execute(update(CustomerIdentity), [
+            {"id": identity_id, "customer_id": customers[sender_id].id}
+            for identity_id, sender_id in unclaimed
+        ])
+    return customers
+
+
+def process_inbound_batch(db: Session, events: List[InboundEvent]) -> List[Optional[MessageAssignment]]:
+    """
+    Lưu cả lô sự kiện trong một transaction: một truy vấn khách hàng cho mỗi
+    nền tảng, insert hàng loạt tin nhắn, giao việc theo lô với cùng một
+    snapshot từ khóa / lịch trực rồi insert hàng loạt assignment và thông báo
+
+    Sự kiện trùng (trong lô hoặc đã lưu từ trước) bị bỏ qua; kết quả chỉ gồm
+    các sự kiện thực sự được lưu.
+    """
+    # Bỏ trùng trong cùng payload trước khi chạm DB
+    unique_keys = set()
+    deduped = []
+    for event in events:
+        key = event.dedup_key
+        if key is not None:
+            if key in unique_keys:
+                continue
+            unique_keys.add(key)
+        deduped.append(event)
+    events = deduped
+    if not events:
+        return []
+
+    try:
+        customers_by_platform: Dict[str, Dict[str, CachedCustomer]] = {}
+        for platform in dict.fromkeys(event.platform for event in events):
+            sender_ids = [event.sender_id for event in events if event.platform == platform]
+            customers_by_platform[platform] = resolve_customers(db, platform, sender_ids)
+
+        rows = [
+            _message_row(
+                customers_by_platform[event.platform][event.sender_id],
+                event.text, event.platform, event.external_id
+            )
+            for event in events
+        ]
+        inserted = {
+            (message.platform, message.external_id): message
+            for message in _insert_messages(db, [row for row in rows if row["external_id"] is not None])
+        }
+        # Tin nhắn không có external_id không thể trùng, insert thường
+        anonymous = [Message(**row) for row in rows if row["external_id"] is None]
+        if anonymous:
+            db.add_all(anonymous)
+            db.flush()
+        anonymous_messages = iter(anonymous)
+
+        kept = []
+        for event in events:
+            if event.dedup_key is None:
+                kept.append((event, next(anonymous_messages)))
+            elif event.dedup_key in inserted:
+                kept.append((event, inserted[event.dedup_key]))
+        duplicates = len(events) - len(kept)
+        if duplicates:
+            logger.info(f"{duplicates} duplicate messages ignored in batch")
+        if not kept:
+            db.rollback()
+            return []
+
+        events = [event for event, _ in kept]
+        new_messages = [message for _, message in kept]
+        customers = [customers_by_platform[event.platform][event.sender_id] for event in events]
+
+        assignments = KeywordAnalyzer(db).auto_assign_messages(new_messages)
+
+        # Không cần đọc lại ID thông báo nên insert một lệnh executemany
+        notifications = [
+            {
+                "user_id": assignment.assigned_to,
+                "title": NOTIFICATION_TITLES.get(event.platform, "Tin nhắn mới được giao"),
+                "message": f"Bạn có tin nhắn mới từ {customer.name}: {event.text[:50]}...",
+                "type": "message",
+                "link": f"/staff/messages/{message.id}",
+            }
+            for event, customer, message, assignment in zip(events, customers, new_messages, assignments)
+            if assignment
+        ]
+        if notifications:
+            db.execute(insert(Notification), notifications)
+
+        record_incoming(db, [
+            (message, assignment.assigned_to if assignment else None)
+            for message, assignment in zip(new_messages, assignments)
+        ])
+    except Exception:
+        db.rollback()
+        raise
+
+    _commit_and_report(db, list(zip(new_messages, assignments)))
+    return assignments
@@ -0,0 +1,217 @@
+from typing import List, Optional
+import asyncio
+import logging
+import os
+import time
+import zlib
+
+from starlette.concurrency import run_in_threadpool
+
+from database import SessionLocal
+from dead_letters import record_dead_letter
+from ingestion import InboundEvent, process_inbound_event
+from recent_ids import recent_ids
+
+logger = logging.getLogger(__name__)
+
+# "sync" (mặc định): xử lý ngay trong request webhook
+# "queue": webhook chỉ kiểm tra và đưa vào hàng đợi, worker nền xử lý
+WEBHOOK_INGESTION_MODE = os.getenv("WEBHOOK_INGESTION_MODE", "sync")
+# Tổng sức chứa, chia đều cho các lane
+INGESTION_QUEUE_SIZE = int(os.getenv("INGESTION_QUEUE_SIZE", "10000"))
+# Số lane (mỗi lane một worker); mặc định theo số CPU
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", str(os.cpu_count() or 4)))
+INGESTION_DRAIN_TIMEOUT_SECONDS = float(os.getenv("INGESTION_DRAIN_TIMEOUT_SECONDS", "30"))
+
+
+class IngestionLane:
+    """Một lane: hàng đợi FIFO riêng và đúng một worker xử lý tuần tự"""
+
+    def __init__(self, index: int, maxsize: int):
+        self.index = index
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.started_at = time.monotonic()
+        self.busy = False
+        self.processed = 0
+        self.failed = 0
+        self.high_watermark = 0
+        self.busy_seconds = 0.0
+
+    def metrics(self) -> dict:
+        uptime = time.monotonic() - self.started_at
+        return {
+            "lane": self.index,
+            "depth": self.queue.qsize(),
+            "high_watermark": self.high_watermark,
+            "busy": self.busy,
+            "processed": self.processed,
+            "failed": self.failed,
+            # Tỉ lệ thời gian worker của lane đang xử lý sự kiện
+            "occupancy": round(self.busy_seconds / uptime, 4) if uptime > 0 else 0.0,
+        }
+
+
+class IngestionQueue:
+    """
+    Hàng đợi có giới hạn cho sự kiện webhook, chia thành các lane cố định.
+
+    Sự kiện được băm theo (nền tảng, người gửi) vào một lane; mỗi lane có một
+    worker duy nhất nên tin nhắn của cùng một khách hàng được lưu và giao việc
+    đúng thứ tự nhận, trong khi các lane chạy song song với nhau. Worker chạy
+    luồng lưu tin nhắn + giao việc (code đồng bộ) trong threadpool với session
+    DB riêng.
+    """
+
+    def __init__(self, maxsize: int = INGESTION_QUEUE_SIZE, workers: int = INGESTION_WORKERS):
+        self.maxsize = maxsize
+        self.worker_count = max(1, workers)
+        self._lanes: List[IngestionLane] = []
+        self._workers: List[asyncio.Task] = []
+        self._accepting = False
+
+        self.enqueued = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.high_watermark = 0
+        self._processing_seconds = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._accepting
+
+    async def start(self) -> None:
+        """Khởi động các lane, gọi trong lifespan của ứng dụng"""
+        lane_size = max(1, self.maxsize // self.worker_count)
+        self._lanes = [IngestionLane(index, lane_size) for index in range(self.worker_count)]
+        self._workers = [
+            asyncio.create_task(self._worker(lane), name=f"ingestion-lane-{lane.index}")
+            for lane in self._lanes
+        ]
+        self._accepting = True
+        logger.info(f"Ingestion queue started with {self.worker_count} lanes")
+
+    def lane_for(self, event: InboundEvent) -> int:
+        """Lane cố định của một người gửi (crc32 ổn định giữa các lần chạy, khác hash())"""
+        key = f"{event.platform}:{event.sender_id}".encode()
+        return zlib.crc32(key) % self.worker_count
+
+    def submit(self, event: InboundEvent) -> bool:
+        """Đưa sự kiện vào lane của người gửi; trả về False nếu lane đầy hoặc đang dừng"""
+        if not self._accepting:
+            self.rejected += 1
+            return False
+        lane = self._lanes[self.lane_for(event)]
+        try:
+            lane.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        self.enqueued += 1
+        depth = lane.queue.qsize()
+        lane.high_watermark = max(lane.high_watermark, depth)
+        self.high_watermark = max(self.high_watermark, self._depth())
+        return True
+
+    def _depth(self) -> int:
+        return sum(lane.queue.qsize() for lane in self._lanes)
+
+    async def drain(self, timeout: float = INGESTION_DRAIN_TIMEOUT_SECONDS) -> None:
+        """Ngừng nhận sự kiện mới, chờ xử lý hết các lane rồi dừng worker"""
+        if not self._lanes:
+            return
+        self._accepting = False
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(lane.queue.join() for lane in self._lanes)),
+                timeout=timeout
+            )
+        except asyncio.TimeoutError:
+            logger.error(f"Ingestion queue drain timed out, moving {self._depth()} events to dead-letter queue")
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        await self._dead_letter_remaining()
+        self._workers = []
+        logger.info("Ingestion queue stopped")
+
+    async def _dead_letter_remaining(self) -> None:
+        """Chuyển các sự kiện chưa kịp xử lý khi tắt vào dead-letter"""
+        remaining = []
+        for lane in self._lanes:
+            while not lane.queue.empty():
+                remaining.append(lane.queue.get_nowait())
+                lane.queue.task_done()
+        for platform in dict.fromkeys(event.platform for event in remaining):
+            events = [event for event in remaining if event.platform == platform]
+            try:
+                await run_in_threadpool(
+                    record_dead_letter, platform, None, events, "Ingestion queue stopped before processing"
+                )
+            except Exception:
+                logger.exception(f"Could not store {len(events)} {platform} events in dead-letter queue")
+
+    async def _worker(self, lane: IngestionLane) -> None:
+        while True:
+            event = await lane.queue.get()
+            self.in_flight += 1
+            lane.busy = True
+            started = time.perf_counter()
+            try:
+                await run_in_threadpool(self._process, event)
+                self.processed += 1
+                lane.processed += 1
+                recent_ids.confirm(event.dedup_key)
+            except Exception as e:
+                self.failed += 1
+                lane.failed += 1
+                recent_ids.release(event.dedup_key)
+                logger.exception(f"Ingestion lane {lane.index} failed to process {event.platform} event")
+                try:
+                    await run_in_threadpool(
+                        record_dead_letter, event.platform, None, [event], f"{type(e).__name__}: {e}"
+                    )
+                except Exception:
+                    logger.exception(f"Could not store {event.platform} event in dead-letter queue")
+            finally:
+                elapsed = time.perf_counter() - started
+                self._processing_seconds += elapsed
+                lane.busy_seconds += elapsed
+                lane.busy = False
+                self.in_flight -= 1
+                lane.queue.task_done()
+
+    @staticmethod
+    def _process(event: InboundEvent) -> None:
+        db = SessionLocal()
+        try:
+            process_inbound_event(db, event)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def metrics(self) -> dict:
+        """Số liệu hàng đợi phục vụ giám sát"""
+        finished = self.processed + self.failed
+        return {
+            "mode": WEBHOOK_INGESTION_MODE,
+            "running": self._accepting,
+            "depth": self._depth(),
+            "capacity": self.maxsize,
+            "high_watermark": self.high_watermark,
+            "workers": len(self._workers),
+            "in_flight": self.in_flight,
+            "enqueued": self.enqueued,
+            "rejected": self.rejected,
+            "processed": self.processed,
+            "failed": self.failed,
+            "avg_processing_ms": round(self._processing_seconds / finished * 1000, 2) if finished else None,
+            "lanes": [lane.metrics() for lane in self._lanes],
+        }
+
+
+# Hàng đợi dùng chung trong process
+ingestion_queue = IngestionQueue()
@@ -3,6 +3,12 @@
 -- PostgreSQL Database Initialization Script
 
 -- Drop existing tables if they exist
+DROP TABLE IF EXISTS cache_versions CASCADE;
+
+DROP TABLE IF EXISTS job_checkpoints CASCADE;
+
+DROP TABLE IF EXISTS conversations CASCADE;
+
 DROP TABLE IF EXISTS notifications CASCADE;
 
 DROP TABLE IF EXISTS message_assignments CASCADE;
@@ -19,6 +25,12 @@ DROP TABLE IF EXISTS kpis CASCADE;
 
 DROP TABLE IF EXISTS keywords CASCADE;
 
+DROP TABLE IF EXISTS webhook_dead_letters CASCADE;
+
+DROP TABLE IF EXISTS customer_affinities CASCADE;
+
+DROP TABLE IF EXISTS customer_identities CASCADE;
+
 DROP TABLE IF EXISTS customers CASCADE;
 
 DROP TABLE IF EXISTS users CASCADE;
@@ -644,4 +656,192 @@ JOIN customers c ON m.customer_id = c.id
 WHERE c.phone = '0938765432'
 AND m.content LIKE '%laptop%';
 
-ALTER TABLE customers ADD COLUMN telegram_id VARCHAR(255);
\ No newline at end of file
+ALTER TABLE customers ADD COLUMN telegram_id VARCHAR(255);
+
+-- Version counters for in-process caches (keywords, ...)
+-- Bumped in the same transaction as the data change, polled cheaply by workers
+CREATE TABLE IF NOT EXISTS cache_versions (
+    name VARCHAR(50) PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO cache_versions (name, version) VALUES ('keywords', 0), ('roster', 0)
+ON CONFLICT (name) DO NOTHING;
+
+-- Idempotent webhook ingestion: one row per (platform, external_id)
+-- Legacy Telegram rows stored the bare per-chat message_id; rewrite them to
+-- the chat_id:message_id format first so messages from different chats
+-- do not collide
+UPDATE messages m SET external_id = c.telegram_id || ':' || m.external_id
+FROM customers c
+WHERE m.customer_id = c.id
+  AND m.platform = 'telegram'
+  AND m.external_id IS NOT NULL
+  AND POSITION(':' IN m.external_id) = 0
+  AND c.telegram_id IS NOT NULL;
+
+-- Remaining duplicates keep their oldest row as the dedup target
+UPDATE messages m SET external_id = NULL
+WHERE external_id IS NOT NULL
+  AND EXISTS (
+      SELECT 1 FROM messages d
+      WHERE d.platform = m.platform
+        AND d.external_id = m.external_id
+        AND d.id < m.id
+  );
+
+CREATE UNIQUE INDEX IF NOT EXISTS uq_messages_platform_external_id ON messages (platform, external_id);
+
+-- Channel identities: (platform, external user id) -> customer, resolved by one upsert
+CREATE TABLE IF NOT EXISTS customer_identities (
+    id SERIAL PRIMARY KEY,
+    platform VARCHAR(50) NOT NULL,
+    external_user_id VARCHAR(255) NOT NULL,
+    customer_id INTEGER REFERENCES customers(id) ON DELETE CASCADE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT uq_customer_identities_platform_user UNIQUE (platform, external_user_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_customer_identities_customer_id ON customer_identities (customer_id);
+
+-- Backfill from the legacy per-platform columns (oldest customer wins on duplicates)
+INSERT INTO customer_identities (platform, external_user_id, customer_id)
+SELECT 'zalo', zalo_id, MIN(id) FROM customers WHERE zalo_id IS NOT NULL GROUP BY zalo_id
+ON CONFLICT (platform, external_user_id) DO NOTHING;
+
+INSERT INTO customer_identities (platform, external_user_id, customer_id)
+SELECT 'facebook', meta_id, MIN(id) FROM customers WHERE meta_id IS NOT NULL GROUP BY meta_id
+ON CONFLICT (platform, external_user_id) DO NOTHING;
+
+INSERT INTO customer_identities (platform, external_user_id, customer_id)
+SELECT 'telegram', telegram_id, MIN(id) FROM customers WHERE telegram_id IS NOT NULL GROUP BY telegram_id
+ON CONFLICT (platform, external_user_id) DO NOTHING;
+
+-- Outbound delivery tracking for staff replies sent through the Telegram outbox
+ALTER TABLE messages
+    ADD COLUMN IF NOT EXISTS delivery_status VARCHAR(20) CONSTRAINT check_message_delivery_status CHECK (
+        delivery_status IN ('queued', 'sent', 'failed')
+    ),
+    ADD COLUMN IF NOT EXISTS delivery_attempts INTEGER DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS delivery_error TEXT,
+    ADD COLUMN IF NOT EXISTS delivered_at TIMESTAMP;
+
+-- Dead letters: webhook events that failed to persist, retried with backoff by the app
+CREATE TABLE IF NOT EXISTS webhook_dead_letters (
+    id SERIAL PRIMARY KEY,
+    platform VARCHAR(50) NOT NULL,
+    raw_payload TEXT,
+    events TEXT,
+    error TEXT,
+    attempts INTEGER DEFAULT 0,
+    status VARCHAR(20) DEFAULT 'pending' CHECK (
+        status IN ('pending', 'resolved', 'dead')
+    ),
+    next_attempt_at TIMESTAMP,
+    resolved_at TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_dead_letters_due ON webhook_dead_letters (status, next_attempt_at);
+
+-- Sticky routing: staff member who last handled each customer
+CREATE TABLE IF NOT EXISTS customer_affinities (
+    customer_id INTEGER PRIMARY KEY REFERENCES customers(id) ON DELETE CASCADE,
+    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    last_assigned_at TIMESTAMP NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_customer_affinities_user_id ON customer_affinities (user_id);
+
+-- Backfill from the latest assignment of each customer
+INSERT INTO customer_affinities (customer_id, user_id, last_assigned_at)
+SELECT DISTINCT ON (m.customer_id) m.customer_id, ma.assigned_to, ma.assigned_at
+FROM message_assignments ma
+JOIN messages m ON m.id = ma.message_id
+WHERE ma.assigned_to IS NOT NULL AND m.customer_id IS NOT NULL AND ma.assigned_at IS NOT NULL
+ORDER BY m.customer_id, ma.assigned_at DESC, ma.id DESC
+ON CONFLICT (customer_id) DO NOTHING;
+
+-- Checkpoints of background jobs (incremental KPI recomputation)
+CREATE TABLE IF NOT EXISTS job_checkpoints (
+    name VARCHAR(100) PRIMARY KEY,
+    checkpoint_at TIMESTAMP NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Set-based KPI recomputation: assignments per staff and time range, change scans
+CREATE INDEX IF NOT EXISTS idx_message_assignments_assigned_to_at ON message_assignments (assigned_to, assigned_at);
+
+CREATE INDEX IF NOT EXISTS idx_message_assignments_updated_at ON message_assignments (updated_at);
+
+-- Staff inbox keyset pagination: copy of messages.created_at on each assignment
+ALTER TABLE message_assignments ADD COLUMN IF NOT EXISTS message_created_at TIMESTAMP;
+
+UPDATE message_assignments ma
+SET message_created_at = m.created_at
+FROM messages m
+WHERE m.id = ma.message_id AND ma.message_created_at IS NULL;
+
+CREATE INDEX IF NOT EXISTS idx_message_assignments_inbox ON message_assignments (assigned_to, message_created_at DESC, message_id DESC);
+
+-- Latest message per customer for the staff conversation list
+CREATE INDEX IF NOT EXISTS idx_messages_customer_created ON messages (customer_id, created_at DESC, id DESC);
+
+-- Conversation summary per (customer, assignee), maintained with every message
+CREATE TABLE IF NOT EXISTS conversations (
+    id SERIAL PRIMARY KEY,
+    customer_id INTEGER NOT NULL REFERENCES customers(id) ON DELETE CASCADE,
+    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    last_message_id INTEGER REFERENCES messages(id) ON DELETE SET NULL,
+    last_message_preview VARCHAR(255),
+    last_message_at TIMESTAMP,
+    last_direction VARCHAR(20),
+    unread_count INTEGER NOT NULL DEFAULT 0,
+    status VARCHAR(20) NOT NULL DEFAULT 'open' CHECK (
+        status IN ('open', 'closed')
+    ),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT uq_conversations_customer_user UNIQUE (customer_id, user_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_conversations_user_activity ON conversations (user_id, last_message_at DESC, customer_id DESC);
+
+-- Backfill: one row per (customer, assignee) with the customer's latest message
+INSERT INTO conversations (
+    customer_id, user_id, last_message_id, last_message_preview,
+    last_message_at, last_direction, unread_count, status
+)
+SELECT
+    pairs.customer_id, pairs.user_id, lm.id, LEFT(lm.content, 255),
+    lm.created_at, lm.direction, 0,
+    CASE WHEN pairs.completed_at IS NOT NULL THEN 'closed' ELSE 'open' END
+FROM (
+    SELECT DISTINCT ON (m.customer_id, ma.assigned_to)
+        m.customer_id, ma.assigned_to AS user_id, ma.completed_at
+    FROM message_assignments ma
+    JOIN messages m ON m.id = ma.message_id
+    WHERE ma.assigned_to IS NOT NULL AND m.customer_id IS NOT NULL
+    ORDER BY m.customer_id, ma.assigned_to, ma.assigned_at DESC, ma.id DESC
+) pairs
+JOIN LATERAL (
+    SELECT id, content, created_at, direction
+    FROM messages
+    WHERE customer_id = pairs.customer_id
+    ORDER BY created_at DESC, id DESC
+    LIMIT 1
+) lm ON TRUE
+ON CONFLICT (customer_id, user_id) DO NOTHING;
+
+-- Outbox claims: a process marks the rows it is delivering as 'sending' so that
+-- other processes do not send the same message again
+ALTER TABLE messages DROP CONSTRAINT IF EXISTS check_message_delivery_status;
+ALTER TABLE messages
+    ADD CONSTRAINT check_message_delivery_status CHECK (
+        delivery_status IN ('queued', 'sending', 'sent', 'failed')
+    ),
+    ADD COLUMN IF NOT EXISTS delivery_claimed_by VARCHAR(100),
+    ADD COLUMN IF NOT EXISTS delivery_claimed_at TIMESTAMP;
@@ -1,52 +1,213 @@
-from typing import List, Tuple, Optional
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
 from sqlalchemy.orm import Session
-from sqlalchemy import func
-from datetime import datetime, date as dt_date
-from models import Keyword, User, KPI, UserShift, Message, MessageAssignment, Department
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy import func, inspect, select
+from datetime import datetime, date as dt_date, time as dt_time
+from models import User, KPI, Message, MessageAssignment, Department
+from affinity import affinity_cache, lookup_affinities, record_affinities
+from keyword_cache import KeywordEntry, get_keyword_snapshot
+from kpi_counters import WORKLOAD_METRIC, add_to_kpis, increment_workload_kpi
+from shift_roster import ON_SHIFT, SCHEDULED, RosterIndex, get_roster
+from workload_tracker import workload_tracker
 from decimal import Decimal
+import logging
+import os
+
+try:
+    import numpy as np
+except ImportError:  # numpy là phụ thuộc tùy chọn, chỉ cần cho chế độ vector hóa
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# "scalar" (mặc định) hoặc "numpy" để chấm điểm vector hóa cho phòng ban đông nhân viên
+SCORING_ENGINE = os.getenv("SCORING_ENGINE", "scalar")
+
+# Nguồn đo khối lượng công việc khi chấm điểm:
+# "kpi" (mặc định) dùng % hoàn thành KPI, "realtime" dùng số việc đang mở từ WorkloadTracker
+LOAD_SCORING_MODE = os.getenv("LOAD_SCORING_MODE", "kpi")
+# Số tin nhắn đang mở mà tại đó nhân viên được xem là đầy tải (điểm tải = 0)
+WORKLOAD_CAPACITY = float(os.getenv("WORKLOAD_CAPACITY", "10"))
+
+STICKY_NOTE = "Tự động giao cho nhân viên đang phụ trách khách hàng"
+
+# Sai số float tối đa khi so điểm NumPy; ứng viên trong khoảng này so với điểm
+# cao nhất được tính lại bằng Decimal trước khi chọn
+_FLOAT_TIE_TOLERANCE = 1e-6
+
+
+@dataclass
+class StaffColumns:
+    """
+    Dữ liệu chấm điểm của ứng viên dạng cột NumPy, sắp theo id nhân viên.
+
+    Dựng một lần cho mỗi lần tìm nhân viên (hoặc mỗi lô tin nhắn) thay vì điền
+    từng phần tử trong vòng lặp Python ở mỗi lần chấm điểm.
+    """
+    staff_ids: "np.ndarray"
+    # -1 nếu nhân viên không thuộc phòng ban nào
+    department_ids: "np.ndarray"
+    # Vị trí KPI (đầu tiên theo id) của nhân viên trong danh sách nguồn, -1 nếu không có
+    kpi_rows: "np.ndarray"
+    kpi_current: "np.ndarray"
+    kpi_target: "np.ndarray"
+    has_shift: "np.ndarray"
+    on_shift: "np.ndarray"
+
+    def position(self, user_id: int) -> Optional[int]:
+        index = int(np.searchsorted(self.staff_ids, user_id))
+        if index < len(self.staff_ids) and self.staff_ids[index] == user_id:
+            return index
+        return None
+
+    def shift_status(self, position: int) -> Optional[str]:
+        if self.on_shift[position]:
+            return ON_SHIFT
+        if self.has_shift[position]:
+            return SCHEDULED
+        return None
+
+    def add_to_kpi(self, user_id: int, delta: int) -> None:
+        """Cộng dồn KPI trong bộ nhớ sau mỗi lần giao trong lô"""
+        position = self.position(user_id)
+        if position is not None and self.kpi_rows[position] >= 0:
+            self.kpi_current[position] += delta
+
+
+def _column(values, dtype, missing) -> "np.ndarray":
+    """Cột NumPy từ một cột kết quả truy vấn; NULL thay bằng `missing`"""
+    column = np.array(values, dtype=np.float64)
+    return np.nan_to_num(column, nan=missing).astype(dtype, copy=False)
+
+
+def build_staff_columns(
+    staff_rows: Sequence[Tuple[int, Optional[int]]],
+    kpi_rows: Sequence[Tuple[int, Optional[Decimal], Optional[Decimal]]],
+    roster: RosterIndex,
+    current_time: dt_time
+) -> StaffColumns:
+    """
+    staff_rows: (id, department_id) sắp theo id nhân viên.
+    kpi_rows: (user_id, current_value, target_value) sắp theo id KPI; mỗi nhân
+    viên dùng KPI đầu tiên của mình, giống .first().
+    """
+    staff_ids, department_ids = (
+        (_column(column, np.int64, -1) for column in zip(*staff_rows)) if staff_rows
+        else (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+    )
+    count = len(staff_ids)
+    
+    kpi_row_positions = np.full(count, -1, dtype=np.int64)
+    kpi_current = np.zeros(count, dtype=np.float64)
+    kpi_target = np.zeros(count, dtype=np.float64)
+    if kpi_rows and count:
+        user_ids, current_values, target_values = zip(*kpi_rows)
+        kpi_users, first_rows = np.unique(np.array(user_ids, dtype=np.int64), return_index=True)
+        positions = np.minimum(np.searchsorted(staff_ids, kpi_users), count - 1)
+        found = staff_ids[positions] == kpi_users
+        positions, first_rows = positions[found], first_rows[found]
+        kpi_row_positions[positions] = first_rows
+        kpi_current[positions] = _column(current_values, np.float64, 0.0)[first_rows]
+        kpi_target[positions] = _column(target_values, np.float64, 0.0)[first_rows]
+    
+    scheduled = np.fromiter(roster.scheduled_today, dtype=np.int64, count=len(roster.scheduled_today))
+    on_shift = np.zeros(count, dtype=bool)
+    for department_id in np.unique(department_ids).tolist():
+        members = roster.on_shift(department_id if department_id >= 0 else None, current_time)
+        if members:
+            in_department = department_ids == department_id
+            on_shift[in_department] = np.isin(
+                staff_ids[in_department], np.fromiter(members, dtype=np.int64, count=len(members))
+            )
+    
+    return StaffColumns(
+        staff_ids=staff_ids,
+        department_ids=department_ids,
+        kpi_rows=kpi_row_positions,
+        kpi_current=kpi_current,
+        kpi_target=kpi_target,
+        has_shift=on_shift | np.isin(staff_ids, scheduled),
+        on_shift=on_shift
+    )
+
 
 class KeywordAnalyzer:
     """Phân tích từ khóa và tự động giao việc cho nhân viên phù hợp"""
     
-    def __init__(self, db: Session):
+    def __init__(
+        self,
+        db: Session,
+        scoring_engine: Optional[str] = None,
+        load_mode: Optional[str] = None
+    ):
         self.db = db
+        self.scoring_engine = scoring_engine or SCORING_ENGINE
+        self.load_mode = load_mode or LOAD_SCORING_MODE
+        # Việc đã giao trong lô hiện tại nhưng chưa commit vào WorkloadTracker
+        self._batch_open: Dict[int, int] = {}
+        if self.scoring_engine == "numpy" and np is None:
+            logger.warning("SCORING_ENGINE=numpy nhưng chưa cài numpy, dùng chế độ scalar")
+            self.scoring_engine = "scalar"
     
-    def extract_keywords(self, message_content: str) -> List[str]:
+    def extract_keywords(self, message_content: str) -> List[KeywordEntry]:
         """Trích xuất từ khóa từ nội dung tin nhắn"""
-        # Chuyển về chữ thường để so sánh
-        content_lower = message_content.lower()
-        
-        # Lấy tất cả keywords đang active từ database
-        active_keywords = self.db.query(Keyword).filter(Keyword.is_active == True).all()
-        
-        matched_keywords = []
-        for kw in active_keywords:
-            if kw.keyword.lower() in content_lower:
-                matched_keywords.append(kw)
-        
-        return matched_keywords
+        # Dùng snapshot từ khóa của process, chỉ đọc lại DB khi version thay đổi
+        snapshot = get_keyword_snapshot(self.db)
+        return snapshot.match(message_content)
     
     def calculate_staff_score(
         self, 
         user: User, 
-        matched_keywords: List[Keyword],
+        matched_keywords: List[KeywordEntry],
         current_date: dt_date = None
     ) -> Decimal:
         """
         Tính điểm ưu tiên cho nhân viên dựa trên:
         - Số lượng từ khóa khớp với phòng ban
-        - KPI hiện tại (workload thấp hơn = điểm cao hơn)
+        - KPI hiện tại hoặc số việc đang mở (workload thấp hơn = điểm cao hơn)
         - Trạng thái làm việc (đang trong ca = điểm cao hơn)
         """
         if current_date is None:
             current_date = dt_date.today()
         
+        kpi = self.db.query(KPI).filter(
+            KPI.user_id == user.id,
+            KPI.metric_name == WORKLOAD_METRIC,
+            KPI.period_start <= current_date,
+            KPI.period_end >= current_date
+        ).order_by(KPI.id).first()
+        
+        roster = get_roster(self.db, current_date)
+        shift_status = roster.shift_status(user, datetime.now().time())
+        
+        return self._score_staff(user, matched_keywords, kpi, shift_status)
+    
+    def _score_staff(
+        self,
+        user: User,
+        matched_keywords: List[KeywordEntry],
+        kpi: Optional[KPI],
+        shift_status: Optional[str]
+    ) -> Decimal:
+        """Tính điểm từ dữ liệu đã nạp sẵn, không truy vấn DB"""
+        return self._score_values(user.id, user.department_id, matched_keywords, kpi, shift_status)
+    
+    def _score_values(
+        self,
+        user_id: int,
+        department_id: Optional[int],
+        matched_keywords: List[KeywordEntry],
+        kpi: Optional[KPI],
+        shift_status: Optional[str]
+    ) -> Decimal:
+        """_score_staff theo id và phòng ban, không cần object User"""
         score = Decimal(0)
         
         # 1. Điểm từ khóa khớp (0-50 điểm)
         keyword_score = Decimal(0)
         for kw in matched_keywords:
-            if kw.department_id == user.department_id:
+            if kw.department_id == department_id:
                 keyword_score += Decimal(kw.priority * 10)
         
         # Giới hạn điểm từ khóa tối đa 50
@@ -54,14 +215,9 @@ class KeywordAnalyzer:
         score += keyword_score
         
         # 2. Điểm KPI (0-30 điểm) - workload thấp hơn = điểm cao hơn
-        kpi = self.db.query(KPI).filter(
-            KPI.user_id == user.id,
-            KPI.metric_name == "Số tin nhắn xử lý",
-            KPI.period_start <= current_date,
-            KPI.period_end >= current_date
-        ).first()
-        
-        if kpi:
+        if self.load_mode == "realtime":
+            score += self._realtime_load_score(user_id)
+        elif kpi:
             # Tính % hoàn thành KPI
             if kpi.target_value and kpi.target_value > 0:
                 completion_rate = (kpi.current_value / kpi.target_value) * 100
@@ -74,37 +230,235 @@ class KeywordAnalyzer:
             score += Decimal(20)  # Điểm cao nếu chưa có KPI (nhân viên mới)
         
         # 3. Điểm trạng thái làm việc (0-20 điểm)
-        current_time = datetime.now().time()
-        user_shift = self.db.query(UserShift).join(
-            UserShift.shift
-        ).filter(
-            UserShift.user_id == user.id,
-            UserShift.date == current_date,
-            UserShift.status == "scheduled"
-        ).first()
-        
-        if user_shift and user_shift.shift:
-            # Kiểm tra xem có đang trong ca làm việc không
-            if user_shift.shift.start_time <= current_time <= user_shift.shift.end_time:
-                score += Decimal(20)  # Đang trong ca
-            else:
-                score += Decimal(5)   # Có ca nhưng chưa đến hoặc đã qua
+        if shift_status == ON_SHIFT:
+            score += Decimal(20)  # Đang trong ca (kể cả ca qua đêm)
+        elif shift_status == SCHEDULED:
+            score += Decimal(5)   # Có ca nhưng chưa đến hoặc đã qua
         else:
             score += Decimal(0)  # Không có ca làm việc
         
         return score
     
+    def _realtime_load_score(self, user_id: int) -> Decimal:
+        """Điểm tải (0-30) theo số việc đang mở, đầy tải ở WORKLOAD_CAPACITY"""
+        load = min(workload_tracker.load(user_id, self._batch_open.get(user_id, 0)), WORKLOAD_CAPACITY)
+        return Decimal(30) * (Decimal(1) - Decimal(load) / Decimal(WORKLOAD_CAPACITY))
+    
+    def _load_scoring_context(
+        self,
+        staff_ids: List[int],
+        current_date: dt_date,
+        load_kpis: Optional[bool] = None
+    ) -> Dict[int, KPI]:
+        """
+        Nạp KPI của toàn bộ ứng viên bằng 1 truy vấn thay vì 1 truy vấn
+        cho mỗi nhân viên (ca làm việc lấy từ chỉ mục lịch trực)
+        """
+        if load_kpis is None:
+            load_kpis = self.load_mode != "realtime"
+        kpis_by_user: Dict[int, KPI] = {}
+        if load_kpis:
+            kpis = self.db.query(KPI).filter(
+                KPI.user_id.in_(staff_ids),
+                KPI.metric_name == WORKLOAD_METRIC,
+                KPI.period_start <= current_date,
+                KPI.period_end >= current_date
+            ).order_by(KPI.id).all()
+            for kpi in kpis:
+                # Giữ KPI đầu tiên của mỗi nhân viên, giống .first()
+                kpis_by_user.setdefault(kpi.user_id, kpi)
+        
+        return kpis_by_user
+    
+    def _pick_best_scalar(
+        self,
+        staff_users: List[User],
+        matched_keywords: List[KeywordEntry],
+        kpis_by_user: Dict[int, KPI],
+        shift_statuses: Dict[int, Optional[str]]
+    ) -> Tuple[Optional[User], Decimal]:
+        """Chấm điểm tuần tự bằng Decimal, chọn người đầu tiên có điểm cao nhất"""
+        best_staff = None
+        best_score = Decimal(0)
+        
+        for staff in staff_users:
+            score = self._score_staff(
+                staff,
+                matched_keywords,
+                kpis_by_user.get(staff.id),
+                shift_statuses[staff.id]
+            )
+            if score > best_score:
+                best_score = score
+                best_staff = staff
+        
+        return best_staff, best_score
+    
+    def _pick_best_vectorized(
+        self,
+        columns: "StaffColumns",
+        matched_keywords: List[KeywordEntry],
+        score_at: Callable[[int], Decimal],
+        candidates: Optional["np.ndarray"] = None
+    ) -> Tuple[Optional[int], Decimal]:
+        """
+        Chấm điểm ứng viên bằng NumPy trên các cột đã dựng sẵn, trả về vị trí
+        người được chọn trong `columns` và điểm Decimal của người đó (None nếu
+        không ai có điểm dương).
+        
+        Cùng công thức với _score_staff nhưng tính bằng float, nên chỉ dùng để
+        lọc: những người có điểm float sát điểm cao nhất được `score_at(vị trí)`
+        tính lại bằng Decimal, rồi chọn điểm cao nhất, bằng điểm thì id nhỏ nhất
+        (cột sắp theo id) - giống hệt _pick_best_scalar.
+        """
+        positions = np.flatnonzero(candidates) if candidates is not None else np.arange(len(columns.staff_ids))
+        if not len(positions):
+            return None, Decimal(0)
+        department_ids = columns.department_ids[positions]
+        
+        # Điểm từ khóa theo phòng ban (0-50)
+        keyword_weight = np.zeros(len(positions), dtype=np.float64)
+        department_weights: Dict[Optional[int], int] = {}
+        for kw in matched_keywords:
+            department_weights[kw.department_id] = department_weights.get(kw.department_id, 0) + kw.priority * 10
+        for department_id, weight in department_weights.items():
+            if department_id is not None:
+                keyword_weight[department_ids == department_id] += weight
+        keyword_scores = np.minimum(keyword_weight, 50.0)
+        
+        if self.load_mode == "realtime":
+            loads = np.fromiter(
+                (
+                    workload_tracker.load(user_id, self._batch_open.get(user_id, 0))
+                    for user_id in columns.staff_ids[positions].tolist()
+                ),
+                dtype=np.float64,
+                count=len(positions)
+            )
+            kpi_scores = 30.0 * (1.0 - np.minimum(loads, WORKLOAD_CAPACITY) / WORKLOAD_CAPACITY)
+        else:
+            has_kpi = columns.kpi_rows[positions] >= 0
+            kpi_current = columns.kpi_current[positions]
+            kpi_target = columns.kpi_target[positions]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                completion_rate = np.minimum(kpi_current / kpi_target * 100.0, 100.0)
+            kpi_scores = np.where(
+                has_kpi,
+                np.where(kpi_target > 0, 30.0 * (100.0 - completion_rate) / 100.0, 15.0),
+                20.0
+            )
+        
+        shift_scores = np.where(
+            columns.on_shift[positions], 20.0, np.where(columns.has_shift[positions], 5.0, 0.0)
+        )
+        
+        scores = keyword_scores + kpi_scores + shift_scores
+        best_position = None
+        best_score = Decimal(0)
+        for position in positions[scores >= scores.max() - _FLOAT_TIE_TOLERANCE].tolist():
+            score = score_at(position)
+            if score > best_score:
+                best_score = score
+                best_position = position
+        return best_position, best_score
+    
+    def _find_best_staff_vectorized(
+        self,
+        matched_keywords: List[KeywordEntry],
+        department_ids: List[Optional[int]],
+        current_date: dt_date
+    ) -> Tuple[Optional[User], Decimal]:
+        """
+        find_best_staff cho SCORING_ENGINE=numpy: đọc ứng viên và KPI dạng cột
+        (không dựng object ORM cho từng nhân viên), chỉ nạp User của người được chọn
+        """
+        candidates = select(User.id).where(
+            User.role == "staff",
+            User.is_active == True,
+            User.department_id.in_(department_ids)
+        )
+        staff_rows = self.db.execute(
+            candidates.add_columns(User.department_id).order_by(User.id)
+        ).all()
+        if not staff_rows:
+            return None, Decimal(0)
+        
+        kpi_rows = []
+        if self.load_mode != "realtime":
+            kpi_rows = self.db.execute(select(
+                KPI.user_id, KPI.current_value, KPI.target_value
+            ).where(
+                KPI.user_id.in_(candidates),
+                KPI.metric_name == WORKLOAD_METRIC,
+                KPI.period_start <= current_date,
+                KPI.period_end >= current_date
+            ).order_by(KPI.id)).all()
+        
+        columns = build_staff_columns(
+            staff_rows, kpi_rows, get_roster(self.db, current_date), datetime.now().time()
+        )
+        
+        def score_at(position: int) -> Decimal:
+            kpi_row = int(columns.kpi_rows[position])
+            department_id = int(columns.department_ids[position])
+            return self._score_values(
+                int(columns.staff_ids[position]),
+                department_id if department_id >= 0 else None,
+                matched_keywords,
+                kpi_rows[kpi_row] if kpi_row >= 0 else None,
+                columns.shift_status(position)
+            )
+        
+        position, best_score = self._pick_best_vectorized(columns, matched_keywords, score_at)
+        if position is None:
+            return None, Decimal(0)
+        
+        return self.db.get(User, int(columns.staff_ids[position])), best_score
+    
+    def _sticky_staff(
+        self,
+        customer_ids: List[int],
+        roster: RosterIndex,
+        current_time: dt_time
+    ) -> Dict[int, User]:
+        """
+        Nhân viên đang phụ trách từng khách hàng (trong cửa sổ hội thoại), chỉ
+        giữ người còn hoạt động và đang trong ca; khách hàng không có ở đây
+        được chấm điểm lại đầy đủ.
+        """
+        affinities = lookup_affinities(self.db, [customer_id for customer_id in customer_ids if customer_id])
+        if not affinities:
+            return {}
+        
+        staff_users = self.db.query(User).filter(
+            User.id.in_(set(affinities.values())),
+            User.role == "staff",
+            User.is_active == True
+        ).all()
+        eligible = {
+            staff.id: staff for staff in staff_users
+            if roster.shift_status(staff, current_time) == ON_SHIFT
+        }
+        return {
+            customer_id: eligible[user_id]
+            for customer_id, user_id in affinities.items()
+            if user_id in eligible
+        }
+    
     def find_best_staff(
         self, 
         message_content: str,
         current_date: dt_date = None
-    ) -> Tuple[Optional[User], Decimal, List[Keyword]]:
+    ) -> Tuple[Optional[User], Decimal, List[KeywordEntry]]:
         """
         Tìm nhân viên phù hợp nhất để xử lý tin nhắn
         
         Returns:
             Tuple[User, score, matched_keywords]
         """
+        if current_date is None:
+            current_date = dt_date.today()
+        
         # 1. Trích xuất từ khóa
         matched_keywords = self.extract_keywords(message_content)
         
@@ -115,26 +469,38 @@ class KeywordAnalyzer:
         # 2. Lấy danh sách phòng ban liên quan
         department_ids = list(set([kw.department_id for kw in matched_keywords]))
         
+        if self.scoring_engine == "numpy":
+            best_staff, best_score = self._find_best_staff_vectorized(
+                matched_keywords, department_ids, current_date
+            )
+            return best_staff, best_score, matched_keywords
+        
         # 3. Lấy danh sách nhân viên trong các phòng ban đó
         staff_users = self.db.query(User).filter(
             User.role == "staff",
             User.is_active == True,
             User.department_id.in_(department_ids)
-        ).all()
+        ).order_by(User.id).all()
         
         if not staff_users:
             # Không có nhân viên phù hợp
             return None, Decimal(0), matched_keywords
         
-        # 4. Tính điểm cho từng nhân viên
-        best_staff = None
-        best_score = Decimal(0)
+        # 4. Nạp KPI của tất cả ứng viên một lần, ca làm việc tra từ chỉ mục lịch trực
+        kpis_by_user = self._load_scoring_context(
+            [staff.id for staff in staff_users], current_date
+        )
+        roster = get_roster(self.db, current_date)
+        current_time = datetime.now().time()
+        shift_statuses = {
+            staff.id: roster.shift_status(staff, current_time)
+            for staff in staff_users
+        }
         
-        for staff in staff_users:
-            score = self.calculate_staff_score(staff, matched_keywords, current_date)
-            if score > best_score:
-                best_score = score
-                best_staff = staff
+        # 5. Tính điểm cho từng nhân viên trong bộ nhớ
+        best_staff, best_score = self._pick_best_scalar(
+            staff_users, matched_keywords, kpis_by_user, shift_statuses
+        )
         
         return best_staff, best_score, matched_keywords
     
@@ -146,6 +512,13 @@ class KeywordAnalyzer:
         """
         Tự động giao tin nhắn cho nhân viên phù hợp
         
+        Tin nhắn tiếp theo của cuộc hội thoại đang diễn ra đi thẳng tới nhân
+        viên đang phụ trách khách hàng (nếu còn hoạt động và đang trong ca),
+        không trích xuất từ khóa và chấm điểm lại.
+        
+        Chỉ flush vào transaction hiện tại; người gọi chịu trách nhiệm commit
+        (và báo WorkloadTracker sau khi commit thành công).
+        
         Args:
             message: Message object cần giao
             assigned_by_id: ID của người giao việc (None nếu là hệ thống)
@@ -153,40 +526,194 @@ class KeywordAnalyzer:
         Returns:
             MessageAssignment object nếu thành công, None nếu không tìm được nhân viên
         """
-        # Tìm nhân viên phù hợp
-        best_staff, score, matched_keywords = self.find_best_staff(message.content)
+        current_date = dt_date.today()
+        best_staff = self._sticky_staff(
+            [message.customer_id], get_roster(self.db, current_date), datetime.now().time()
+        ).get(message.customer_id)
+        
+        if best_staff:
+            affinity_cache.record_routes(sticky=1, scored=0)
+            assignment = self._create_assignment(
+                message, best_staff, None, [], assigned_by_id, notes=STICKY_NOTE
+            )
+        else:
+            affinity_cache.record_routes(sticky=0, scored=1)
+            # Tìm nhân viên phù hợp
+            best_staff, score, matched_keywords = self.find_best_staff(message.content)
+            
+            if not best_staff:
+                return None
+            
+            assignment = self._create_assignment(message, best_staff, score, matched_keywords, assigned_by_id)
+        
+        if message.customer_id:
+            record_affinities(self.db, {message.customer_id: best_staff.id})
+        
+        # Cập nhật KPI của nhân viên (UPDATE nguyên tử, không đọc-sửa-ghi)
+        self.db.flush()
+        increment_workload_kpi(self.db, best_staff.id, current_date)
+        
+        return assignment
+    
+    def auto_assign_messages(
+        self,
+        messages: List[Message],
+        assigned_by_id: Optional[int] = None
+    ) -> List[Optional[MessageAssignment]]:
+        """
+        Tự động giao một lô tin nhắn với cùng một snapshot từ khóa, lịch trực
+        và KPI: một truy vấn nhân viên và một truy vấn KPI cho cả lô.
+        
+        Tin nhắn được giao lần lượt theo thứ tự; KPI, tải của nhân viên và
+        nhân viên phụ trách khách hàng được cộng dồn trong bộ nhớ nên kết quả
+        giống như giao từng tin một. Chỉ flush, người gọi chịu trách nhiệm commit.
         
-        if not best_staff:
-            return None
+        Returns:
+            Danh sách MessageAssignment (hoặc None) tương ứng từng tin nhắn
+        """
+        current_date = dt_date.today()
+        roster = get_roster(self.db, current_date)
+        current_time = datetime.now().time()
+        
+        # customer_id -> nhân viên phụ trách, bổ sung dần khi giao trong lô
+        sticky = self._sticky_staff(
+            [message.customer_id for message in messages], roster, current_time
+        )
+        sticky_user_ids = [staff.id for staff in sticky.values()]
+        
+        matched_per_message = [
+            [] if message.customer_id in sticky else self.extract_keywords(message.content)
+            for message in messages
+        ]
+        department_ids = list(set(
+            kw.department_id for matched_keywords in matched_per_message for kw in matched_keywords
+        ))
+        if not department_ids and not sticky:
+            affinity_cache.record_routes(sticky=0, scored=len(messages))
+            return [None] * len(messages)
+        
+        staff_users = self.db.query(User).filter(
+            User.role == "staff",
+            User.is_active == True,
+            User.department_id.in_(department_ids)
+        ).order_by(User.id).all() if department_ids else []
+        
+        # KPI luôn được nạp vì cần cộng dồn sau mỗi lần giao
+        kpis_by_user = self._load_scoring_context(
+            list(set([staff.id for staff in staff_users] + sticky_user_ids)), current_date, load_kpis=True
+        )
+        scoring_kpis = kpis_by_user if self.load_mode != "realtime" else {}
+        columns = None
+        shift_statuses: Dict[int, Optional[str]] = {}
+        if self.scoring_engine == "numpy":
+            # Dựng cột một lần cho cả lô, KPI được cộng dồn ngay trên cột
+            columns = build_staff_columns(
+                [(staff.id, staff.department_id) for staff in staff_users],
+                [(kpi.user_id, kpi.current_value, kpi.target_value) for kpi in scoring_kpis.values()],
+                roster,
+                current_time
+            )
+        else:
+            shift_statuses = {
+                staff.id: roster.shift_status(staff, current_time)
+                for staff in staff_users
+            }
+        
+        assignments: List[Optional[MessageAssignment]] = []
+        affinities: Dict[int, int] = {}
+        kpi_deltas: Dict[int, int] = {}
+        sticky_routes = 0
+        for message, matched_keywords in zip(messages, matched_per_message):
+            best_staff = sticky.get(message.customer_id)
+            if best_staff:
+                sticky_routes += 1
+                assignment = self._create_assignment(
+                    message, best_staff, None, [], assigned_by_id, notes=STICKY_NOTE
+                )
+            else:
+                # Nhân viên luôn thuộc một phòng ban (lọc bằng IN ở trên), nên từ
+                # khóa không có phòng ban không chọn thêm ứng viên nào
+                message_departments = set(
+                    kw.department_id for kw in matched_keywords if kw.department_id is not None
+                )
+                if columns is not None:
+                    position, score = self._pick_best_vectorized(
+                        columns,
+                        matched_keywords,
+                        lambda position: self._score_staff(
+                            staff_users[position],
+                            matched_keywords,
+                            scoring_kpis.get(staff_users[position].id),
+                            columns.shift_status(position)
+                        ),
+                        np.isin(columns.department_ids, list(message_departments))
+                    )
+                    best_staff = staff_users[position] if position is not None else None
+                    best_status = columns.shift_status(position) if position is not None else None
+                else:
+                    candidates = [staff for staff in staff_users if staff.department_id in message_departments]
+                    best_staff, score = self._pick_best_scalar(
+                        candidates, matched_keywords, scoring_kpis, shift_statuses
+                    ) if candidates else (None, None)
+                    best_status = shift_statuses[best_staff.id] if best_staff else None
+                if not best_staff:
+                    assignments.append(None)
+                    continue
+                
+                assignment = self._create_assignment(message, best_staff, score, matched_keywords, assigned_by_id)
+                if message.customer_id and best_status == ON_SHIFT:
+                    sticky[message.customer_id] = best_staff
+            
+            assignments.append(assignment)
+            if message.customer_id:
+                affinities[message.customer_id] = best_staff.id
+            self._batch_open[best_staff.id] = self._batch_open.get(best_staff.id, 0) + 1
+            
+            kpi = kpis_by_user.get(best_staff.id)
+            if kpi:
+                # Chỉ cộng trong bộ nhớ cho lần chấm điểm kế tiếp (không đánh dấu
+                # dirty); giá trị trong DB được cộng nguyên tử ở cuối lô
+                set_committed_value(kpi, "current_value", (kpi.current_value or Decimal(0)) + Decimal(1))
+                kpi_deltas[kpi.id] = kpi_deltas.get(kpi.id, 0) + 1
+                if columns is not None:
+                    columns.add_to_kpi(best_staff.id, 1)
+        
+        affinity_cache.record_routes(sticky=sticky_routes, scored=len(messages) - sticky_routes)
+        record_affinities(self.db, affinities)
+        self._batch_open.clear()
+        self.db.flush()
+        add_to_kpis(self.db, kpi_deltas)
+        
+        return assignments
+    
+    def _create_assignment(
+        self,
+        message: Message,
+        staff: User,
+        score: Optional[Decimal],
+        matched_keywords: List[KeywordEntry],
+        assigned_by_id: Optional[int],
+        notes: Optional[str] = None
+    ) -> MessageAssignment:
+        """Tạo assignment và chuyển tin nhắn sang trạng thái đã giao (score None: giao theo affinity)"""
+        if "created_at" in inspect(message).unloaded:
+            # created_at do DB sinh và chưa nạp: lấy ngay trong lệnh INSERT
+            message_created_at = select(Message.created_at).where(Message.id == message.id).scalar_subquery()
+        else:
+            message_created_at = message.created_at
         
-# Tạo assignment
         assignment = MessageAssignment(
             message_id=message.id,
-            assigned_to=best_staff.id,
+            message_created_at=message_created_at,
+            assigned_to=staff.id,
             assigned_by=assigned_by_id,
-            match_score=score,
-            notes=f"Tự động giao dựa trên từ khóa: {', '.join([kw.keyword for kw in matched_keywords])}"
+            match_score=score.quantize(Decimal("0.01")) if score is not None else None,
+            notes=notes or f"Tự động giao dựa trên từ khóa: {', '.join([kw.keyword for kw in matched_keywords])}"
         )
         
         self.db.add(assignment)
-
-    # Cập nhật trạng thái tin nhắn
-        message.status = "assigned"
         
-                # Cập nhật KPI của nhân viên
-        current_date = dt_date.today()
-        kpi = self.db.query(KPI).filter(
-            KPI.user_id == best_staff.id,
-            KPI.metric_name == "Số tin nhắn xử lý",
-            KPI.period_start <= current_date,
-            KPI.period_end >= current_date
-        ).first()
-        
-        if kpi:
-            kpi.current_value = (kpi.current_value or Decimal(0)) + Decimal(1)
-        
-        self.db.commit()
-        self.db.refresh(assignment)
+        # Cập nhật trạng thái tin nhắn
+        message.status = "assigned"
         
         return assignment
-
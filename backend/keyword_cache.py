@@ -0,0 +1,116 @@
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+import os
+import threading
+import time
+
+from sqlalchemy.orm import Session
+
+from cache_version import KEYWORD_CACHE, get_cache_version, get_local_bump_count
+from keyword_matcher import KeywordMatcher
+from models import Keyword
+
+# Khoảng thời gian tối thiểu (giây) giữa hai lần kiểm tra version trong DB
+KEYWORD_CACHE_CHECK_SECONDS = float(os.getenv("KEYWORD_CACHE_CHECK_SECONDS", "5"))
+
+
+@dataclass(frozen=True)
+class KeywordEntry:
+    """Bản sao chỉ đọc của một từ khóa active, dùng chung giữa các request"""
+    id: int
+    keyword: str
+    normalized: str
+    department_id: Optional[int]
+    priority: int
+
+
+@dataclass(frozen=True)
+class KeywordSnapshot:
+    """Toàn bộ từ khóa active tại một version, kèm automaton đã build sẵn"""
+    version: int
+    entries: Tuple[KeywordEntry, ...]
+    matcher: KeywordMatcher
+
+    def match(self, message_content: str) -> List[KeywordEntry]:
+        """Trả về các từ khóa xuất hiện trong tin nhắn, theo thứ tự id"""
+        return [self.entries[index] for index in self.matcher.find_sorted(message_content)]
+
+
+_snapshot: Optional[KeywordSnapshot] = None
+_checked_at: float = 0.0
+_seen_local_bumps: int = 0
+_lock = threading.Lock()
+
+
+def _load_snapshot(db: Session, version: int) -> KeywordSnapshot:
+    active_keywords = db.query(Keyword).filter(
+        Keyword.is_active == True
+    ).order_by(Keyword.id).all()
+
+    entries = tuple(
+        KeywordEntry(
+            id=kw.id,
+            keyword=kw.keyword,
+            normalized=kw.keyword.lower(),
+            department_id=kw.department_id,
+            priority=kw.priority,
+        )
+        for kw in active_keywords
+    )
+    matcher = KeywordMatcher(entry.normalized for entry in entries)
+    return KeywordSnapshot(version=version, entries=entries, matcher=matcher)
+
+
+def get_keyword_snapshot(db: Session) -> KeywordSnapshot:
+    """
+    Lấy snapshot từ khóa của process.
+
+    Version trong DB chỉ được đọc tối đa một lần mỗi KEYWORD_CACHE_CHECK_SECONDS;
+    bảng keywords chỉ được đọc lại khi version thay đổi.
+
+    Không bao giờ chờ lock: khi request khác đang làm mới, dùng snapshot hiện
+    có (hoặc tự nạp một bản riêng nếu chưa có). Hàm được gọi cả trên thread
+    event loop (AsyncSession.run_sync), nơi request đang giữ lock chỉ chạy
+    tiếp được khi loop rảnh, nên chờ lock ở đó sẽ treo cả loop.
+    """
+    global _snapshot, _checked_at, _seen_local_bumps
+
+    now = time.monotonic()
+    local_bumps = get_local_bump_count(KEYWORD_CACHE)
+    snapshot = _snapshot
+    if (
+        snapshot is not None
+        and local_bumps == _seen_local_bumps
+        and now - _checked_at < KEYWORD_CACHE_CHECK_SECONDS
+    ):
+        return snapshot
+
+    if not _lock.acquire(blocking=False):
+        if snapshot is not None:
+            return snapshot
+        return _load_snapshot(db, get_cache_version(db, KEYWORD_CACHE))
+    try:
+        # Một request khác có thể vừa làm mới xong
+        if (
+            _snapshot is not None
+            and local_bumps == _seen_local_bumps
+            and time.monotonic() - _checked_at < KEYWORD_CACHE_CHECK_SECONDS
+        ):
+            return _snapshot
+
+        version = get_cache_version(db, KEYWORD_CACHE)
+        if _snapshot is None or _snapshot.version != version or local_bumps != _seen_local_bumps:
+            _snapshot = _load_snapshot(db, version)
+
+        _checked_at = time.monotonic()
+        _seen_local_bumps = local_bumps
+        return _snapshot
+    finally:
+        _lock.release()
+
+
+def invalidate_keyword_snapshot() -> None:
+    """Bỏ snapshot hiện tại, lần gọi kế tiếp sẽ đọc lại từ DB"""
+    global _snapshot
+    with _lock:
+        _snapshot = None
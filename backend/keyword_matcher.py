@@ -0,0 +1,79 @@
+from collections import deque
+from typing import Dict, Iterable, List, Set
+
+
+class KeywordMatcher:
+    """
+    Automaton Aho-Corasick để tìm nhiều từ khóa trong một lần duyệt tin nhắn.
+
+    Từ khóa được so khớp dạng chuỗi con sau khi chuyển về chữ thường, giống
+    hệt phép kiểm tra `keyword.lower() in content.lower()` trước đây.
+    """
+
+    def __init__(self, patterns: Iterable[str]):
+        self.patterns: List[str] = [p.lower() for p in patterns]
+
+        # Trie: mỗi node là dict ký tự -> node con
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[int]] = [[]]
+        # Từ khóa rỗng luôn khớp (tương đương "" in content)
+        self._always: List[int] = []
+
+        for index, pattern in enumerate(self.patterns):
+            if not pattern:
+                self._always.append(index)
+                continue
+            node = 0
+            for char in pattern:
+                next_node = self._goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto[node][char] = next_node
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                node = next_node
+            self._output[node].append(index)
+
+        self._build_failure_links()
+
+    def _build_failure_links(self) -> None:
+        """Tính failure link theo BFS và gộp output của các hậu tố"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fallback = self._fail[node]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(char, 0)
+                self._fail[child] = target if target != child else 0
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def find(self, content: str) -> Set[int]:
+        """Trả về tập chỉ số các từ khóa xuất hiện trong nội dung"""
+        matched: Set[int] = set(self._always)
+        if len(matched) == len(self.patterns):
+            return matched
+
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        node = 0
+        for char in content.lower():
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if output[node]:
+                matched.update(output[node])
+        return matched
+
+    def find_sorted(self, content: str) -> List[int]:
+        """
+        Chỉ số các từ khóa khớp theo thứ tự tăng dần (thứ tự của patterns).
+
+        Chỉ sắp xếp các chỉ số đã khớp, không duyệt lại toàn bộ danh sách từ khóa.
+        """
+        return sorted(self.find(content))
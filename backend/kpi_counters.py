@@ -0,0 +1,229 @@
+from datetime import date as dt_date, datetime, time as dt_time, timedelta
+from decimal import Decimal
+from typing import Dict, Iterable, Optional
+import asyncio
+import logging
+import os
+
+from sqlalchemy import and_, bindparam, func, select, update
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from database import SessionLocal, dialect_insert
+from models import KPI, JobCheckpoint, Message, MessageAssignment
+
+logger = logging.getLogger(__name__)
+
+# KPI dùng để ước lượng khối lượng công việc của nhân viên
+WORKLOAD_METRIC = "Số tin nhắn xử lý"
+# Các KPI tin nhắn khác được tính lại từ message_assignments + messages
+COMPLETED_METRIC = "Số tin nhắn hoàn thành"
+COMPLETION_RATE_METRIC = "Tỷ lệ hoàn thành"
+MESSAGE_METRICS = (WORKLOAD_METRIC, COMPLETED_METRIC, COMPLETION_RATE_METRIC)
+
+# Chu kỳ (giây) tính lại các KPI có dữ liệu thay đổi kể từ lần trước; 0 để tắt
+KPI_RECONCILE_SECONDS = float(os.getenv("KPI_RECONCILE_SECONDS", "900"))
+# Lùi mốc checkpoint để không bỏ sót assignment được ghi trước mốc nhưng commit sau khi job đọc
+KPI_RECOMPUTE_OVERLAP_SECONDS = float(os.getenv("KPI_RECOMPUTE_OVERLAP_SECONDS", "60"))
+
+KPI_RECOMPUTE_JOB = "kpi_recompute"
+
+
+def _current_workload_kpi(user_id, current_date: dt_date):
+    """ID KPI khối lượng công việc của nhân viên trong kỳ (dòng có ID nhỏ nhất)"""
+    return select(func.min(KPI.id)).where(
+        KPI.user_id == user_id,
+        KPI.metric_name == WORKLOAD_METRIC,
+        KPI.period_start <= current_date,
+        KPI.period_end >= current_date
+    ).scalar_subquery()
+
+
+def increment_workload_kpi(db: Session, user_id: int, current_date: Optional[dt_date] = None) -> None:
+    """
+    Cộng 1 vào KPI khối lượng công việc bằng một lệnh UPDATE nguyên tử
+    (current_value = current_value + 1), không đọc-sửa-ghi qua ORM nên các
+    lần giao việc song song không làm mất lượt cộng.
+    """
+    if current_date is None:
+        current_date = dt_date.today()
+    db.execute(
+        update(KPI)
+        .where(KPI.id == _current_workload_kpi(user_id, current_date))
+        .values(current_value=func.coalesce(KPI.current_value, 0) + 1)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def add_to_kpis(db: Session, deltas: Dict[int, int]) -> None:
+    """
+    Cộng dồn nguyên tử theo ID KPI, một lệnh executemany cho cả lô. ID được
+    sắp xếp để các transaction song song khóa dòng theo cùng thứ tự.
+    """
+    if not deltas:
+        return
+    db.connection().execute(
+        update(KPI.__table__)
+        .where(KPI.__table__.c.id == bindparam("kpi_id"))
+        .values(current_value=func.coalesce(KPI.__table__.c.current_value, 0) + bindparam("delta")),
+        [{"kpi_id": kpi_id, "delta": delta} for kpi_id, delta in sorted(deltas.items())]
+    )
+
+
+def _metric_value(metric_name: str, assigned: int, completed: int) -> Decimal:
+    if metric_name == WORKLOAD_METRIC:
+        return Decimal(assigned)
+    if metric_name == COMPLETED_METRIC:
+        return Decimal(completed)
+    if not assigned:
+        return Decimal(0)
+    return (Decimal(completed) * 100 / Decimal(assigned)).quantize(Decimal("0.01"))
+
+
+def recompute_kpis(
+    db: Session,
+    period_start: Optional[dt_date] = None,
+    period_end: Optional[dt_date] = None,
+    incremental: bool = False,
+    kpi_ids: Optional[Iterable[int]] = None
+) -> dict:
+    """
+    Tính lại current_value của các KPI tin nhắn (MESSAGE_METRICS) bằng một
+    truy vấn gom nhóm theo KPI trên message_assignments + messages, rồi ghi
+    các giá trị thay đổi bằng một lệnh bulk UPDATE. Người gọi commit.
+
+    - Mặc định: mọi KPI có kỳ giao với [period_start, period_end] (mặc định
+      kỳ chứa hôm nay)
+    - kpi_ids: chỉ các KPI này (quản lý vừa tạo / sửa KPI)
+    - incremental=True: chỉ KPI của nhân viên có assignment thay đổi kể từ
+      mốc lần chạy trước; mốc là updated_at lớn nhất của message_assignments
+      đọc được lúc bắt đầu (dữ liệu nguồn, không dùng updated_at của KPI vì
+      chính job và increment_workload_kpi đều ghi vào KPI). Lần chạy đầu tiên
+      (chưa có checkpoint) tính như mặc định.
+    """
+    watermark = db.scalar(select(func.max(MessageAssignment.updated_at)))
+    kpi_filter = [
+        KPI.metric_name.in_(MESSAGE_METRICS),
+        KPI.period_start.isnot(None),
+        KPI.period_end.isnot(None)
+    ]
+
+    since = None
+    if incremental:
+        checkpoint = db.get(JobCheckpoint, KPI_RECOMPUTE_JOB)
+        if checkpoint is not None:
+            since = checkpoint.checkpoint_at - timedelta(seconds=KPI_RECOMPUTE_OVERLAP_SECONDS)
+            # Không có assignment mới hơn: giữ nguyên mốc cũ
+            if watermark is None or watermark < checkpoint.checkpoint_at:
+                watermark = checkpoint.checkpoint_at
+
+    if kpi_ids is not None:
+        kpi_filter.append(KPI.id.in_(list(kpi_ids)))
+    elif since is not None:
+        changed_users = select(MessageAssignment.assigned_to).where(
+            MessageAssignment.updated_at > since,
+            MessageAssignment.assigned_to.isnot(None)
+        )
+        kpi_filter.append(KPI.user_id.in_(changed_users))
+    else:
+        if period_start is None:
+            period_start = dt_date.today()
+        if period_end is None:
+            period_end = period_start
+        kpi_filter += [KPI.period_start <= period_end, KPI.period_end >= period_start]
+
+    scanned = updated = 0
+    first_day, last_day = db.query(func.min(KPI.period_start), func.max(KPI.period_end)).filter(*kpi_filter).one()
+    if first_day is not None:
+        # Cận theo cột assigned_at (dùng được chỉ mục) cho cả cửa sổ, so khớp
+        # từng kỳ bằng ngày giao
+        assigned_day = func.date(MessageAssignment.assigned_at)
+        in_period = and_(
+            MessageAssignment.assigned_to == KPI.user_id,
+            MessageAssignment.assigned_at >= datetime.combine(first_day, dt_time.min),
+            MessageAssignment.assigned_at < datetime.combine(last_day + timedelta(days=1), dt_time.min),
+            assigned_day >= KPI.period_start,
+            assigned_day <= KPI.period_end
+        )
+        rows = db.query(
+            KPI.id,
+            KPI.metric_name,
+            KPI.current_value,
+            func.count(MessageAssignment.id),
+            func.count(Message.id)
+        ).outerjoin(
+            MessageAssignment, in_period
+        ).outerjoin(
+            Message, and_(Message.id == MessageAssignment.message_id, Message.status == "completed")
+        ).filter(
+            *kpi_filter
+        ).group_by(
+            KPI.id, KPI.metric_name, KPI.current_value
+        ).all()
+
+        changes = []
+        for kpi_id, metric_name, current_value, assigned, completed in rows:
+            value = _metric_value(metric_name, assigned, completed)
+            if current_value is None or Decimal(current_value) != value:
+                changes.append({"id": kpi_id, "current_value": value})
+        if changes:
+            db.execute(update(KPI), changes)
+        scanned, updated = len(rows), len(changes)
+
+    if incremental and kpi_ids is None and watermark is not None:
+        stmt = dialect_insert(db, JobCheckpoint)
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=[JobCheckpoint.name],
+            set_={"checkpoint_at": stmt.excluded.checkpoint_at}
+        ), {"name": KPI_RECOMPUTE_JOB, "checkpoint_at": watermark})
+
+    return {
+        "incremental": since is not None,
+        "since": since,
+        "watermark": watermark,
+        "scanned": scanned,
+        "updated": updated,
+    }
+
+
+def _recompute_changed() -> dict:
+    db = SessionLocal()
+    try:
+        result = recompute_kpis(db, incremental=True)
+        db.commit()
+        return result
+    finally:
+        db.close()
+
+
+class KpiReconciler:
+    """Task nền định kỳ tính lại các KPI có dữ liệu thay đổi (incremental)"""
+
+    def __init__(self, interval_seconds: float = KPI_RECONCILE_SECONDS):
+        self.interval_seconds = interval_seconds
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        if self.interval_seconds <= 0:
+            return
+        self._task = asyncio.create_task(self._run(), name="kpi-reconciler")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval_seconds)
+            try:
+                result = await run_in_threadpool(_recompute_changed)
+                logger.info(f"Recomputed KPIs: {result['updated']} of {result['scanned']} changed")
+            except Exception:
+                logger.exception("KPI reconciliation failed")
+
+
+# Task đối soát dùng chung trong process
+kpi_reconciler = KpiReconciler()
@@ -0,0 +1,195 @@
+from collections import deque
+from typing import Deque, Dict, List, Optional
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+from fastapi import FastAPI
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+
+from database import engine
+
+logger = logging.getLogger(__name__)
+
+# Bật đo độ trễ event loop (mặc định tắt, chỉ bật khi cần điều tra)
+LOOP_MONITOR_ENABLED = os.getenv("LOOP_MONITOR_ENABLED", "0") == "1"
+# Chu kỳ heartbeat của event loop và ngưỡng bị coi là "stall"
+LOOP_MONITOR_INTERVAL_MS = float(os.getenv("LOOP_MONITOR_INTERVAL_MS", "50"))
+LOOP_MONITOR_THRESHOLD_MS = float(os.getenv("LOOP_MONITOR_THRESHOLD_MS", "100"))
+# Số stall gần nhất giữ trong ring buffer
+LOOP_MONITOR_BUFFER_SIZE = int(os.getenv("LOOP_MONITOR_BUFFER_SIZE", "500"))
+
+_BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class LoopMonitor:
+    """
+    Phát hiện các đoạn code chặn event loop (SQL đồng bộ, CPU nặng trong async def).
+
+    - Một task heartbeat trên event loop đo độ trễ mỗi lần thức dậy
+    - Một thread watchdog, khi heartbeat trễ quá ngưỡng, chụp stack của thread
+      event loop để biết route nào đang chạy và dòng code nào đang chặn
+    - Listener cursor trên engine đồng bộ ghi câu SQL đang chạy trên thread
+      event loop (engine async không chặn loop nên không cần theo dõi)
+
+    Mỗi stall (route, SQL, vị trí code, thời lượng) được ghi vào ring buffer.
+    """
+
+    def __init__(
+        self,
+        interval_ms: float = LOOP_MONITOR_INTERVAL_MS,
+        threshold_ms: float = LOOP_MONITOR_THRESHOLD_MS,
+        buffer_size: int = LOOP_MONITOR_BUFFER_SIZE
+    ):
+        self.interval = interval_ms / 1000
+        self.threshold = threshold_ms / 1000
+        self.stalls: Deque[dict] = deque(maxlen=buffer_size)
+        self.samples = 0
+        self.max_lag_ms = 0.0
+        self._total_lag = 0.0
+
+        self._routes: Dict[object, str] = {}
+        self._loop_thread_id: Optional[int] = None
+        self._beat = 0.0
+        self._snapshot: Optional[dict] = None
+        # Câu SQL đồng bộ đang chạy trên thread event loop
+        self._statement: Optional[str] = None
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._heartbeat_task is not None
+
+    def start(self, app: FastAPI) -> None:
+        """Bắt đầu theo dõi, gọi trong lifespan khi LOOP_MONITOR_ENABLED"""
+        self._routes = {
+            route.endpoint.__code__: f"{','.join(sorted(route.methods))} {route.path}"
+            for route in app.routes
+            if isinstance(route, APIRoute)
+        }
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopped.clear()
+
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+
+        self._heartbeat_task = asyncio.create_task(self._heartbeat(), name="loop-monitor-heartbeat")
+        self._watchdog = threading.Thread(target=self._watch, name="loop-monitor-watchdog", daemon=True)
+        self._watchdog.start()
+        logger.info(f"Event loop monitor started (threshold {self.threshold * 1000:.0f}ms)")
+
+    async def stop(self) -> None:
+        if self._heartbeat_task is None:
+            return
+        self._stopped.set()
+        self._heartbeat_task.cancel()
+        await asyncio.gather(self._heartbeat_task, return_exceptions=True)
+        self._heartbeat_task = None
+        event.remove(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.remove(engine, "after_cursor_execute", self._after_cursor_execute)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        if threading.get_ident() == self._loop_thread_id:
+            self._statement = statement
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        if threading.get_ident() == self._loop_thread_id:
+            self._statement = None
+
+    async def _heartbeat(self) -> None:
+        while True:
+            before = time.monotonic()
+            self._beat = before
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(now - before - self.interval, 0.0)
+            self._beat = now
+
+            self.samples += 1
+            self._total_lag += lag
+            self.max_lag_ms = max(self.max_lag_ms, lag * 1000)
+
+            if lag >= self.threshold:
+                snapshot, self._snapshot = self._snapshot, None
+                self._record_stall(lag, snapshot or {})
+            else:
+                self._snapshot = None
+
+    def _watch(self) -> None:
+        """Thread watchdog: chụp thông tin trong lúc event loop đang bị chặn"""
+        while not self._stopped.wait(self.interval / 2):
+            if self._snapshot is not None:
+                continue
+            if time.monotonic() - self._beat - self.interval >= self.threshold / 2:
+                self._snapshot = self._capture()
+
+    def _capture(self) -> dict:
+        frame = sys._current_frames().get(self._loop_thread_id)
+        route = None
+        location = None
+        while frame is not None:
+            code = frame.f_code
+            if location is None and code.co_filename.startswith(_BACKEND_DIR) and code.co_filename != __file__:
+                location = f"{os.path.relpath(code.co_filename, _BACKEND_DIR)}:{frame.f_lineno} {code.co_name}"
+            if code in self._routes:
+                route = self._routes[code]
+                break
+            frame = frame.f_back
+        return {"route": route, "sql": self._statement, "location": location}
+
+    def _record_stall(self, lag: float, snapshot: dict) -> None:
+        stall = {
+            "at": datetime.utcnow().isoformat(),
+            "duration_ms": round(lag * 1000, 1),
+            "route": snapshot.get("route"),
+            "sql": snapshot.get("sql"),
+            "location": snapshot.get("location"),
+        }
+        self.stalls.append(stall)
+        logger.warning(
+            f"Event loop blocked {stall['duration_ms']}ms "
+            f"route={stall['route']} location={stall['location']}"
+        )
+
+    def report(self, limit: int = 20) -> dict:
+        """Các route chặn event loop nhiều nhất, tính trên ring buffer hiện tại"""
+        offenders: Dict[Optional[str], dict] = {}
+        for stall in list(self.stalls):
+            entry = offenders.setdefault(stall["route"], {
+                "route": stall["route"],
+                "stalls": 0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+                "worst_sql": None,
+                "worst_location": None,
+            })
+            entry["stalls"] += 1
+            entry["total_ms"] = round(entry["total_ms"] + stall["duration_ms"], 1)
+            if stall["duration_ms"] >= entry["max_ms"]:
+                entry["max_ms"] = stall["duration_ms"]
+                entry["worst_sql"] = stall["sql"]
+                entry["worst_location"] = stall["location"]
+
+        worst: List[dict] = sorted(offenders.values(), key=lambda entry: entry["total_ms"], reverse=True)
+        return {
+            "enabled": self.running,
+            "threshold_ms": self.threshold * 1000,
+            "samples": self.samples,
+            "avg_lag_ms": round(self._total_lag / self.samples * 1000, 2) if self.samples else None,
+            "max_lag_ms": round(self.max_lag_ms, 1),
+            "stalls_recorded": len(self.stalls),
+            "worst_offenders": worst[:limit],
+            "recent_stalls": list(self.stalls)[-limit:][::-1],
+        }
+
+
+# Monitor dùng chung trong process
+loop_monitor = LoopMonitor()
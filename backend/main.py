@@ -1,9 +1,21 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
 import logging
 
+from database import SessionLocal, async_engine
 from routers import auth, admin, manager, staff, webhook
+from ingestion_queue import WEBHOOK_INGESTION_MODE, ingestion_queue
+from dead_letters import dead_letter_scheduler
+from keyword_cache import get_keyword_snapshot
+from kpi_counters import kpi_reconciler
+from loop_monitor import LOOP_MONITOR_ENABLED, loop_monitor
+from outbox import telegram_outbox
+from realtime import realtime_hub
+from shift_roster import get_roster
+from workload_tracker import workload_reconciler
 
 # Configure logging
 logging.basicConfig(
@@ -13,13 +25,52 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+def _warm_caches() -> None:
+    """Nạp sẵn snapshot từ khóa và lịch trực trước khi nhận webhook"""
+    db = SessionLocal()
+    try:
+        get_keyword_snapshot(db)
+        get_roster(db)
+    finally:
+        db.close()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Khởi động và dừng các tác vụ nền của ứng dụng"""
+    try:
+        await run_in_threadpool(_warm_caches)
+    except Exception:
+        logger.exception("Could not warm keyword / roster caches")
+    if WEBHOOK_INGESTION_MODE == "queue":
+        await ingestion_queue.start()
+    if LOOP_MONITOR_ENABLED:
+        loop_monitor.start(app)
+    await realtime_hub.start()
+    await telegram_outbox.start()
+    await dead_letter_scheduler.start()
+    await kpi_reconciler.start()
+    await workload_reconciler.start()
+    
+    yield
+    
+    await workload_reconciler.stop()
+    await kpi_reconciler.stop()
+    await dead_letter_scheduler.stop()
+    await loop_monitor.stop()
+    await realtime_hub.stop()
+    # Xử lý nốt các sự kiện webhook đã nhận trước khi tắt
+    await ingestion_queue.drain()
+    await telegram_outbox.drain()
+    await async_engine.dispose()
+
 # Create FastAPI app
 app = FastAPI(
     title="OmniChat API",
     description="Hệ thống quản lý đa kênh cho doanh nghiệp",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    lifespan=lifespan
 )
 
 # CORS middleware - Robust configuration for development
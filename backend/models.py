@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text, Date, Time, DECIMAL, CheckConstraint
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, DateTime, ForeignKey, Text, Date, Time, DECIMAL, CheckConstraint, Index, UniqueConstraint
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from database import Base
@@ -59,6 +59,23 @@ class Customer(Base):
     updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
     
     messages = relationship("Message", back_populates="customer", cascade="all, delete-orphan")
+    identities = relationship("CustomerIdentity", back_populates="customer", cascade="all, delete-orphan")
+
+class CustomerIdentity(Base):
+    __tablename__ = "customer_identities"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    platform = Column(String(50), nullable=False)
+    external_user_id = Column(String(255), nullable=False)
+    # NULL chỉ trong transaction vừa giành được định danh, trước khi tạo khách hàng
+    customer_id = Column(Integer, ForeignKey("customers.id", ondelete="CASCADE"), index=True)
+    created_at = Column(DateTime, server_default=func.now())
+    
+    customer = relationship("Customer", back_populates="identities")
+    
+    __table_args__ = (
+        UniqueConstraint("platform", "external_user_id", name="uq_customer_identities_platform_user"),
+    )
 
 class Keyword(Base):
     __tablename__ = "keywords"
@@ -130,12 +147,25 @@ class Message(Base):
     external_id = Column(String(255))
     direction = Column(String(20), default="incoming")
     status = Column(String(20), default="pending")
+    # Trạng thái gửi ra nền tảng của tin nhắn outgoing (NULL nếu không cần gửi)
+    delivery_status = Column(String(20))
+    delivery_attempts = Column(Integer, default=0)
+    delivery_error = Column(Text)
+    delivered_at = Column(DateTime)
+    # Process outbox đang giữ tin nhắn (delivery_status = sending) và thời điểm nhận
+    delivery_claimed_by = Column(String(100))
+    delivery_claimed_at = Column(DateTime)
     created_at = Column(DateTime, server_default=func.now(), index=True)
     updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
     
     __table_args__ = (
         CheckConstraint("direction IN ('incoming', 'outgoing')", name="check_message_direction"),
         CheckConstraint("status IN ('pending', 'assigned', 'in_progress', 'completed')", name="check_message_status"),
+        CheckConstraint("delivery_status IN ('queued', 'sending', 'sent', 'failed')", name="check_message_delivery_status"),
+        # Tin nhắn mới nhất của khách hàng (danh sách hội thoại)
+        Index("idx_messages_customer_created", "customer_id", created_at.desc(), id.desc()),
+        # Mỗi tin nhắn của nền tảng chỉ được lưu một lần (chống gửi lại webhook)
+        Index("uq_messages_platform_external_id", "platform", "external_id", unique=True),
     )
     
     customer = relationship("Customer", back_populates="messages")
@@ -152,9 +182,19 @@ class MessageAssignment(Base):
     completed_at = Column(DateTime)
     notes = Column(Text)
     match_score = Column(DECIMAL(5, 2))
+    # Sao chép messages.created_at để hộp thư của nhân viên phân trang bằng một chỉ mục
+    message_created_at = Column(DateTime)
     created_at = Column(DateTime, server_default=func.now())
     updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
     
+    __table_args__ = (
+        # Hộp thư nhân viên: lọc assigned_to, sắp xếp (created_at, id) giảm dần
+        Index("idx_message_assignments_inbox", "assigned_to", message_created_at.desc(), message_id.desc()),
+        # Tính lại KPI theo nhân viên và khoảng thời gian giao, quét thay đổi theo updated_at
+        Index("idx_message_assignments_assigned_to_at", "assigned_to", "assigned_at"),
+        Index("idx_message_assignments_updated_at", "updated_at"),
+    )
+    
     message = relationship("Message", back_populates="assignments")
     assignee = relationship("User", foreign_keys=[assigned_to], back_populates="message_assignments")
     assigner = relationship("User", foreign_keys=[assigned_by])
@@ -195,3 +235,72 @@ class Notification(Base):
     created_at = Column(DateTime, server_default=func.now())
     
     user = relationship("User", back_populates="notifications")
+
+class CacheVersion(Base):
+    __tablename__ = "cache_versions"
+    
+    name = Column(String(50), primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+class JobCheckpoint(Base):
+    __tablename__ = "job_checkpoints"
+    
+    # Mốc dữ liệu nguồn job nền đã xử lý tới (ví dụ updated_at lớn nhất đã đọc)
+    name = Column(String(100), primary_key=True)
+    checkpoint_at = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+class WebhookDeadLetter(Base):
+    __tablename__ = "webhook_dead_letters"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    platform = Column(String(50), nullable=False)
+    # Payload gốc của webhook (JSON) và các sự kiện đã parse (JSON), NULL nếu không có
+    raw_payload = Column(Text)
+    events = Column(Text)
+    error = Column(Text)
+    attempts = Column(Integer, default=0)
+    status = Column(String(20), default="pending")
+    next_attempt_at = Column(DateTime)
+    resolved_at = Column(DateTime)
+    created_at = Column(DateTime, server_default=func.now())
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+    
+    __table_args__ = (
+        CheckConstraint("status IN ('pending', 'resolved', 'dead')", name="check_dead_letter_status"),
+        Index("idx_dead_letters_due", "status", "next_attempt_at"),
+    )
+
+class CustomerAffinity(Base):
+    __tablename__ = "customer_affinities"
+    
+    # Nhân viên được giao tin nhắn gần nhất của khách hàng (định tuyến "dính")
+    customer_id = Column(Integer, ForeignKey("customers.id", ondelete="CASCADE"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+    last_assigned_at = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+class Conversation(Base):
+    __tablename__ = "conversations"
+    
+    # Tóm tắt hội thoại của một khách hàng với một nhân viên phụ trách, cập nhật
+    # cùng transaction với tin nhắn để danh sách hội thoại không phải quét messages
+    id = Column(Integer, primary_key=True, index=True)
+    customer_id = Column(Integer, ForeignKey("customers.id", ondelete="CASCADE"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    last_message_id = Column(Integer, ForeignKey("messages.id", ondelete="SET NULL"))
+    last_message_preview = Column(String(255))
+    last_message_at = Column(DateTime)
+    last_direction = Column(String(20))
+    # Số tin nhắn đến từ lần cuối nhân viên trả lời / xử lý
+    unread_count = Column(Integer, nullable=False, default=0)
+    status = Column(String(20), nullable=False, default="open")
+    created_at = Column(DateTime, server_default=func.now())
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+    
+    __table_args__ = (
+        CheckConstraint("status IN ('open', 'closed')", name="check_conversation_status"),
+        UniqueConstraint("customer_id", "user_id", name="uq_conversations_customer_user"),
+        Index("idx_conversations_user_activity", "user_id", last_message_at.desc(), customer_id.desc()),
+    )
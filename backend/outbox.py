@@ -0,0 +1,468 @@
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Deque, Dict, Iterable, List, Optional
+import asyncio
+import logging
+import os
+import random
+import socket
+import time
+import uuid
+
+import httpx
+from sqlalchemy import and_, func, or_, select, update
+
+from database import AsyncSessionLocal
+from models import Conversation, Customer, Message
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+# Đổi sang server giả lập khi test
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org")
+
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))
+# Giới hạn của Telegram: ~30 tin/giây cho toàn bot, ~1 tin/giây cho mỗi chat
+OUTBOX_RATE_PER_SECOND = float(os.getenv("OUTBOX_RATE_PER_SECOND", "30"))
+OUTBOX_PER_CHAT_INTERVAL_SECONDS = float(os.getenv("OUTBOX_PER_CHAT_INTERVAL_SECONDS", "1"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_RETRY_BASE_SECONDS = float(os.getenv("OUTBOX_RETRY_BASE_SECONDS", "1"))
+OUTBOX_HTTP_TIMEOUT_SECONDS = float(os.getenv("OUTBOX_HTTP_TIMEOUT_SECONDS", "10"))
+OUTBOX_DRAIN_TIMEOUT_SECONDS = float(os.getenv("OUTBOX_DRAIN_TIMEOUT_SECONDS", "10"))
+# Tin "sending" giữ quá lâu (process giữ nó đã dừng đột ngột) được process
+# khởi động sau nhận lại; phải lớn hơn thời gian gửi hết hàng đợi lúc cao điểm
+OUTBOX_CLAIM_TIMEOUT_SECONDS = float(os.getenv("OUTBOX_CLAIM_TIMEOUT_SECONDS", "600"))
+# Chặn trên cho thời gian chờ khi ghi kết quả vào DB bị lỗi
+OUTBOX_RETRY_MAX_SECONDS = 60
+
+
+@dataclass
+class OutboundJob:
+    """Một tin nhắn gửi đi đã lưu trong DB và đã được process này nhận (delivery_status = sending)"""
+    message_id: int
+    chat_id: str
+    text: str
+    attempts: int = 0
+    # Kết quả gửi chưa ghi được vào DB: lần thử sau chỉ ghi lại, không gửi lần nữa
+    outcome: Optional[dict] = None
+    # Số lần xử lý lỗi liên tiếp (thường là lỗi DB khi ghi kết quả)
+    errors: int = 0
+    # Chưa được thử lại trước thời điểm này (time.monotonic), sau 429 / lỗi tạm thời
+    not_before: float = 0.0
+
+
+class TokenBucket:
+    """Token bucket dùng trên một event loop (không cần khóa)"""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class TelegramOutbox:
+    """
+    Outbox gửi tin nhắn của nhân viên ra Telegram Bot API.
+
+    - Một httpx.AsyncClient dùng chung (giữ kết nối, không bắt tay TLS mỗi tin)
+    - Tin nhắn của cùng một chat được gửi lần lượt theo thứ tự (FIFO), các chat
+      khác nhau được gửi song song bởi nhóm worker, xoay vòng giữa các chat
+    - Token bucket toàn cục và khoảng cách tối thiểu giữa hai tin của một chat
+    - Lỗi mạng / 429 / 5xx được gửi lại với backoff; kết quả cuối cùng
+      (sent / failed) ghi lại vào dòng Message
+    - Chat phải chờ (retry_after, backoff, khoảng cách giữa hai tin) được hẹn
+      giờ đưa lại vào hàng đợi, worker không ngủ thay cho chat đó mà chuyển
+      sang chat khác
+
+    Tin nhắn chỉ được gửi bởi process đã nhận nó: dòng Message chuyển sang
+    "sending" với delivery_claimed_by = instance_id trước khi vào hàng đợi. Khi
+    khởi động, outbox nhận các tin "queued" còn lại (và tin "sending" của process
+    đã dừng quá OUTBOX_CLAIM_TIMEOUT_SECONDS); khi tắt, tin chưa gửi được trả về
+    "queued" cho lần khởi động sau.
+    """
+
+    def __init__(
+        self,
+        token: Optional[str] = TELEGRAM_BOT_TOKEN,
+        api_base: str = TELEGRAM_API_BASE,
+        workers: int = OUTBOX_WORKERS,
+        rate_per_second: float = OUTBOX_RATE_PER_SECOND,
+        per_chat_interval: float = OUTBOX_PER_CHAT_INTERVAL_SECONDS,
+        max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+        retry_base: float = OUTBOX_RETRY_BASE_SECONDS,
+        claim_timeout: float = OUTBOX_CLAIM_TIMEOUT_SECONDS,
+        instance_id: Optional[str] = None
+    ):
+        self.token = token
+        self.api_base = api_base
+        self.worker_count = workers
+        self.rate_per_second = rate_per_second
+        self.per_chat_interval = per_chat_interval
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.claim_timeout = claim_timeout
+        self.instance_id = instance_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+        self._client: Optional[httpx.AsyncClient] = None
+        self._bucket: Optional[TokenBucket] = None
+        # chat_id -> các tin đang chờ gửi; chat có mặt ở đây thì đã nằm trong _ready
+        # hoặc đang được một worker xử lý
+        self._chats: Dict[str, Deque[OutboundJob]] = {}
+        self._ready: Optional[asyncio.Queue] = None
+        self._last_sent: Dict[str, float] = {}
+        self._workers: List[asyncio.Task] = []
+        # chat_id -> hẹn giờ đưa chat đang chờ trở lại _ready
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._recovery: Optional[asyncio.Task] = None
+        self._accepting = False
+
+        self.enqueued = 0
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.rate_limited = 0
+
+    @property
+    def running(self) -> bool:
+        return self._accepting
+
+    async def start(self) -> None:
+        """Khởi động client và worker, gọi trong lifespan của ứng dụng"""
+        if not self.token:
+            logger.info("TELEGRAM_BOT_TOKEN is not set, Telegram outbox disabled")
+            return
+        self._client = httpx.AsyncClient(
+            base_url=self.api_base,
+            timeout=OUTBOX_HTTP_TIMEOUT_SECONDS,
+            limits=httpx.Limits(max_connections=self.worker_count, max_keepalive_connections=self.worker_count)
+        )
+        self._bucket = TokenBucket(self.rate_per_second)
+        self._ready = asyncio.Queue()
+        self._workers = [
+            asyncio.create_task(self._worker(), name=f"telegram-outbox-{index}")
+            for index in range(self.worker_count)
+        ]
+        self._accepting = True
+        try:
+            await self._recover()
+        except Exception:
+            # DB tạm thời không truy cập được: không chặn ứng dụng khởi động
+            logger.exception("Telegram outbox recovery failed, retrying in the background")
+            self._recovery = asyncio.create_task(self._retry_recovery(), name="telegram-outbox-recovery")
+        logger.info(f"Telegram outbox started with {self.worker_count} workers")
+
+    async def _retry_recovery(self) -> None:
+        failures = 1
+        while self._accepting:
+            await asyncio.sleep(min(self.retry_base * 2 ** (failures - 1), OUTBOX_RETRY_MAX_SECONDS))
+            try:
+                await self._recover()
+                return
+            except Exception:
+                failures += 1
+                logger.exception(f"Telegram outbox recovery failed ({failures} attempts)")
+
+    def claim_values(self) -> dict:
+        """Giá trị cột đánh dấu tin nhắn thuộc về process này (dùng khi tạo tin mới)"""
+        return {
+            "delivery_status": "sending",
+            "delivery_claimed_by": self.instance_id,
+            "delivery_claimed_at": datetime.utcnow(),
+        }
+
+    async def _recover(self) -> None:
+        """
+        Nhận các tin nhắn chưa gửi xong từ lần chạy trước. Lệnh UPDATE có điều
+        kiện trên delivery_status nên khi nhiều process khởi động cùng lúc mỗi
+        dòng chỉ thuộc về một process; chỉ các dòng RETURNING được đưa vào hàng đợi.
+        """
+        stale_before = datetime.utcnow() - timedelta(seconds=self.claim_timeout)
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(
+                update(Message)
+                .where(
+                    Message.direction == "outgoing",
+                    or_(
+                        Message.delivery_status == "queued",
+                        and_(Message.delivery_status == "sending", Message.delivery_claimed_at < stale_before)
+                    ),
+                    Message.customer_id.in_(select(Customer.id).where(Customer.telegram_id.isnot(None)))
+                )
+                .values(**self.claim_values())
+                .returning(Message.id, Message.customer_id, Message.content)
+                .execution_options(synchronize_session=False)
+            )).all()
+            chat_ids = {}
+            if rows:
+                chat_ids = dict((await db.execute(
+                    select(Customer.id, Customer.telegram_id)
+                    .where(Customer.id.in_({row.customer_id for row in rows}))
+                )).all())
+            await db.commit()
+        for message_id, customer_id, text in sorted(rows):
+            self.enqueue(message_id, chat_ids[customer_id], text)
+        if rows:
+            logger.info(f"Telegram outbox claimed {len(rows)} undelivered messages")
+
+    async def release(self, message_ids: Iterable[int]) -> None:
+        """Trả các tin đã nhận nhưng chưa gửi về "queued" để process khác / lần chạy sau gửi"""
+        message_ids = list(message_ids)
+        if not message_ids:
+            return
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(Message)
+                .where(
+                    Message.id.in_(message_ids),
+                    Message.delivery_status == "sending",
+                    Message.delivery_claimed_by == self.instance_id
+                )
+                .values(delivery_status="queued", delivery_claimed_by=None, delivery_claimed_at=None)
+                .execution_options(synchronize_session=False)
+            )
+            await db.commit()
+
+    def enqueue(self, message_id: int, chat_id: str, text: str) -> bool:
+        """Đưa tin nhắn đã lưu vào outbox; False nếu outbox không chạy"""
+        if not self._accepting:
+            return False
+        chat_id = str(chat_id)
+        jobs = self._chats.get(chat_id)
+        if jobs is None:
+            jobs = self._chats[chat_id] = deque()
+            self._ready.put_nowait(chat_id)
+        jobs.append(OutboundJob(message_id=message_id, chat_id=chat_id, text=text))
+        self.enqueued += 1
+        return True
+
+    async def drain(self, timeout: float = OUTBOX_DRAIN_TIMEOUT_SECONDS) -> None:
+        """Ngừng nhận tin mới, chờ gửi nốt rồi đóng client"""
+        if self._ready is None:
+            return
+        self._accepting = False
+        try:
+            await asyncio.wait_for(self._ready.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pending = sum(len(jobs) for jobs in self._chats.values())
+            logger.warning(f"Telegram outbox drain timed out, {pending} messages left queued")
+        tasks = self._workers + ([self._recovery] if self._recovery else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+        self._recovery = None
+        for handle in self._timers.values():
+            handle.cancel()
+        self._timers.clear()
+        # Tin đã có kết quả gửi (chỉ chưa ghi được) không trả lại để tránh gửi hai lần
+        unsent = [job.message_id for jobs in self._chats.values() for job in jobs if job.outcome is None]
+        self._chats.clear()
+        try:
+            await self.release(unsent)
+        except Exception:
+            logger.exception(f"Telegram outbox could not release {len(unsent)} unsent messages")
+        await self._client.aclose()
+        self._client = None
+        logger.info("Telegram outbox stopped")
+
+    async def _worker(self) -> None:
+        while True:
+            chat_id = await self._ready.get()
+            jobs = self._chats[chat_id]
+            job = jobs[0]
+            delay = self._wait_time(job)
+            if delay > 0:
+                self._defer(chat_id, delay)
+                continue
+            try:
+                done = await self._deliver(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Thường là lỗi DB khi ghi kết quả: giữ tin ở đầu hàng đợi của chat
+                # (không phá thứ tự) và thử lại sau
+                job.errors += 1
+                logger.exception(f"Telegram outbox failed on message {job.message_id} (error {job.errors})")
+                done = job.errors >= self.max_attempts
+                if done:
+                    await self._give_up(job, e)
+                else:
+                    job.not_before = time.monotonic() + min(
+                        self.retry_base * 2 ** (job.errors - 1), OUTBOX_RETRY_MAX_SECONDS
+                    )
+            if done:
+                jobs.popleft()
+            if jobs:
+                # Xếp cuối hàng đợi để các chat khác được gửi xen kẽ
+                self._ready.put_nowait(chat_id)
+            else:
+                del self._chats[chat_id]
+                self._prune_last_sent()
+            self._ready.task_done()
+
+    def _wait_time(self, job: OutboundJob) -> float:
+        """Số giây tin đầu hàng của chat còn phải chờ (backoff hoặc khoảng cách giữa hai tin)"""
+        now = time.monotonic()
+        wait = job.not_before - now
+        last_sent = self._last_sent.get(job.chat_id)
+        if last_sent is not None:
+            wait = max(wait, last_sent + self.per_chat_interval - now)
+        return wait
+
+    def _defer(self, chat_id: str, delay: float) -> None:
+        """
+        Hẹn giờ đưa chat trở lại _ready rồi trả worker cho chat khác. task_done
+        chỉ được gọi khi chat đã vào lại hàng đợi, nên drain() vẫn chờ chat này.
+        """
+        self._timers[chat_id] = asyncio.get_running_loop().call_later(delay, self._wake, chat_id)
+
+    def _wake(self, chat_id: str) -> None:
+        self._timers.pop(chat_id, None)
+        self._ready.put_nowait(chat_id)
+        self._ready.task_done()
+
+    async def _give_up(self, job: OutboundJob, error: Exception) -> None:
+        """Bỏ tin khỏi hàng đợi sau quá nhiều lỗi; đánh dấu failed nếu chưa gửi"""
+        if job.outcome is not None:
+            logger.error(
+                f"Telegram message {job.message_id} got result {job.outcome['delivery_status']!r} but it could not be saved; "
+                f"it stays 'sending' until claimed again"
+            )
+            return
+        try:
+            await self._record(job, "failed", error=f"{type(error).__name__}: {error}")
+            self.failed += 1
+        except Exception:
+            logger.exception(
+                f"Telegram outbox could not mark message {job.message_id} failed; "
+                f"it stays 'sending' until claimed again"
+            )
+
+    def _prune_last_sent(self) -> None:
+        if len(self._last_sent) <= 10000:
+            return
+        cutoff = time.monotonic() - self.per_chat_interval
+        self._last_sent = {
+            chat_id: sent_at for chat_id, sent_at in self._last_sent.items() if sent_at > cutoff
+        }
+
+    async def _deliver(self, job: OutboundJob) -> bool:
+        """
+        Gửi (nếu chưa có kết quả) rồi ghi kết quả vào dòng Message. False khi
+        lần gửi gặp lỗi tạm thời và tin được hẹn thử lại (job.not_before).
+        """
+        if job.outcome is None:
+            job.outcome = await self._send(job)
+            if job.outcome is None:
+                return False
+        await self._record(job, **job.outcome)
+        if job.outcome["delivery_status"] == "sent":
+            self.sent += 1
+        else:
+            self.failed += 1
+        return True
+
+    async def _send(self, job: OutboundJob) -> Optional[dict]:
+        """
+        Gọi sendMessage một lần; trả về kết quả để ghi vào DB, hoặc None khi
+        lỗi tạm thời (hẹn thử lại qua job.not_before thay vì ngủ trong worker).
+        """
+        await self._bucket.acquire()
+        job.attempts += 1
+        retry_after = None
+        try:
+            response = await self._client.post(
+                f"/bot{self.token}/sendMessage",
+                json={"chat_id": job.chat_id, "text": job.text}
+            )
+        except httpx.HTTPError as e:
+            error = f"{type(e).__name__}: {e}"
+            retryable = True
+        else:
+            self._last_sent[job.chat_id] = time.monotonic()
+            try:
+                payload = response.json()
+            except ValueError:
+                payload = {}
+            if response.status_code == 200 and payload.get("ok", True):
+                telegram_message_id = (payload.get("result") or {}).get("message_id")
+                external_id = f"{job.chat_id}:{telegram_message_id}" if telegram_message_id else None
+                return {"delivery_status": "sent", "external_id": external_id}
+            error = payload.get("description") or f"HTTP {response.status_code}"
+            retry_after = (payload.get("parameters") or {}).get("retry_after")
+            if response.status_code == 429:
+                self.rate_limited += 1
+            retryable = response.status_code == 429 or response.status_code >= 500
+
+        if not retryable or job.attempts >= self.max_attempts:
+            logger.warning(f"Telegram delivery of message {job.message_id} failed: {error}")
+            return {"delivery_status": "failed", "error": error}
+
+        self.retries += 1
+        delay = retry_after or self.retry_base * 2 ** (job.attempts - 1)
+        job.not_before = time.monotonic() + delay + random.uniform(0, delay * 0.1)
+        return None
+
+    async def _record(
+        self,
+        job: OutboundJob,
+        delivery_status: str,
+        error: Optional[str] = None,
+        external_id: Optional[str] = None
+    ) -> None:
+        values = {
+            "delivery_status": delivery_status,
+            "delivery_attempts": job.attempts,
+            "delivery_error": error,
+            "delivery_claimed_by": None,
+            "delivery_claimed_at": None,
+        }
+        if delivery_status == "sent":
+            values["delivered_at"] = datetime.utcnow()
+            if external_id:
+                values["external_id"] = external_id
+        async with AsyncSessionLocal() as db:
+            # Chỉ ghi khi tin vẫn thuộc về process này (chưa bị process khác nhận lại)
+            await db.execute(update(Message).where(
+                Message.id == job.message_id,
+                Message.delivery_claimed_by == self.instance_id
+            ).values(**values))
+            # Đổi ETag lịch sử chat để client đang poll thấy trạng thái gửi mới
+            await db.execute(update(Conversation).where(
+                Conversation.customer_id == select(Message.customer_id).where(
+                    Message.id == job.message_id
+                ).scalar_subquery()
+            ).values(updated_at=func.now()))
+            await db.commit()
+
+    def metrics(self) -> dict:
+        """Số liệu outbox phục vụ giám sát"""
+        return {
+            "enabled": bool(self.token),
+            "instance_id": self.instance_id,
+            "running": self._accepting,
+            "pending": sum(len(jobs) for jobs in self._chats.values()),
+            "active_chats": len(self._chats),
+            "waiting_chats": len(self._timers),
+            "enqueued": self.enqueued,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+        }
+
+
+# Outbox dùng chung trong process
+telegram_outbox = TelegramOutbox()
@@ -0,0 +1,30 @@
+from datetime import datetime
+from typing import Optional, Tuple
+import base64
+import json
+
+from fastapi import HTTPException, status
+
+# Header trả cursor của trang kế tiếp (không có header = trang cuối)
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+MAX_PAGE_SIZE = 200
+
+
+def encode_cursor(sort_value: Optional[datetime], row_id: int) -> str:
+    """Cursor mờ (base64) cho phân trang keyset theo (thời điểm, id)"""
+    payload = json.dumps([sort_value.isoformat() if sort_value else None, row_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[Optional[datetime], int]:
+    """Giải mã cursor; cursor hỏng hoặc bị sửa trả về 400"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        sort_value, row_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return (datetime.fromisoformat(sort_value) if sort_value else None), int(row_id)
+    except (ValueError, TypeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Cursor không hợp lệ"
+        )
@@ -0,0 +1,217 @@
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, Iterable, Optional, Set, Tuple
+import asyncio
+import logging
+import os
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+logger = logging.getLogger(__name__)
+
+# Server gửi {"type": "ping"} khi kết nối im lặng quá khoảng này; client trả
+# lời bất kỳ frame nào (ví dụ {"type": "pong"}) để được coi là còn sống
+REALTIME_HEARTBEAT_SECONDS = float(os.getenv("REALTIME_HEARTBEAT_SECONDS", "25"))
+REALTIME_IDLE_TIMEOUT_SECONDS = float(os.getenv("REALTIME_IDLE_TIMEOUT_SECONDS", "75"))
+# Số sự kiện chờ gửi tối đa cho mỗi kết nối; client đọc không kịp bị ngắt
+# (client kết nối lại rồi tải lại dữ liệu qua API)
+REALTIME_CLIENT_QUEUE_SIZE = int(os.getenv("REALTIME_CLIENT_QUEUE_SIZE", "100"))
+REALTIME_MAX_CONNECTIONS = int(os.getenv("REALTIME_MAX_CONNECTIONS", "5000"))
+
+# Mã đóng WebSocket
+CLOSE_GOING_AWAY = 1001
+CLOSE_POLICY_VIOLATION = 1008
+CLOSE_TRY_AGAIN_LATER = 1013
+
+
+@dataclass
+class _Close:
+    """Phần tử đặc biệt trong hàng đợi: yêu cầu task gửi đóng kết nối"""
+    code: int
+    reason: str
+
+
+class RealtimeClient:
+    """Một kết nối WebSocket của nhân viên và hàng đợi sự kiện có giới hạn của nó"""
+
+    def __init__(self, user_id: int, queue_size: int):
+        self.user_id = user_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+
+    def offer(self, item) -> bool:
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def close(self, code: int, reason: str) -> None:
+        # Bỏ các sự kiện còn chờ để chắc chắn có chỗ cho yêu cầu đóng
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(_Close(code, reason))
+
+
+class RealtimeHub:
+    """
+    Đẩy sự kiện (giao việc, tin nhắn mới, thông báo) tới các kết nối WebSocket
+    của nhân viên trong process.
+
+    - publish() an toàn khi gọi từ thread bất kỳ (luồng ingestion chạy trong
+      threadpool): sự kiện được chuyển sang event loop bằng call_soon_threadsafe
+      và chỉ nên gọi sau khi transaction đã commit
+    - Mỗi kết nối có hàng đợi giới hạn; kết nối đọc chậm bị đóng (1013) thay vì
+      để bộ nhớ tăng không giới hạn
+    - Kết nối nhàn rỗi chỉ tốn hai coroutine đang chờ: heartbeat được gửi khi
+      không có sự kiện, client im lặng quá REALTIME_IDLE_TIMEOUT_SECONDS bị đóng
+
+    Hub chỉ biết kết nối của process hiện tại; khi chạy nhiều worker, client vẫn
+    dùng API REST để tải lại dữ liệu sau khi kết nối lại.
+    """
+
+    def __init__(
+        self,
+        heartbeat_seconds: float = REALTIME_HEARTBEAT_SECONDS,
+        idle_timeout_seconds: float = REALTIME_IDLE_TIMEOUT_SECONDS,
+        queue_size: int = REALTIME_CLIENT_QUEUE_SIZE,
+        max_connections: int = REALTIME_MAX_CONNECTIONS
+    ):
+        self.heartbeat_seconds = heartbeat_seconds
+        self.idle_timeout_seconds = idle_timeout_seconds
+        self.queue_size = queue_size
+        self.max_connections = max_connections
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._clients: Dict[int, Set[RealtimeClient]] = {}
+        # Ảnh chụp bất biến của các user đang kết nối, đọc được từ thread khác
+        self._user_ids: FrozenSet[int] = frozenset()
+        self._connections = 0
+
+        self.published = 0
+        self.delivered = 0
+        self.slow_disconnects = 0
+        self.rejected = 0
+
+    @property
+    def running(self) -> bool:
+        return self._loop is not None
+
+    async def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+
+    async def stop(self) -> None:
+        """Đóng mọi kết nối (1001) khi tắt ứng dụng"""
+        self._loop = None
+        for clients in self._clients.values():
+            for client in clients:
+                client.close(CLOSE_GOING_AWAY, "Server shutting down")
+
+    def subscribed_users(self) -> FrozenSet[int]:
+        """Các user đang có ít nhất một kết nối (gọi được từ mọi thread)"""
+        return self._user_ids
+
+    def publish(self, events: Iterable[Tuple[int, dict]]) -> None:
+        """Gửi các cặp (user_id, sự kiện); sự kiện của user không kết nối bị bỏ qua"""
+        loop = self._loop
+        user_ids = self._user_ids
+        if loop is None or not user_ids:
+            return
+        relevant = [(user_id, event) for user_id, event in events if user_id in user_ids]
+        if not relevant:
+            return
+        try:
+            loop.call_soon_threadsafe(self._deliver, relevant)
+        except RuntimeError:
+            # Event loop đã đóng (đang tắt ứng dụng)
+            pass
+
+    def _deliver(self, events) -> None:
+        for user_id, event in events:
+            self.published += 1
+            for client in list(self._clients.get(user_id, ())):
+                if client.offer(event):
+                    self.delivered += 1
+                else:
+                    self.slow_disconnects += 1
+                    self._unregister(client)
+                    client.close(CLOSE_TRY_AGAIN_LATER, "Client too slow")
+
+    def _register(self, user_id: int) -> Optional[RealtimeClient]:
+        if self._connections >= self.max_connections:
+            self.rejected += 1
+            return None
+        client = RealtimeClient(user_id, self.queue_size)
+        self._clients.setdefault(user_id, set()).add(client)
+        self._connections += 1
+        self._user_ids = frozenset(self._clients)
+        return client
+
+    def _unregister(self, client: RealtimeClient) -> None:
+        clients = self._clients.get(client.user_id)
+        if not clients or client not in clients:
+            return
+        clients.discard(client)
+        if not clients:
+            del self._clients[client.user_id]
+        self._connections -= 1
+        self._user_ids = frozenset(self._clients)
+
+    async def serve(self, websocket: WebSocket, user_id: int) -> None:
+        """Phục vụ một kết nối đã xác thực cho tới khi một trong hai phía đóng"""
+        client = self._register(user_id) if self.running else None
+        if client is None:
+            await websocket.close(code=CLOSE_TRY_AGAIN_LATER)
+            return
+
+        await websocket.accept()
+        sender = asyncio.create_task(self._send_loop(websocket, client))
+        receiver = asyncio.create_task(self._receive_loop(websocket))
+        try:
+            await asyncio.wait({sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            self._unregister(client)
+            for task in (sender, receiver):
+                task.cancel()
+            await asyncio.gather(sender, receiver, return_exceptions=True)
+            if receiver.done() and not receiver.cancelled() and receiver.exception() is None:
+                # Client im lặng quá lâu
+                try:
+                    await websocket.close(code=CLOSE_GOING_AWAY)
+                except RuntimeError:
+                    pass
+
+    async def _send_loop(self, websocket: WebSocket, client: RealtimeClient) -> None:
+        while True:
+            try:
+                item = await asyncio.wait_for(client.queue.get(), self.heartbeat_seconds)
+            except asyncio.TimeoutError:
+                item = {"type": "ping"}
+            if isinstance(item, _Close):
+                await websocket.close(code=item.code, reason=item.reason)
+                return
+            await websocket.send_json(item)
+
+    async def _receive_loop(self, websocket: WebSocket) -> None:
+        """Chờ frame từ client; trả về khi client im lặng quá idle timeout"""
+        while True:
+            try:
+                message = await asyncio.wait_for(websocket.receive(), self.idle_timeout_seconds)
+            except asyncio.TimeoutError:
+                return
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+
+    def metrics(self) -> dict:
+        """Số liệu kết nối realtime phục vụ giám sát"""
+        return {
+            "running": self.running,
+            "connections": self._connections,
+            "users": len(self._user_ids),
+            "max_connections": self.max_connections,
+            "published": self.published,
+            "delivered": self.delivered,
+            "slow_disconnects": self.slow_disconnects,
+            "rejected": self.rejected,
+        }
+
+
+# Hub dùng chung trong process
+realtime_hub = RealtimeHub()
@@ -0,0 +1,78 @@
+from collections import OrderedDict
+from typing import Hashable, Optional, Set
+import os
+import threading
+
+# Số ID tin nhắn gần nhất được giữ trong bộ nhớ để loại webhook gửi lại
+WEBHOOK_DEDUP_CAPACITY = int(os.getenv("WEBHOOK_DEDUP_CAPACITY", "100000"))
+
+
+class RecentIdFilter:
+    """
+    Bộ lọc LRU các ID tin nhắn đã nhận gần đây, đặt trước DB.
+
+    Nền tảng thường gửi lại webhook ngay sau lần đầu (timeout, lỗi mạng), nên
+    phần lớn bản trùng bị loại ở đây mà không tốn truy vấn nào. Bộ lọc chỉ là
+    lớp tăng tốc: ràng buộc unique (platform, external_id) trong DB vẫn là
+    nguồn chống trùng cuối cùng (restart, nhiều worker, ID đã bị đẩy khỏi LRU).
+
+    Một ID đi qua hai trạng thái:
+    - claim(): đang xử lý, các bản trùng đến cùng lúc bị loại
+    - confirm(): đã commit, nhớ tới khi bị đẩy khỏi LRU
+    release() trả lại ID khi xử lý lỗi để lần gửi lại sau vẫn được nhận.
+    """
+
+    def __init__(self, capacity: int = WEBHOOK_DEDUP_CAPACITY):
+        self.capacity = capacity
+        self._seen: "OrderedDict[Hashable, None]" = OrderedDict()
+        self._pending: Set[Hashable] = set()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def claim(self, key: Optional[Hashable]) -> bool:
+        """Nhận xử lý một ID; False nếu ID đã nhận hoặc đang được xử lý"""
+        if key is None:
+            return True
+        with self._lock:
+            if key in self._pending or key in self._seen:
+                if key in self._seen:
+                    self._seen.move_to_end(key)
+                self.hits += 1
+                return False
+            self._pending.add(key)
+            self.misses += 1
+            return True
+
+    def confirm(self, key: Optional[Hashable]) -> None:
+        """Ghi nhớ ID đã được lưu (hoặc DB xác nhận là bản trùng)"""
+        if key is None:
+            return
+        with self._lock:
+            self._pending.discard(key)
+            self._seen[key] = None
+            self._seen.move_to_end(key)
+            while len(self._seen) > self.capacity:
+                self._seen.popitem(last=False)
+
+    def release(self, key: Optional[Hashable]) -> None:
+        """Bỏ claim khi xử lý lỗi"""
+        if key is None:
+            return
+        with self._lock:
+            self._pending.discard(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._seen),
+                "pending": len(self._pending),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+# Bộ lọc dùng chung trong process
+recent_ids = RecentIdFilter()
@@ -5,12 +5,22 @@ from typing import List, Optional
 from datetime import datetime, date
 
 from database import get_db
+from cache_version import ROSTER_CACHE, bump_cache_version
+from affinity import affinity_cache
+from customer_cache import customer_cache
+from dead_letters import dead_letter_scheduler
+from ingestion_queue import ingestion_queue
+from kpi_counters import recompute_kpis
+from loop_monitor import loop_monitor
+from outbox import telegram_outbox
+from realtime import realtime_hub
+from recent_ids import recent_ids
 from auth import get_admin_user, get_password_hash
-from models import User, Department, Keyword, Message, MessageAssignment, Request, KPI
+from models import User, Department, Keyword, Message, MessageAssignment, Request, KPI, WebhookDeadLetter
 from schemas import (
     UserResponse, UserCreate, UserUpdate, UserWithDepartment,
     DashboardStatistics, StatisticsByDepartment, StatisticsByUser, StatisticsByRequestType,
-    KeywordWithDepartment
+    KeywordWithDepartment, DeadLetterResponse, DeadLetterReplay
 )
 
 router = APIRouter(prefix="/api/admin", tags=["Admin"])
@@ -182,6 +192,132 @@ async def get_statistics_by_request_type(
     
     return result
 
+# ============= KPI Maintenance =============
+@router.post("/kpis/recompute", response_model=dict)
+async def recompute_message_kpis(
+    current_user: User = Depends(get_admin_user),
+    db: Session = Depends(get_db),
+    period_start: Optional[date] = None,
+    period_end: Optional[date] = None,
+    incremental: bool = False
+):
+    """
+    Tính lại KPI tin nhắn ("Số tin nhắn xử lý", "Số tin nhắn hoàn thành",
+    "Tỷ lệ hoàn thành") từ message_assignments và messages
+    
+    - **period_start / period_end**: các KPI có kỳ giao với khoảng này (mặc định: hôm nay)
+    - **incremental**: chỉ tính các KPI có dữ liệu thay đổi kể từ lần chạy incremental trước
+    """
+    
+    if period_start and period_end and period_start > period_end:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="period_start phải trước period_end"
+        )
+    
+    result = recompute_kpis(db, period_start, period_end or period_start, incremental=incremental)
+    db.commit()
+    
+    return result
+
+# ============= Ingestion Monitoring =============
+@router.get("/ingestion/metrics", response_model=dict)
+async def get_ingestion_metrics(
+    current_user: User = Depends(get_admin_user)
+):
+    """Số liệu hàng đợi xử lý webhook (độ sâu, số sự kiện đã xử lý, lỗi, ...)"""
+    
+    return {
+        **ingestion_queue.metrics(),
+        "dedup": recent_ids.stats(),
+        "customer_cache": customer_cache.stats(),
+        "affinity": affinity_cache.stats(),
+    }
+
+@router.get("/dead-letters", response_model=List[DeadLetterResponse])
+async def get_dead_letters(
+    current_user: User = Depends(get_admin_user),
+    db: Session = Depends(get_db),
+    status_filter: Optional[str] = None,
+    platform: Optional[str] = None,
+    skip: int = 0,
+    limit: int = 100
+):
+    """Danh sách sự kiện webhook lỗi đang chờ thử lại / đã bỏ cuộc / đã xử lý"""
+    
+    query = db.query(WebhookDeadLetter)
+    
+    if status_filter:
+        query = query.filter(WebhookDeadLetter.status == status_filter)
+    if platform:
+        query = query.filter(WebhookDeadLetter.platform == platform)
+    
+    return query.order_by(WebhookDeadLetter.id.desc()).offset(skip).limit(limit).all()
+
+@router.post("/dead-letters/replay", response_model=dict)
+async def replay_dead_letters(
+    replay_data: DeadLetterReplay,
+    current_user: User = Depends(get_admin_user),
+    db: Session = Depends(get_db)
+):
+    """
+    Đưa dead letter trở lại hàng thử lại ngay (reset số lần thử).
+    
+    - **ids**: danh sách ID cần replay; bỏ trống để replay mọi dòng theo **status**
+    - **status**: trạng thái cần replay khi không truyền ids (mặc định "dead")
+    """
+    
+    query = db.query(WebhookDeadLetter).filter(
+        WebhookDeadLetter.status != "resolved",
+        # Dòng không có sự kiện đã parse thì không thể thử lại
+        WebhookDeadLetter.events.isnot(None)
+    )
+    
+    if replay_data.ids:
+        query = query.filter(WebhookDeadLetter.id.in_(replay_data.ids))
+    else:
+        query = query.filter(WebhookDeadLetter.status == replay_data.status)
+    
+    replayed = query.update({
+        WebhookDeadLetter.status: "pending",
+        WebhookDeadLetter.attempts: 0,
+        WebhookDeadLetter.next_attempt_at: datetime.utcnow()
+    }, synchronize_session=False)
+    db.commit()
+    
+    dead_letter_scheduler.wake()
+    
+    return {"replayed": replayed}
+
+@router.get("/outbox/metrics", response_model=dict)
+async def get_outbox_metrics(
+    current_user: User = Depends(get_admin_user)
+):
+    """Số liệu outbox gửi tin ra Telegram (đang chờ, đã gửi, lỗi, retry)"""
+    
+    return telegram_outbox.metrics()
+
+@router.get("/realtime/metrics", response_model=dict)
+async def get_realtime_metrics(
+    current_user: User = Depends(get_admin_user)
+):
+    """Số liệu kết nối WebSocket (số kết nối, sự kiện đã đẩy, client bị ngắt vì đọc chậm)"""
+    
+    return realtime_hub.metrics()
+
+@router.get("/event-loop/stalls", response_model=dict)
+async def get_event_loop_stalls(
+    current_user: User = Depends(get_admin_user),
+    limit: int = Query(20, ge=1, le=100)
+):
+    """
+    Các route chặn event loop lâu nhất (SQL đồng bộ, xử lý nặng trong async def).
+    
+    Chỉ có dữ liệu khi bật LOOP_MONITOR_ENABLED=1.
+    """
+    
+    return loop_monitor.report(limit)
+
 # ============= Keywords Management =============
 @router.get("/keywords", response_model=List[KeywordWithDepartment])
 async def get_all_keywords(
@@ -312,6 +448,9 @@ async def update_user(
     if user_data.phone is not None:
         user.phone = user_data.phone
     if user_data.department_id is not None:
+        if user.department_id != user_data.department_id:
+            # Lịch trực được đánh chỉ mục theo phòng ban của nhân viên
+            bump_cache_version(db, ROSTER_CACHE)
         user.department_id = user_data.department_id
     if user_data.is_active is not None:
         user.is_active = user_data.is_active
@@ -1,8 +1,8 @@
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import timedelta
 
-from database import get_db
+from database import get_async_db
 from auth import authenticate_user, create_access_token, get_current_user, ACCESS_TOKEN_EXPIRE_MINUTES
 from schemas import LoginRequest, Token, UserResponse
 from models import User
@@ -10,7 +10,7 @@ from models import User
 router = APIRouter(prefix="/api/auth", tags=["Authentication"])
 
 @router.post("/login", response_model=Token)
-async def login(login_data: LoginRequest, db: Session = Depends(get_db)):
+async def login(login_data: LoginRequest, db: AsyncSession = Depends(get_async_db)):
     """
     Đăng nhập và nhận JWT token
     
@@ -22,7 +22,7 @@ async def login(login_data: LoginRequest, db: Session = Depends(get_db)):
     - Manager: manager.sales@omnichat.com / manager123
     - Staff: staff1@omnichat.com / staff123
     """
-    user = authenticate_user(db, login_data.email, login_data.password)
+    user = await authenticate_user(db, login_data.email, login_data.password)
     
     if not user:
         raise HTTPException(
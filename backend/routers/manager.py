@@ -5,7 +5,9 @@ from typing import List, Optional
 from datetime import datetime, date
 
 from database import get_db
+from cache_version import KEYWORD_CACHE, ROSTER_CACHE, bump_cache_version
 from auth import get_manager_user, get_password_hash
+from kpi_counters import MESSAGE_METRICS, recompute_kpis
 from models import User, Keyword, KPI, Shift, UserShift, Request, Department
 from schemas import (
     UserResponse, UserCreate, UserUpdate,
@@ -197,6 +199,10 @@ async def create_kpi(
     
     new_kpi = KPI(**kpi_data.dict())
     db.add(new_kpi)
+    db.flush()
+    # KPI tin nhắn được tính từ assignment ngay (job incremental chỉ theo dõi assignment)
+    if new_kpi.metric_name in MESSAGE_METRICS:
+        recompute_kpis(db, kpi_ids=[new_kpi.id])
     db.commit()
     db.refresh(new_kpi)
     
@@ -225,6 +231,9 @@ async def update_kpi(
     for key, value in kpi_data.dict(exclude_unset=True).items():
         setattr(kpi, key, value)
     
+    if kpi.metric_name in MESSAGE_METRICS:
+        db.flush()
+        recompute_kpis(db, kpi_ids=[kpi.id])
     db.commit()
     db.refresh(kpi)
     
@@ -292,6 +301,7 @@ async def create_keyword(
     
     new_keyword = Keyword(**keyword_data.dict())
     db.add(new_keyword)
+    bump_cache_version(db, KEYWORD_CACHE)
     db.commit()
     db.refresh(new_keyword)
     
@@ -320,6 +330,7 @@ async def update_keyword(
     for key, value in keyword_data.dict(exclude_unset=True).items():
         setattr(keyword, key, value)
     
+    bump_cache_version(db, KEYWORD_CACHE)
     db.commit()
     db.refresh(keyword)
     
@@ -345,6 +356,7 @@ async def delete_keyword(
         )
     
     db.delete(keyword)
+    bump_cache_version(db, KEYWORD_CACHE)
     db.commit()
     
     return {"message": "Đã xóa từ khóa thành công"}
@@ -379,6 +391,7 @@ async def create_shift(
     
     new_shift = Shift(**shift_data.dict())
     db.add(new_shift)
+    bump_cache_version(db, ROSTER_CACHE)
     db.commit()
     db.refresh(new_shift)
     
@@ -407,6 +420,7 @@ async def update_shift(
     for key, value in shift_data.dict(exclude_unset=True).items():
         setattr(shift, key, value)
     
+    bump_cache_version(db, ROSTER_CACHE)
     db.commit()
     db.refresh(shift)
     
@@ -432,6 +446,7 @@ async def delete_shift(
         )
     
     db.delete(shift)
+    bump_cache_version(db, ROSTER_CACHE)
     db.commit()
     
     return {"message": "Đã xóa ca làm việc thành công"}
@@ -485,6 +500,7 @@ async def assign_shift_to_staff(
     
     new_assignment = UserShift(**assignment_data.dict())
     db.add(new_assignment)
+    bump_cache_version(db, ROSTER_CACHE)
     db.commit()
     db.refresh(new_assignment)
     
@@ -1,14 +1,17 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from sqlalchemy import and_
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response, WebSocket, status
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import func, select, tuple_
 from typing import List, Optional
 from datetime import datetime
-import os
-import httpx
 
-from database import get_db
-from auth import get_staff_user, get_current_user
-from models import User, Message, MessageAssignment, Customer, Request, Notification
+from database import AsyncSessionLocal, get_async_db
+from auth import decode_access_token, get_staff_user, get_current_user
+from conversations import record_outgoing, set_conversation_status
+from models import User, Department, Message, MessageAssignment, Customer, Conversation, Request, Notification
+from outbox import telegram_outbox
+from pagination import MAX_PAGE_SIZE, NEXT_CURSOR_HEADER, decode_cursor, encode_cursor
+from realtime import CLOSE_POLICY_VIOLATION, realtime_hub
+from workload_tracker import workload_tracker
 from schemas import (
     MessageWithCustomer, MessageUpdate, MessageResponse,
     CustomerResponse,
@@ -18,31 +21,55 @@ from schemas import (
 
 router = APIRouter(prefix="/api/staff", tags=["Staff"])
 
-TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-
 # ============= Messages =============
 @router.get("/messages", response_model=List[MessageWithCustomer])
 async def get_assigned_messages(
+    response: Response,
     current_user: User = Depends(get_staff_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     status_filter: Optional[str] = None,
-    skip: int = 0,
-    limit: int = 50
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE)
 ):
-    """Lấy danh sách tin nhắn được giao"""
-    
-    query = db.query(Message).join(MessageAssignment).filter(
+    """
+    Lấy danh sách tin nhắn được giao, mới nhất trước
+    
+    Phân trang keyset theo (created_at, id): truyền lại giá trị header
+    X-Next-Cursor vào **cursor** để lấy trang kế tiếp; không có header
+    nghĩa là đã hết.
+    """
+    
+    query = select(Message, Customer.name, Customer.phone, MessageAssignment.message_created_at).join(
+        MessageAssignment, MessageAssignment.message_id == Message.id
+    ).outerjoin(
+        Customer, Customer.id == Message.customer_id
+    ).where(
         MessageAssignment.assigned_to == current_user.id
     )
     
     if status_filter:
-        query = query.filter(Message.status == status_filter)
+        query = query.where(Message.status == status_filter)
+    
+    if cursor:
+        created_at, message_id = decode_cursor(cursor)
+        query = query.where(
+            tuple_(MessageAssignment.message_created_at, MessageAssignment.message_id) < tuple_(created_at, message_id)
+        )
+    
+    rows = (await db.execute(
+        query.order_by(
+            MessageAssignment.message_created_at.desc(),
+            MessageAssignment.message_id.desc()
+        ).limit(limit + 1)
+    )).all()
     
-    messages = query.order_by(Message.created_at.desc()).offset(skip).limit(limit).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last_message, _, _, last_created_at = rows[-1]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(last_created_at, last_message.id)
     
     result = []
-    for msg in messages:
-        customer = db.query(Customer).filter(Customer.id == msg.customer_id).first()
+    for msg, customer_name, customer_phone, _ in rows:
         result.append({
             "id": msg.id,
             "customer_id": msg.customer_id,
@@ -52,8 +79,8 @@ async def get_assigned_messages(
             "status": msg.status,
             "external_id": msg.external_id,
             "created_at": msg.created_at,
-            "customer_name": customer.name if customer else None,
-            "customer_phone": customer.phone if customer else None
+            "customer_name": customer_name,
+            "customer_phone": customer_phone
         })
     
     return result
@@ -62,14 +89,14 @@ async def get_assigned_messages(
 async def get_message_detail(
     message_id: int,
     current_user: User = Depends(get_staff_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Lấy chi tiết tin nhắn"""
     
-    message = db.query(Message).join(MessageAssignment).filter(
+    message = (await db.scalars(select(Message).join(MessageAssignment).where(
         Message.id == message_id,
         MessageAssignment.assigned_to == current_user.id
-    ).first()
+    ))).first()
     
     if not message:
         raise HTTPException(
@@ -77,7 +104,7 @@ async def get_message_detail(
             detail="Không tìm thấy tin nhắn hoặc bạn không có quyền truy cập"
         )
     
-    customer = db.query(Customer).filter(Customer.id == message.customer_id).first()
+    customer = await db.get(Customer, message.customer_id)
     
     return {
         "id": message.id,
@@ -97,15 +124,15 @@ async def mark_message_complete(
     message_id: int,
     notes: Optional[str] = None,
     current_user: User = Depends(get_staff_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Đánh dấu tin nhắn đã hoàn thành"""
     
     # Kiểm tra message có được giao cho user không
-    assignment = db.query(MessageAssignment).filter(
+    assignment = (await db.scalars(select(MessageAssignment).where(
         MessageAssignment.message_id == message_id,
         MessageAssignment.assigned_to == current_user.id
-    ).first()
+    ))).first()
     
     if not assignment:
         raise HTTPException(
@@ -113,7 +140,7 @@ async def mark_message_complete(
             detail="Không tìm thấy tin nhắn hoặc bạn không có quyền truy cập"
         )
     
-    message = db.query(Message).filter(Message.id == message_id).first()
+    message = await db.get(Message, message_id)
     
     if message.status == "completed":
         raise HTTPException(
@@ -127,7 +154,21 @@ async def mark_message_complete(
     if notes:
         assignment.notes = notes
     
-    db.commit()
+    # Hội thoại đóng khi staff không còn tin nhắn nào chưa xong của khách hàng
+    still_open = (await db.scalars(select(MessageAssignment.id).join(Message).where(
+        Message.customer_id == message.customer_id,
+        MessageAssignment.assigned_to == current_user.id,
+        MessageAssignment.completed_at.is_(None),
+        MessageAssignment.id != assignment.id
+    ).limit(1))).first()
+    await db.run_sync(
+        set_conversation_status, message.customer_id, current_user.id,
+        "open" if still_open else "closed"
+    )
+    
+    await db.commit()
+    
+    workload_tracker.assignment_closed(current_user.id, message_id)
     
     return {"message": "Đã đánh dấu tin nhắn hoàn thành"}
 
@@ -135,14 +176,14 @@ async def mark_message_complete(
 async def mark_message_in_progress(
     message_id: int,
     current_user: User = Depends(get_staff_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Đánh dấu tin nhắn đang xử lý"""
     
-    assignment = db.query(MessageAssignment).filter(
+    assignment = (await db.scalars(select(MessageAssignment).where(
         MessageAssignment.message_id == message_id,
         MessageAssignment.assigned_to == current_user.id
-    ).first()
+    ))).first()
     
     if not assignment:
         raise HTTPException(
@@ -150,101 +191,170 @@ async def mark_message_in_progress(
             detail="Không tìm thấy tin nhắn hoặc bạn không có quyền truy cập"
         )
     
-    message = db.query(Message).filter(Message.id == message_id).first()
+    message = await db.get(Message, message_id)
     message.status = "in_progress"
+    await db.run_sync(set_conversation_status, message.customer_id, current_user.id, "open")
     
-    db.commit()
+    await db.commit()
     
     return {"message": "Đã đánh dấu tin nhắn đang xử lý"}
 
 # ============= Customers =============
 @router.get("/customers", response_model=List[dict])
 async def get_customers_list(
+    response: Response,
     current_user: User = Depends(get_staff_user),
-    db: Session = Depends(get_db),
-    skip: int = 0,
-    limit: int = 50
+    db: AsyncSession = Depends(get_async_db),
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE)
 ):
-    """Lấy danh sách khách hàng mà staff đang phụ trách"""
-    
-    # Lấy danh sách customer_id từ messages được giao
-    customer_ids = db.query(Message.customer_id).distinct().join(MessageAssignment).filter(
-        MessageAssignment.assigned_to == current_user.id
-    ).all()
-    
-    customer_ids = [cid[0] for cid in customer_ids]
-    
-    if not customer_ids:
-        return []
-    
-    customers = db.query(Customer).filter(Customer.id.in_(customer_ids)).offset(skip).limit(limit).all()
+    """
+    Lấy danh sách khách hàng mà staff đang phụ trách, hoạt động gần nhất trước
+    
+    Đọc thẳng từ bảng conversations (được cập nhật cùng transaction với mỗi
+    tin nhắn đến / đi) qua chỉ mục (user_id, last_message_at, customer_id).
+    Phân trang keyset theo (thời điểm tin nhắn mới nhất, id khách hàng) qua
+    header X-Next-Cursor.
+    """
+    
+    query = select(
+        Conversation.customer_id,
+        Customer.name,
+        Customer.platform,
+        Conversation.last_message_preview,
+        Conversation.last_message_at,
+        Conversation.last_direction,
+        Conversation.unread_count,
+        Conversation.status
+    ).join(
+        Customer, Customer.id == Conversation.customer_id
+    ).where(
+        Conversation.user_id == current_user.id
+    )
     
-    result = []
-    for customer in customers:
-        # Lấy tin nhắn mới nhất
-        latest_message = db.query(Message).filter(
-            Message.customer_id == customer.id
-        ).order_by(Message.created_at.desc()).first()
-        
-        # Kiểm tra trạng thái xử lý
-        assignment = db.query(MessageAssignment).join(Message).filter(
-            Message.customer_id == customer.id,
-            MessageAssignment.assigned_to == current_user.id
-        ).order_by(MessageAssignment.assigned_at.desc()).first()
-        
-        status = "completed" if assignment and assignment.completed_at else "in_progress"
-        
-        result.append({
-            "id": customer.id,
-            "name": customer.name or "Không rõ",
-            "platform": customer.platform,
-            "latest_message": latest_message.content if latest_message else "",
-            "latest_message_time": latest_message.created_at if latest_message else None,
-            "status": status
-        })
+    if cursor:
+        latest_time, customer_id = decode_cursor(cursor)
+        query = query.where(
+            tuple_(Conversation.last_message_at, Conversation.customer_id) < tuple_(latest_time, customer_id)
+        )
     
-    return result
+    rows = (await db.execute(
+        query.order_by(Conversation.last_message_at.desc(), Conversation.customer_id.desc()).limit(limit + 1)
+    )).all()
+    
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(rows[-1].last_message_at, rows[-1].customer_id)
+    
+    return [
+        {
+            "id": row.customer_id,
+            "name": row.name or "Không rõ",
+            "platform": row.platform,
+            "latest_message": row.last_message_preview or "",
+            "latest_message_time": row.last_message_at,
+            "latest_direction": row.last_direction,
+            "unread_count": row.unread_count,
+            "status": "completed" if row.status == "closed" else "in_progress"
+        }
+        for row in rows
+    ]
+
+async def _has_customer_access(db: AsyncSession, customer_id: int, user_id: int) -> bool:
+    """Nhân viên được xem / nhắn cho khách hàng khi đã được giao ít nhất một tin của khách"""
+    return (await db.scalars(select(MessageAssignment.id).join(Message).where(
+        Message.customer_id == customer_id,
+        MessageAssignment.assigned_to == user_id
+    ).limit(1))).first() is not None
+
+def _history_etag(last_message_id: Optional[int], updated_at: Optional[datetime], assignees: int) -> str:
+    """
+    ETag của lịch sử chat, lấy từ các dòng hội thoại của khách hàng (mọi nhân
+    viên phụ trách, không chỉ người đang xem).
+
+    Chỉ last_message_id là chưa đủ: trang trả về còn chứa trạng thái xử lý và
+    trạng thái gửi của các tin cũ, mà các thay đổi này không tạo tin nhắn mới.
+    Chúng cập nhật updated_at của dòng hội thoại (đổi trạng thái, outbox ghi
+    kết quả gửi), còn số dòng đổi khi khách được giao thêm nhân viên.
+    """
+    revision = updated_at.strftime("%Y%m%d%H%M%S%f") if updated_at else "0"
+    return f'W/"{last_message_id or 0}-{revision}-{assignees}"'
 
 @router.get("/customers/{customer_id}/messages", response_model=List[MessageResponse])
 async def get_customer_messages(
     customer_id: int,
+    response: Response,
     current_user: User = Depends(get_staff_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db),
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    if_none_match: Optional[str] = Header(None)
 ):
-    """Lấy lịch sử chat với khách hàng"""
+    """
+    Lấy lịch sử chat với khách hàng theo trang, trang mới nhất trước
     
-    # Kiểm tra quyền truy cập
-    has_access = db.query(MessageAssignment).join(Message).filter(
-        Message.customer_id == customer_id,
-        MessageAssignment.assigned_to == current_user.id
-    ).first()
+    Mỗi trang gồm các tin nhắn liền trước **cursor** theo thứ tự thời gian;
+    truyền lại header X-Next-Cursor để tải trang cũ hơn, không có header
+    nghĩa là đã tới tin đầu tiên.
     
-    if not has_access:
+    ETag đổi khi khách hàng có tin nhắn mới, khi được giao thêm nhân viên hoặc
+    khi bất kỳ nhân viên phụ trách nào đổi trạng thái xử lý; gửi lại qua
+    If-None-Match để nhận 304 khi không có gì mới.
+    
+    Không truyền **cursor**: trang mới nhất; frontend tải thêm trang cũ bằng
+    X-Next-Cursor.
+    """
+    
+    if not await _has_customer_access(db, customer_id, current_user.id):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Bạn không có quyền xem tin nhắn của khách hàng này"
         )
     
-    messages = db.query(Message).filter(
-        Message.customer_id == customer_id
-    ).order_by(Message.created_at.asc()).all()
-    
-    return messages
+    # Phiên bản cho ETag, gộp trên mọi dòng hội thoại của khách hàng
+    version = (await db.execute(select(
+        func.max(Conversation.last_message_id).label("last_message_id"),
+        func.max(Conversation.updated_at).label("updated_at"),
+        func.count().label("assignees")
+    ).where(
+        Conversation.customer_id == customer_id
+    ))).one()
+    
+    # Khách chưa có dòng hội thoại (dữ liệu cũ): không có phiên bản để so, luôn trả 200
+    if version.assignees:
+        etag = _history_etag(version.last_message_id, version.updated_at, version.assignees)
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if if_none_match and etag in (tag.strip() for tag in if_none_match.split(",")):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        response.headers.update(headers)
+    
+    query = select(Message).where(Message.customer_id == customer_id)
+    if cursor:
+        created_at, message_id = decode_cursor(cursor)
+        query = query.where(tuple_(Message.created_at, Message.id) < tuple_(created_at, message_id))
+    
+    messages = (await db.scalars(
+        query.order_by(Message.created_at.desc(), Message.id.desc()).limit(limit + 1)
+    )).all()
+    
+    if len(messages) > limit:
+        messages = messages[:limit]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(messages[-1].created_at, messages[-1].id)
+    
+    # Trong trang vẫn trả theo thứ tự thời gian để hiển thị khung chat
+    return messages[::-1]
 
 @router.post("/customers/{customer_id}/messages", response_model=MessageResponse)
 async def send_message_to_customer(
     customer_id: int,
     content: str,
     current_user: User = Depends(get_staff_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Gửi tin nhắn cho khách hàng"""
     
     # Kiểm tra quyền truy cập
-    has_access = db.query(MessageAssignment).join(Message).filter(
-        Message.customer_id == customer_id,
-        MessageAssignment.assigned_to == current_user.id
-    ).first()
+    has_access = await _has_customer_access(db, customer_id, current_user.id)
     
     if not has_access:
         raise HTTPException(
@@ -253,7 +363,7 @@ async def send_message_to_customer(
         )
     
     # Lấy thông tin customer để biết platform
-    customer = db.query(Customer).filter(Customer.id == customer_id).first()
+    customer = await db.get(Customer, customer_id)
     
     if not customer:
         raise HTTPException(
@@ -263,32 +373,28 @@ async def send_message_to_customer(
     
     # Tạo tin nhắn mới (luôn lưu trong hệ thống)
     platform = customer.platform or "web"
+    # Khách Telegram: gửi ra Telegram Bot qua outbox, kết quả ghi lại vào delivery_status
+    deliver_to_telegram = platform == "telegram" and customer.telegram_id and telegram_outbox.running
     new_message = Message(
         customer_id=customer_id,
         content=content,
         platform=platform,
         direction="outgoing",
-        status="completed"
+        status="completed",
+        # Tin được process này nhận ngay để không process nào khác gửi trùng
+        **(telegram_outbox.claim_values() if deliver_to_telegram else {})
     )
     
     db.add(new_message)
-    db.commit()
-    db.refresh(new_message)
+    await db.flush()
+    await db.run_sync(record_outgoing, new_message, current_user.id)
+    await db.commit()
+    await db.refresh(new_message)
 
-    # Nếu là khách Telegram thì gửi ra Telegram Bot
-    if platform == "telegram" and customer.telegram_id and TELEGRAM_BOT_TOKEN:
-        try:
-            async with httpx.AsyncClient(timeout=10) as client:
-                await client.post(
-                    f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage",
-                    json={
-                        "chat_id": customer.telegram_id,
-                        "text": content
-                    }
-                )
-        except Exception:
-            # Không chặn lỗi gửi Telegram, chỉ log ở server (FastAPI log)
-            pass
+    if deliver_to_telegram and not telegram_outbox.enqueue(new_message.id, customer.telegram_id, content):
+        # Outbox vừa dừng: trả tin về "queued" cho lần khởi động sau
+        await telegram_outbox.release([new_message.id])
+        await db.refresh(new_message)
     
     return new_message
 
@@ -296,15 +402,12 @@ async def send_message_to_customer(
 async def get_customer_info(
     customer_id: int,
     current_user: User = Depends(get_staff_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Xem thông tin khách hàng"""
     
     # Kiểm tra staff có được giao tin nhắn của customer này không
-    has_access = db.query(MessageAssignment).join(Message).filter(
-        Message.customer_id == customer_id,
-        MessageAssignment.assigned_to == current_user.id
-    ).first()
+    has_access = await _has_customer_access(db, customer_id, current_user.id)
     
     if not has_access:
         raise HTTPException(
@@ -312,7 +415,7 @@ async def get_customer_info(
             detail="Bạn không có quyền xem thông tin khách hàng này"
         )
     
-    customer = db.query(Customer).filter(Customer.id == customer_id).first()
+    customer = await db.get(Customer, customer_id)
     
     if not customer:
         raise HTTPException(
@@ -326,17 +429,17 @@ async def get_customer_info(
 @router.get("/requests", response_model=List[RequestResponse])
 async def get_my_requests(
     current_user: User = Depends(get_staff_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     status_filter: Optional[str] = None
 ):
     """Lấy danh sách yêu cầu của mình"""
     
-    query = db.query(Request).filter(Request.user_id == current_user.id)
+    query = select(Request).where(Request.user_id == current_user.id)
     
     if status_filter:
-        query = query.filter(Request.status == status_filter)
+        query = query.where(Request.status == status_filter)
     
-    requests = query.order_by(Request.created_at.desc()).all()
+    requests = (await db.scalars(query.order_by(Request.created_at.desc()))).all()
     
     return requests
 
@@ -344,7 +447,7 @@ async def get_my_requests(
 async def create_request(
     request_data: RequestCreate,
     current_user: User = Depends(get_staff_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Tạo yêu cầu nội bộ mới (nghỉ phép, tăng lương, v.v.)"""
     
@@ -356,16 +459,16 @@ async def create_request(
     )
     
     db.add(new_request)
-    db.commit()
-    db.refresh(new_request)
+    await db.commit()
+    await db.refresh(new_request)
     
     # Tạo thông báo cho manager
     if current_user.department_id:
-        managers = db.query(User).filter(
+        managers = (await db.scalars(select(User).where(
             User.department_id == current_user.department_id,
             User.role == "manager",
             User.is_active == True
-        ).all()
+        ))).all()
         
         for manager in managers:
             notification = Notification(
@@ -377,7 +480,7 @@ async def create_request(
             )
             db.add(notification)
         
-        db.commit()
+        await db.commit()
     
     return new_request
 
@@ -385,14 +488,14 @@ async def create_request(
 async def get_request_detail(
     request_id: int,
     current_user: User = Depends(get_staff_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Xem chi tiết yêu cầu"""
     
-    request = db.query(Request).filter(
+    request = (await db.scalars(select(Request).where(
         Request.id == request_id,
         Request.user_id == current_user.id
-    ).first()
+    ))).first()
     
     if not request:
         raise HTTPException(
@@ -406,34 +509,46 @@ async def get_request_detail(
 @router.get("/profile", response_model=dict)
 async def get_my_profile(
     current_user: User = Depends(get_staff_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Xem thông tin cá nhân và hiệu suất"""
     
     # Thông tin cơ bản
+    department_name = None
+    if current_user.department_id:
+        department_name = await db.scalar(
+            select(Department.name).where(Department.id == current_user.department_id)
+        )
+    
     profile = {
         "id": current_user.id,
         "email": current_user.email,
         "full_name": current_user.full_name,
         "phone": current_user.phone,
         "role": current_user.role,
-        "department_name": current_user.department.name if current_user.department else None
+        "department_name": department_name
     }
     
     # Thống kê hiệu suất
-    total_messages = db.query(MessageAssignment).filter(
-        MessageAssignment.assigned_to == current_user.id
-    ).count()
+    total_messages = await db.scalar(
+        select(func.count()).select_from(MessageAssignment).where(
+            MessageAssignment.assigned_to == current_user.id
+        )
+    )
     
-    completed_messages = db.query(MessageAssignment).join(Message).filter(
-        MessageAssignment.assigned_to == current_user.id,
-        Message.status == "completed"
-    ).count()
+    completed_messages = await db.scalar(
+        select(func.count()).select_from(MessageAssignment).join(Message).where(
+            MessageAssignment.assigned_to == current_user.id,
+            Message.status == "completed"
+        )
+    )
     
-    pending_messages = db.query(MessageAssignment).join(Message).filter(
-        MessageAssignment.assigned_to == current_user.id,
-        Message.status.in_(["pending", "assigned", "in_progress"])
-    ).count()
+    pending_messages = await db.scalar(
+        select(func.count()).select_from(MessageAssignment).join(Message).where(
+            MessageAssignment.assigned_to == current_user.id,
+            Message.status.in_(["pending", "assigned", "in_progress"])
+        )
+    )
     
     profile["performance"] = {
         "total_messages": total_messages,
@@ -448,19 +563,21 @@ async def get_my_profile(
 @router.get("/notifications", response_model=List[NotificationResponse])
 async def get_my_notifications(
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     unread_only: bool = False,
     skip: int = 0,
     limit: int = 20
 ):
     """Lấy danh sách thông báo"""
     
-    query = db.query(Notification).filter(Notification.user_id == current_user.id)
+    query = select(Notification).where(Notification.user_id == current_user.id)
     
     if unread_only:
-        query = query.filter(Notification.is_read == False)
+        query = query.where(Notification.is_read == False)
     
-    notifications = query.order_by(Notification.created_at.desc()).offset(skip).limit(limit).all()
+    notifications = (await db.scalars(
+        query.order_by(Notification.created_at.desc()).offset(skip).limit(limit)
+    )).all()
     
     return notifications
 
@@ -468,14 +585,14 @@ async def get_my_notifications(
 async def mark_notification_read(
     notification_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Đánh dấu thông báo đã đọc"""
     
-    notification = db.query(Notification).filter(
+    notification = (await db.scalars(select(Notification).where(
         Notification.id == notification_id,
         Notification.user_id == current_user.id
-    ).first()
+    ))).first()
     
     if not notification:
         raise HTTPException(
@@ -484,6 +601,38 @@ async def mark_notification_read(
         )
     
     notification.is_read = True
-    db.commit()
+    await db.commit()
     
     return {"message": "Đã đánh dấu thông báo đã đọc"}
+
+# ============= Realtime =============
+@router.websocket("/ws")
+async def realtime_updates(
+    websocket: WebSocket,
+    token: Optional[str] = None
+):
+    """
+    Kênh WebSocket đẩy sự kiện cho staff: assignment, message, notification
+    
+    Trình duyệt không gửi được header Authorization khi mở WebSocket nên
+    access token được truyền qua query **token**. Server gửi {"type": "ping"}
+    khi kết nối im lặng; client cần gửi lại một frame bất kỳ (ví dụ
+    {"type": "pong"}) để không bị đóng.
+    """
+    
+    user = None
+    if token:
+        try:
+            token_data = decode_access_token(token)
+        except HTTPException:
+            token_data = None
+        if token_data:
+            # Phiên DB chỉ dùng để xác thực, không giữ connection suốt kết nối
+            async with AsyncSessionLocal() as db:
+                user = (await db.scalars(select(User).where(User.email == token_data.email))).first()
+    
+    if not user or not user.is_active or user.role != "staff":
+        await websocket.close(code=CLOSE_POLICY_VIOLATION)
+        return
+    
+    await realtime_hub.serve(websocket, user.id)
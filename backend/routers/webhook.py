@@ -1,12 +1,17 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Request as FastAPIRequest
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from typing import Dict, Any
+from starlette.concurrency import run_in_threadpool
+from typing import Any, List, Optional
 import logging
 import os
 
-from database import get_db
-from models import Customer, Message, Notification, User
-from keyword_analyzer import KeywordAnalyzer
+from database import get_async_db
+from dead_letters import record_dead_letter
+from ingestion import InboundEvent, commit_ingestion, ingest_message, process_inbound_batch, process_inbound_event
+from ingestion_queue import ingestion_queue
+from models import Customer, User
+from recent_ids import recent_ids
 from schemas import ZaloWebhookMessage
 
 router = APIRouter(prefix="/api/webhook", tags=["Webhooks"])
@@ -15,10 +20,81 @@ logger = logging.getLogger(__name__)
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 
+async def defer_failed_events(
+    platform: str,
+    raw_payload: Any,
+    events: Optional[List[InboundEvent]],
+    error: str
+) -> str:
+    """
+    Lưu sự kiện không xử lý được vào dead-letter và trả 200 cho nền tảng.
+
+    Trả 500 khiến nền tảng gửi lại dồn dập đúng lúc DB đang gặp sự cố;
+    scheduler dead-letter sẽ thử lại với backoff. Chỉ khi không lưu được
+    dead letter mới trả 503 để nền tảng tự gửi lại.
+    """
+    try:
+        await run_in_threadpool(record_dead_letter, platform, raw_payload, events, error)
+    except Exception:
+        logger.exception(f"Could not store {platform} webhook in dead-letter queue")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Webhook could not be processed"
+        )
+    return "deferred"
+
+async def dispatch_events(db: AsyncSession, events: List[InboundEvent]) -> str:
+    """
+    Xử lý các sự kiện đã parse từ webhook.
+
+    Khi hàng đợi ingestion đang chạy, sự kiện chỉ được đưa vào hàng đợi và
+    webhook trả về ngay; sự kiện nào gặp lane đầy được chuyển vào dead-letter
+    để thử lại sau.
+
+    Sự kiện có external_id vừa nhận gần đây (webhook gửi lại) bị loại bằng
+    bộ lọc trong bộ nhớ trước khi chạm DB.
+
+    Luồng lưu + giao việc là code ORM đồng bộ, chạy qua run_sync trên kết nối
+    async nên không chặn event loop khi chờ DB. Cache từ khóa / lịch trực
+    không chờ lock khi được gọi từ đây (xem get_keyword_snapshot).
+    """
+    if not events:
+        # Sự kiện không phải tin nhắn văn bản: trả như trước khi có bộ lọc trùng
+        return "success"
+
+    fresh = [event for event in events if recent_ids.claim(event.dedup_key)]
+    if not fresh:
+        return "duplicate"
+
+    if ingestion_queue.running:
+        # Lane của người gửi đầy thì chỉ sự kiện đó bị chuyển sang dead-letter,
+        # sự kiện của người gửi khác vẫn vào lane của mình
+        rejected = [event for event in fresh if not ingestion_queue.submit(event)]
+        if rejected:
+            for event in rejected:
+                recent_ids.release(event.dedup_key)
+            return await defer_failed_events(
+                rejected[0].platform, None, rejected, "Ingestion lane is full"
+            )
+        return "queued"
+
+    try:
+        if len(fresh) > 1:
+            await db.run_sync(process_inbound_batch, fresh)
+        else:
+            await db.run_sync(process_inbound_event, fresh[0])
+    except Exception:
+        for event in fresh:
+            recent_ids.release(event.dedup_key)
+        raise
+    for event in fresh:
+        recent_ids.confirm(event.dedup_key)
+    return "success"
+
 @router.post("/zalo")
 async def zalo_webhook(
     request: FastAPIRequest,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Webhook nhận tin nhắn từ Zalo OA
@@ -29,6 +105,8 @@ async def zalo_webhook(
     - Rate limiting
     """
     
+    data = None
+    events = None
     try:
         data = await request.json()
         logger.info(f"Received Zalo webhook: {data}")
@@ -36,70 +114,31 @@ async def zalo_webhook(
         # Mock processing - trong thực tế cần parse theo Zalo API format
         event_name = data.get("event_name", "")
         
+        events = []
         if event_name == "user_send_text":
             # Xử lý tin nhắn text từ user
-            user_id = data.get("sender", {}).get("id")
-            message_text = data.get("message", {}).get("text", "")
-            message_id = data.get("message_id")
-            
-            # Tìm hoặc tạo customer
-            customer = db.query(Customer).filter(Customer.zalo_id == user_id).first()
-            if not customer:
-                customer = Customer(
-                    zalo_id=user_id,
-                    platform="zalo",
-                    name=f"Khách hàng Zalo {user_id}"
-                )
-                db.add(customer)
-                db.commit()
-                db.refresh(customer)
-            
-            # Tạo message
-            new_message = Message(
-                customer_id=customer.id,
-                content=message_text,
+            events.append(InboundEvent(
                 platform="zalo",
-                external_id=message_id,
-                direction="incoming",
-                status="pending"
-            )
-            db.add(new_message)
-            db.commit()
-            db.refresh(new_message)
-            
-            # Tự động giao việc
-            analyzer = KeywordAnalyzer(db)
-            assignment = analyzer.auto_assign_message(new_message)
-            
-            if assignment:
-                # Tạo thông báo cho staff được giao
-                notification = Notification(
-                    user_id=assignment.assigned_to,
-                    title="Tin nhắn mới được giao",
-                    message=f"Bạn có tin nhắn mới từ {customer.name}: {message_text[:50]}...",
-                    type="message",
-                    link=f"/staff/messages/{new_message.id}"
-                )
-                db.add(notification)
-                db.commit()
-                
-                logger.info(f"Message {new_message.id} auto-assigned to user {assignment.assigned_to}")
-            else:
-                logger.warning(f"Could not auto-assign message {new_message.id}")
+                sender_id=data.get("sender", {}).get("id"),
+                text=data.get("message", {}).get("text", ""),
+                external_id=data.get("message_id")
+            ))
+        
+        result = await dispatch_events(db, events)
         
-        return {"status": "success", "message": "Webhook processed"}
+        return {"status": result, "message": "Webhook processed"}
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error processing Zalo webhook: {str(e)}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error processing webhook: {str(e)}"
-        )
+        result = await defer_failed_events("zalo", data, events, f"{type(e).__name__}: {e}")
+        return {"status": result, "message": "Webhook deferred"}
 
 @router.post("/meta")
 async def meta_webhook(
     request: FastAPIRequest,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Webhook nhận tin nhắn từ Meta (Facebook/Instagram)
@@ -110,70 +149,40 @@ async def meta_webhook(
     - Parse Meta webhook format
     """
     
+    data = None
+    events = None
     try:
         data = await request.json()
         logger.info(f"Received Meta webhook: {data}")
         
         # Mock processing
+        events = []
         if data.get("object") == "page":
             for entry in data.get("entry", []):
                 for messaging in entry.get("messaging", []):
-                    sender_id = messaging.get("sender", {}).get("id")
                     message_data = messaging.get("message", {})
                     message_text = message_data.get("text", "")
-                    message_id = message_data.get("mid")
                     
                     if not message_text:
                         continue
                     
-                    # Tìm hoặc tạo customer
-                    customer = db.query(Customer).filter(Customer.meta_id == sender_id).first()
-                    if not customer:
-                        customer = Customer(
-                            meta_id=sender_id,
-                            platform="facebook",
-                            name=f"Khách hàng Facebook {sender_id}"
-                        )
-                        db.add(customer)
-                        db.commit()
-                        db.refresh(customer)
-                    
-                    # Tạo message
-                    new_message = Message(
-                        customer_id=customer.id,
-                        content=message_text,
+                    events.append(InboundEvent(
                         platform="facebook",
-                        external_id=message_id,
-                        direction="incoming",
-                        status="pending"
-                    )
-                    db.add(new_message)
-                    db.commit()
-                    db.refresh(new_message)
-                    
-                    # Tự động giao việc
-                    analyzer = KeywordAnalyzer(db)
-                    assignment = analyzer.auto_assign_message(new_message)
-                    
-                    if assignment:
-                        notification = Notification(
-                            user_id=assignment.assigned_to,
-                            title="Tin nhắn mới được giao",
-                            message=f"Bạn có tin nhắn mới từ {customer.name}: {message_text[:50]}...",
-                            type="message",
-                            link=f"/staff/messages/{new_message.id}"
-                        )
-                        db.add(notification)
-                        db.commit()
+                        sender_id=messaging.get("sender", {}).get("id"),
+                        text=message_text,
+                        external_id=message_data.get("mid")
+                    ))
+        
+        result = await dispatch_events(db, events)
         
-        return {"status": "success"}
+        return {"status": result}
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error processing Meta webhook: {str(e)}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error processing webhook: {str(e)}"
-        )
+        result = await defer_failed_events("facebook", data, events, f"{type(e).__name__}: {e}")
+        return {"status": result}
 
 @router.get("/meta")
 async def meta_webhook_verification(
@@ -192,14 +201,11 @@ async def meta_webhook_verification(
     raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Verification failed")
 
 # Endpoint để test tạo tin nhắn thủ công (for demo)
-@router.post("/test/create-message")
-async def create_test_message(
+def _create_test_message(
+    db: Session,
     content: str,
-    platform: str = "zalo",
-    db: Session = Depends(get_db)
-):
-    """Tạo tin nhắn test để demo auto-assignment"""
-    
+    platform: str
+) -> dict:
     # Tạo customer test
     customer = Customer(
         name=f"Khách hàng test",
@@ -207,57 +213,48 @@ async def create_test_message(
         phone="0900000000"
     )
     db.add(customer)
-    db.commit()
-    db.refresh(customer)
-    
-    # Tạo message
-    new_message = Message(
-        customer_id=customer.id,
-        content=content,
-        platform=platform,
-        direction="incoming",
-        status="pending"
-    )
-    db.add(new_message)
-    db.commit()
-    db.refresh(new_message)
+    db.flush()
     
-    # Tự động giao việc
-    analyzer = KeywordAnalyzer(db)
-    assignment = analyzer.auto_assign_message(new_message)
-    
-    if assignment:
-        # Tạo thông báo
-        notification = Notification(
-            user_id=assignment.assigned_to,
-            title="Tin nhắn mới được giao",
-            message=f"Bạn có tin nhắn mới: {content[:50]}...",
-            type="message",
-            link=f"/staff/messages/{new_message.id}"
-        )
-        db.add(notification)
-        db.commit()
-        
-        assigned_user = db.query(User).filter(User.id == assignment.assigned_to).first()
-        
-        return {
-            "message_id": new_message.id,
-            "assigned_to": assigned_user.full_name if assigned_user else None,
-            "match_score": float(assignment.match_score),
-            "notes": assignment.notes
-        }
-    else:
+    # Tạo message, tự động giao việc và thông báo trong cùng một transaction
+    new_message, assignment = ingest_message(db, customer, content, platform)
+    if not assignment:
+        commit_ingestion(db, new_message, assignment)
         return {
             "message_id": new_message.id,
             "assigned_to": None,
             "message": "Không tìm thấy nhân viên phù hợp"
         }
+    
+    # Đọc kết quả trước khi commit để không phải nạp lại object bị expire
+    assigned_user = db.get(User, assignment.assigned_to)
+    result = {
+        "message_id": new_message.id,
+        "assigned_to": assigned_user.full_name if assigned_user else None,
+        "match_score": float(assignment.match_score) if assignment.match_score is not None else None,
+        "notes": assignment.notes
+    }
+    commit_ingestion(db, new_message, assignment)
+    return result
+
+@router.post("/test/create-message")
+async def create_test_message(
+    content: str,
+    platform: str = "zalo",
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Tạo tin nhắn test để demo auto-assignment"""
+    
+    try:
+        return await db.run_sync(_create_test_message, content, platform)
+    except Exception:
+        await db.rollback()
+        raise
 
 
 @router.post("/telegram")
 async def telegram_webhook(
     request: FastAPIRequest,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Webhook nhận tin nhắn từ Telegram Bot.
@@ -266,6 +263,8 @@ async def telegram_webhook(
     /api/webhook/telegram
     """
 
+    data = None
+    events = None
     try:
         data = await request.json()
         logger.info(f"Received Telegram webhook: {data}")
@@ -283,51 +282,24 @@ async def telegram_webhook(
         if not chat_id or not text:
             return {"status": "ignored"}
 
-        # Tìm hoặc tạo customer theo telegram_id
-        customer = db.query(Customer).filter(Customer.telegram_id == str(chat_id)).first()
-        if not customer:
-            customer = Customer(
-                telegram_id=str(chat_id),
-                platform="telegram",
-                name=f"Khách hàng Telegram {chat_id}"
-            )
-            db.add(customer)
-            db.commit()
-            db.refresh(customer)
+        # message_id chỉ duy nhất trong một chat; mỗi lần sửa tin là một bản mới
+        external_id = f"{chat_id}:{message_id}"
+        if message_data.get("edit_date"):
+            external_id = f"{external_id}:{message_data['edit_date']}"
 
-        # Lưu tin nhắn vào hệ thống
-        new_message = Message(
-            customer_id=customer.id,
-            content=text,
+        events = [InboundEvent(
             platform="telegram",
-            external_id=str(message_id),
-            direction="incoming",
-            status="pending"
-        )
-        db.add(new_message)
-        db.commit()
-        db.refresh(new_message)
+            sender_id=str(chat_id),
+            text=text,
+            external_id=external_id
+        )]
+        result = await dispatch_events(db, events)
 
-        # Tự động giao việc cho nhân viên
-        analyzer = KeywordAnalyzer(db)
-        assignment = analyzer.auto_assign_message(new_message)
-
-        if assignment:
-            notification = Notification(
-                user_id=assignment.assigned_to,
-                title="Tin nhắn mới từ Telegram",
-                message=f"Bạn có tin nhắn mới từ {customer.name}: {text[:50]}...",
-                type="message",
-                link=f"/staff/messages/{new_message.id}"
-            )
-            db.add(notification)
-            db.commit()
-
-        return {"status": "success"}
+        return {"status": result}
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error processing Telegram webhook: {str(e)}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error processing Telegram webhook: {str(e)}"
-        )
+        result = await defer_failed_events("telegram", data, events, f"{type(e).__name__}: {e}")
+        return {"status": result}
@@ -201,6 +201,8 @@ class MessageUpdate(BaseModel):
 class MessageResponse(MessageBase):
     id: int
     external_id: Optional[str] = None
+    delivery_status: Optional[str] = None
+    delivered_at: Optional[datetime] = None
     created_at: datetime
     
     class Config:
@@ -317,6 +319,25 @@ class DashboardStatistics(BaseModel):
     pending_requests: int
 
 # ============= Webhook Schemas =============
+class DeadLetterResponse(BaseModel):
+    id: int
+    platform: str
+    raw_payload: Optional[str] = None
+    events: Optional[str] = None
+    error: Optional[str] = None
+    attempts: int
+    status: str
+    next_attempt_at: Optional[datetime] = None
+    resolved_at: Optional[datetime] = None
+    created_at: datetime
+    
+    class Config:
+        from_attributes = True
+
+class DeadLetterReplay(BaseModel):
+    ids: Optional[List[int]] = None
+    status: str = "dead"
+
 class ZaloWebhookMessage(BaseModel):
     event_name: str
     message_id: str
@@ -0,0 +1,212 @@
+from bisect import bisect_right
+from dataclasses import dataclass
+from datetime import date as dt_date, time as dt_time, timedelta
+from typing import Dict, FrozenSet, List, Optional, Tuple
+import os
+import threading
+import time
+
+from sqlalchemy.orm import Session
+
+from cache_version import ROSTER_CACHE, get_cache_version, get_local_bump_count
+from models import Shift, User, UserShift
+
+# Khoảng thời gian tối thiểu (giây) giữa hai lần kiểm tra version lịch trực trong DB
+ROSTER_CACHE_CHECK_SECONDS = float(os.getenv("ROSTER_CACHE_CHECK_SECONDS", "5"))
+
+# Trạng thái ca làm việc của nhân viên tại một thời điểm
+ON_SHIFT = "on_shift"
+SCHEDULED = "scheduled"
+
+_DAY_US = 24 * 3600 * 1_000_000
+
+
+def _to_us(value: dt_time) -> int:
+    """Đổi giờ trong ngày ra micro giây kể từ 00:00"""
+    return ((value.hour * 60 + value.minute) * 60 + value.second) * 1_000_000 + value.microsecond
+
+
+@dataclass(frozen=True)
+class DepartmentRoster:
+    """
+    Lịch trực trong ngày của một phòng ban dưới dạng các đoạn thời gian liên tiếp.
+
+    on_shift[i] là tập nhân viên đang trong ca trong khoảng
+    [boundaries[i], boundaries[i + 1]).
+    """
+    boundaries: Tuple[int, ...]
+    on_shift: Tuple[FrozenSet[int], ...]
+
+    def on_shift_at(self, current_us: int) -> FrozenSet[int]:
+        index = bisect_right(self.boundaries, current_us) - 1
+        if index < 0:
+            return frozenset()
+        return self.on_shift[index]
+
+
+def _build_department_roster(intervals: List[Tuple[int, int, int]]) -> DepartmentRoster:
+    """Quét các khoảng [start, end) của từng nhân viên thành các đoạn không chồng nhau"""
+    changes: Dict[int, List[Tuple[int, int]]] = {}
+    for start, end, user_id in intervals:
+        changes.setdefault(start, []).append((user_id, 1))
+        changes.setdefault(end, []).append((user_id, -1))
+
+    boundaries: List[int] = [0]
+    segments: List[FrozenSet[int]] = [frozenset()]
+    active: Dict[int, int] = {}
+    for point in sorted(changes):
+        for user_id, delta in changes[point]:
+            count = active.get(user_id, 0) + delta
+            if count:
+                active[user_id] = count
+            else:
+                active.pop(user_id, None)
+        members = frozenset(active)
+        if point == boundaries[-1]:
+            segments[-1] = members
+        else:
+            boundaries.append(point)
+            segments.append(members)
+    return DepartmentRoster(boundaries=tuple(boundaries), on_shift=tuple(segments))
+
+
+@dataclass(frozen=True)
+class RosterIndex:
+    """Chỉ mục "ai đang trực" cho một ngày, tra cứu O(log n) không cần DB"""
+    version: int
+    day: dt_date
+    departments: Dict[Optional[int], DepartmentRoster]
+    # Nhân viên có ca "scheduled" trong ngày (kể cả chưa tới giờ hoặc đã hết ca)
+    scheduled_today: FrozenSet[int]
+
+    def on_shift(self, department_id: Optional[int], current_time: dt_time) -> FrozenSet[int]:
+        roster = self.departments.get(department_id)
+        if roster is None:
+            return frozenset()
+        return roster.on_shift_at(_to_us(current_time))
+
+    def shift_status(self, user: User, current_time: dt_time) -> Optional[str]:
+        """ON_SHIFT, SCHEDULED hoặc None nếu hôm nay nhân viên không có ca"""
+        if user.id in self.on_shift(user.department_id, current_time):
+            return ON_SHIFT
+        if user.id in self.scheduled_today:
+            return SCHEDULED
+        return None
+
+
+def build_roster(db: Session, day: dt_date, version: int = 0) -> RosterIndex:
+    """
+    Đọc ca "scheduled" của hôm nay và hôm qua rồi dựng chỉ mục.
+
+    Ca qua đêm (start_time > end_time) được tách thành [start, 24:00) của ngày
+    được phân công và [00:00, end] của ngày hôm sau.
+    """
+    rows = db.query(
+        UserShift.user_id,
+        UserShift.date,
+        User.department_id,
+        Shift.start_time,
+        Shift.end_time
+    ).join(
+        Shift, UserShift.shift_id == Shift.id
+    ).join(
+        User, UserShift.user_id == User.id
+    ).filter(
+        UserShift.date.in_([day, day - timedelta(days=1)]),
+        UserShift.status == "scheduled"
+    ).all()
+
+    intervals: Dict[Optional[int], List[Tuple[int, int, int]]] = {}
+    scheduled_today = set()
+    for user_id, shift_date, department_id, start_time, end_time in rows:
+        start_us = _to_us(start_time)
+        # end_time tính cả giây cuối cùng như phép so sánh <= trước đây
+        end_us = _to_us(end_time) + 1
+        overnight = start_time > end_time
+
+        if shift_date == day:
+            scheduled_today.add(user_id)
+            interval = (start_us, _DAY_US if overnight else end_us)
+        elif overnight:
+            # Phần sau nửa đêm của ca bắt đầu từ hôm qua
+            interval = (0, end_us)
+        else:
+            continue
+        intervals.setdefault(department_id, []).append(interval + (user_id,))
+
+    departments = {
+        department_id: _build_department_roster(department_intervals)
+        for department_id, department_intervals in intervals.items()
+    }
+    return RosterIndex(
+        version=version,
+        day=day,
+        departments=departments,
+        scheduled_today=frozenset(scheduled_today)
+    )
+
+
+_roster: Optional[RosterIndex] = None
+_checked_at: float = 0.0
+_seen_local_bumps: int = 0
+_lock = threading.Lock()
+
+
+def get_roster(db: Session, day: Optional[dt_date] = None) -> RosterIndex:
+    """
+    Lấy chỉ mục lịch trực của process cho ngày `day` (mặc định hôm nay).
+
+    Dựng lại khi sang ngày mới hoặc khi version "roster" trong DB thay đổi
+    (kiểm tra tối đa một lần mỗi ROSTER_CACHE_CHECK_SECONDS). Chỉ chỉ mục của
+    hôm nay được giữ lại; ngày khác được dựng riêng mỗi lần gọi để không thay
+    thế chỉ mục dùng chung của các request khác.
+
+    Như get_keyword_snapshot, không chờ lock (hàm chạy được trên thread event
+    loop): khi request khác đang dựng lại, dùng chỉ mục hiện có nếu đúng ngày,
+    nếu không thì dựng một chỉ mục riêng không lưu lại.
+    """
+    global _roster, _checked_at, _seen_local_bumps
+
+    today = dt_date.today()
+    if day is None:
+        day = today
+    elif day != today:
+        return build_roster(db, day, get_cache_version(db, ROSTER_CACHE))
+
+    local_bumps = get_local_bump_count(ROSTER_CACHE)
+    roster = _roster
+    if (
+        roster is not None
+        and roster.day == day
+        and local_bumps == _seen_local_bumps
+        and time.monotonic() - _checked_at < ROSTER_CACHE_CHECK_SECONDS
+    ):
+        return roster
+
+    if not _lock.acquire(blocking=False):
+        if roster is not None and roster.day == day:
+            return roster
+        return build_roster(db, day, get_cache_version(db, ROSTER_CACHE))
+    try:
+        if (
+            _roster is not None
+            and _roster.day == day
+            and local_bumps == _seen_local_bumps
+            and time.monotonic() - _checked_at < ROSTER_CACHE_CHECK_SECONDS
+        ):
+            return _roster
+
+        version = get_cache_version(db, ROSTER_CACHE)
+        if (
+            _roster is None
+            or _roster.day != day
+            or _roster.version != version
+            or local_bumps != _seen_local_bumps
+        ):
+            _roster = build_roster(db, day, version)
+
+        _checked_at = time.monotonic()
+        _seen_local_bumps = local_bumps
+        return _roster
+    finally:
+        _lock.release()
@@ -0,0 +1,239 @@
+"""
+Kiểm tra lịch sử chat phân trang và ETag / 304 của
+GET /api/staff/customers/{id}/messages.
+
+Các trường hợp kiểm tra:
+1. Phân trang: đi theo X-Next-Cursor lấy đủ mọi tin, đúng thứ tự, không trùng
+2. If-None-Match khớp (kể cả trong danh sách nhiều ETag): 304, không có body
+3. Quyền truy cập: nhân viên chưa được giao tin nào của khách nhận 403 ở cả
+   lịch sử chat, gửi tin và thông tin khách hàng
+4. Tin nhắn mới được giao cho nhân viên khác: ETag đổi, nhân viên đó xem được
+   và nhận cùng ETag (ETag theo khách hàng, không theo người xem)
+5. Nhân viên khác hoàn thành tin (không có tin mới): ETag đổi
+6. Nhân viên gửi trả lời: ETag đổi, tin trả lời nằm cuối trang mới nhất
+
+Mặc định dùng SQLite trong thư mục tạm. Script xóa và tạo lại toàn bộ bảng,
+chỉ trỏ VERIFY_DATABASE_URL tới một database dành riêng cho việc kiểm tra:
+    python verify_chat_history.py
+"""
+from datetime import datetime, timedelta
+import os
+import sys
+import tempfile
+import time
+
+_tmpdir = tempfile.mkdtemp(prefix="verify_chat_history_")
+os.environ["DATABASE_URL"] = os.getenv("VERIFY_DATABASE_URL", f"sqlite:///{_tmpdir}/chat_history.db")
+os.environ["WEBHOOK_INGESTION_MODE"] = "sync"
+
+from fastapi.testclient import TestClient
+
+from auth import create_access_token
+from database import Base, SessionLocal, engine
+from main import app
+from models import CacheVersion, Customer, Department, Keyword, Message, User
+from pagination import NEXT_CURSOR_HEADER
+
+HISTORY_MESSAGES = 5
+PAGE_SIZE = 2
+# updated_at do DB sinh; SQLite chỉ lưu tới giây nên chờ qua giây kế tiếp
+# trước mỗi thay đổi cần làm đổi ETag
+TIMESTAMP_RESOLUTION_SECONDS = 1.1
+
+
+def seed() -> dict:
+    """Trả về {tên: header Authorization} của nhân viên a, b (phòng khác) và c (không được giao gì)"""
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    db = SessionLocal()
+    db.add_all([CacheVersion(name="keywords", version=0), CacheVersion(name="roster", version=0)])
+    sales, support = Department(name="Kinh doanh"), Department(name="Bảo hành")
+    db.add_all([sales, support])
+    db.flush()
+    db.add_all([
+        Keyword(keyword="hoi gia", department_id=sales.id, priority=3),
+        Keyword(keyword="bao hanh", department_id=support.id, priority=3),
+    ])
+    headers = {}
+    for name, department in [("a", sales), ("b", support), ("c", sales)]:
+        email = f"verify.history.{name}@example.com"
+        db.add(User(
+            email=email,
+            password_hash="verify",
+            full_name=f"Verify History {name}",
+            role="staff",
+            department_id=department.id
+        ))
+        headers[name] = {"Authorization": f"Bearer {create_access_token({'sub': email, 'role': 'staff'})}"}
+    db.commit()
+    db.close()
+    return headers
+
+
+def incoming(client: TestClient, mid: str, text: str) -> None:
+    client.post("/api/webhook/meta", json={"object": "page", "entry": [{"messaging": [
+        {"sender": {"id": "fb-history"}, "message": {"text": text, "mid": mid}}
+    ]}]})
+
+
+def history(client: TestClient, customer_id: int, headers: dict, etag: str = None, cursor: str = None):
+    params = {"limit": PAGE_SIZE}
+    if cursor:
+        params["cursor"] = cursor
+    request_headers = dict(headers)
+    if etag:
+        request_headers["If-None-Match"] = etag
+    return client.get(f"/api/staff/customers/{customer_id}/messages", params=params, headers=request_headers)
+
+
+def spread_created_at(customer_id: int) -> None:
+    """
+    Giãn created_at của các tin đã lưu ra từng phút trong quá khứ.
+
+    SQLite lưu CURRENT_TIMESTAMP dạng chuỗi tới giây, còn cursor được so bằng
+    chuỗi có phần lẻ giây, nên các tin cùng giây không phân trang được trên
+    SQLite (PostgreSQL so bằng kiểu timestamp, không bị ảnh hưởng).
+    """
+    db = SessionLocal()
+    messages = db.query(Message).filter(Message.customer_id == customer_id).order_by(Message.id).all()
+    start = datetime.utcnow() - timedelta(minutes=len(messages) + 1)
+    for index, message in enumerate(messages):
+        message.created_at = start + timedelta(minutes=index)
+    db.commit()
+    db.close()
+
+
+def check_pages(client: TestClient, customer_id: int, headers: dict) -> list:
+    pages, cursor = [], None
+    # Giới hạn số trang để cursor lặp lại không làm script treo
+    while len(pages) <= HISTORY_MESSAGES:
+        response = history(client, customer_id, headers, cursor=cursor)
+        pages.append([message["id"] for message in response.json()])
+        cursor = response.headers.get(NEXT_CURSOR_HEADER)
+        if not cursor:
+            break
+    loaded = [message_id for page in reversed(pages) for message_id in page]
+
+    db = SessionLocal()
+    expected = [message.id for message in db.query(Message).filter(
+        Message.customer_id == customer_id
+    ).order_by(Message.created_at, Message.id)]
+    db.close()
+
+    problems = []
+    if loaded != expected:
+        problems.append(f"pages: loaded {loaded}, expected {expected}")
+    if any(len(page) > PAGE_SIZE for page in pages):
+        problems.append(f"pages: page larger than {PAGE_SIZE}: {pages}")
+    print(f"[1] Phân trang: {pages}")
+    return problems
+
+
+def check_not_modified(client: TestClient, customer_id: int, headers: dict) -> list:
+    first = history(client, customer_id, headers)
+    etag = first.headers.get("etag")
+    if not etag:
+        return [f"not modified: no ETag on {first.status_code}"]
+    same = history(client, customer_id, headers, etag=etag)
+    listed = history(client, customer_id, headers, etag=f'W/"stale", {etag}')
+    stale = history(client, customer_id, headers, etag='W/"stale"')
+
+    problems = []
+    if first.headers.get("cache-control") != "private, no-cache":
+        problems.append(f"not modified: Cache-Control {first.headers.get('cache-control')}")
+    if (same.status_code, listed.status_code, stale.status_code) != (304, 304, 200):
+        problems.append(f"not modified: {same.status_code}, {listed.status_code}, {stale.status_code}")
+    if same.content or same.headers.get("etag") != etag:
+        problems.append("not modified: 304 carries a body or a different ETag")
+    print(f"[2] If-None-Match: khớp {same.status_code}, trong danh sách {listed.status_code}, cũ {stale.status_code}")
+    return problems
+
+
+def check_access(client: TestClient, customer_id: int, headers: dict, label: str) -> list:
+    statuses = [
+        history(client, customer_id, headers).status_code,
+        client.post(
+            f"/api/staff/customers/{customer_id}/messages", params={"content": "xin chao"}, headers=headers
+        ).status_code,
+        client.get(f"/api/staff/customers/{customer_id}", headers=headers).status_code,
+    ]
+    problems = []
+    if statuses != [403, 403, 403]:
+        problems.append(f"access ({label}): history / send / info returned {statuses}, expected 403")
+    print(f"[3] Chưa được giao ({label}): lịch sử / gửi / thông tin -> {statuses}")
+    return problems
+
+
+def check_changes(client: TestClient, customer_id: int, headers: dict) -> list:
+    problems = []
+    etag = history(client, customer_id, headers["a"]).headers["etag"]
+
+    # Tin mới được giao cho b (phòng bảo hành)
+    time.sleep(TIMESTAMP_RESOLUTION_SECONDS)
+    incoming(client, "mid-support", "bao hanh may")
+    after_new = history(client, customer_id, headers["a"], etag=etag)
+    seen_by_b = history(client, customer_id, headers["b"])
+    if after_new.status_code != 200 or after_new.headers["etag"] == etag:
+        problems.append(f"new message: {after_new.status_code}, ETag {etag} -> {after_new.headers.get('etag')}")
+    if seen_by_b.status_code != 200 or seen_by_b.headers.get("etag") != after_new.headers.get("etag"):
+        problems.append(f"new message: staff b got {seen_by_b.status_code}, ETag {seen_by_b.headers.get('etag')}")
+    print(f"[4] Tin mới giao cho b: a nhận {after_new.status_code}, b nhận {seen_by_b.status_code}")
+    etag = after_new.headers["etag"]
+
+    # b hoàn thành tin của mình: trạng thái tin cũ đổi, không có tin mới
+    time.sleep(TIMESTAMP_RESOLUTION_SECONDS)
+    support_message = seen_by_b.json()[-1]["id"]
+    completed = client.put(f"/api/staff/messages/{support_message}/complete", headers=headers["b"]).status_code
+    after_complete = history(client, customer_id, headers["a"], etag=etag)
+    if completed != 200 or after_complete.status_code != 200:
+        problems.append(f"completed by b: complete {completed}, history {after_complete.status_code}")
+    elif after_complete.json()[-1]["status"] != "completed":
+        problems.append("completed by b: history still shows the old status")
+    print(f"[5] b hoàn thành tin: a nhận {after_complete.status_code}")
+    etag = after_complete.headers.get("etag", etag)
+
+    # a trả lời khách
+    time.sleep(TIMESTAMP_RESOLUTION_SECONDS)
+    sent = client.post(
+        f"/api/staff/customers/{customer_id}/messages", params={"content": "cam on"}, headers=headers["a"]
+    ).status_code
+    after_reply = history(client, customer_id, headers["a"], etag=etag)
+    if sent != 200 or after_reply.status_code != 200 or after_reply.json()[-1]["content"] != "cam on":
+        problems.append(f"reply: send {sent}, history {after_reply.status_code}")
+    print(f"[6] a trả lời: a nhận {after_reply.status_code}")
+    return problems
+
+
+def run() -> list:
+    headers = seed()
+    problems = []
+    with TestClient(app) as client:
+        for index in range(HISTORY_MESSAGES):
+            incoming(client, f"mid-{index}", f"hoi gia lan {index}")
+        db = SessionLocal()
+        customer_id = db.query(Customer.id).filter(Customer.meta_id == "fb-history").scalar()
+        db.close()
+        spread_created_at(customer_id)
+
+        problems += check_pages(client, customer_id, headers["a"])
+        problems += check_not_modified(client, customer_id, headers["a"])
+        problems += check_access(client, customer_id, headers["b"], "b")
+        problems += check_access(client, customer_id, headers["c"], "c")
+        problems += check_changes(client, customer_id, headers)
+    return problems
+
+
+def main() -> int:
+    problems = run()
+    if not problems:
+        print("KHỚP")
+        return 0
+
+    for problem in problems[:20]:
+        print(problem, file=sys.stderr)
+    print(f"LỖI: {len(problems)} lỗi", file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
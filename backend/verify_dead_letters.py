@@ -0,0 +1,231 @@
+"""
+Kiểm tra dead-letter cho webhook lỗi và việc thử lại với backoff.
+
+Các trường hợp kiểm tra:
+1. Lưu tin nhắn lỗi: webhook trả "deferred" (200), sự kiện được lưu vào
+   dead-letter "pending"; payload không parse được thành "dead" ngay
+2. Chưa tới hạn: lần quét không đụng tới dead letter
+3. Thử lại vẫn lỗi: số lần thử tăng, lần sau lùi theo backoff lũy thừa, hết
+   DEAD_LETTER_MAX_ATTEMPTS thì "dead"
+4. Thử lại thành công: "resolved", tin nhắn được lưu và giao đúng một lần;
+   chạy lại cùng sự kiện không tạo bản trùng
+
+Mặc định dùng SQLite trong thư mục tạm. Script xóa và tạo lại toàn bộ bảng,
+chỉ trỏ VERIFY_DATABASE_URL tới một database dành riêng cho việc kiểm tra:
+    python verify_dead_letters.py
+"""
+from datetime import datetime, timedelta
+import os
+import sys
+import tempfile
+
+_tmpdir = tempfile.mkdtemp(prefix="verify_dead_letters_")
+os.environ["DATABASE_URL"] = os.getenv("VERIFY_DATABASE_URL", f"sqlite:///{_tmpdir}/dead_letters.db")
+os.environ["WEBHOOK_INGESTION_MODE"] = "sync"
+# Scheduler nền không chạy trong lúc kiểm tra; các lần quét được gọi trực tiếp
+os.environ["DEAD_LETTER_POLL_SECONDS"] = "3600"
+os.environ["DEAD_LETTER_RETRY_BASE_SECONDS"] = "30"
+os.environ["DEAD_LETTER_MAX_ATTEMPTS"] = "3"
+
+from fastapi.testclient import TestClient
+
+import dead_letters
+from database import Base, SessionLocal, engine
+from dead_letters import retry_due_dead_letters
+from main import app
+from models import CacheVersion, Department, Keyword, Message, MessageAssignment, User, WebhookDeadLetter
+from routers import webhook
+
+TELEGRAM = {"message": {"chat": {"id": 601}, "text": "hoi gia lan 1", "message_id": 1}}
+TELEGRAM_GIVE_UP = {"message": {"chat": {"id": 602}, "text": "hoi gia lan 2", "message_id": 1}}
+
+
+class Failing:
+    """Bọc một hàm xử lý, ném lỗi trong khi `failing` còn bật"""
+
+    def __init__(self, function):
+        self.function = function
+        self.failing = True
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        if self.failing:
+            raise RuntimeError("database unavailable")
+        return self.function(*args, **kwargs)
+
+
+def seed() -> None:
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    db = SessionLocal()
+    db.add_all([CacheVersion(name="keywords", version=0), CacheVersion(name="roster", version=0)])
+    sales = Department(name="Kinh doanh")
+    db.add(sales)
+    db.flush()
+    db.add(Keyword(keyword="hoi gia", department_id=sales.id, priority=3))
+    db.add(User(
+        email="verify.deadletter@omnichat.com",
+        password_hash="verify",
+        full_name="Verify Dead Letter",
+        role="staff",
+        department_id=sales.id
+    ))
+    db.commit()
+    db.close()
+
+
+def load_dead_letters() -> dict:
+    db = SessionLocal()
+    try:
+        return {
+            dead_letter.id: dead_letter
+            for dead_letter in db.query(WebhookDeadLetter).order_by(WebhookDeadLetter.id)
+        }
+    finally:
+        db.close()
+
+
+def make_due(dead_letter_id: int) -> None:
+    """Dời next_attempt_at về quá khứ như thể đã hết thời gian chờ"""
+    db = SessionLocal()
+    try:
+        db.get(WebhookDeadLetter, dead_letter_id).next_attempt_at = datetime.utcnow() - timedelta(seconds=1)
+        db.commit()
+    finally:
+        db.close()
+
+
+def stored(external_id: str) -> tuple:
+    db = SessionLocal()
+    try:
+        messages = db.query(Message).filter(Message.external_id == external_id).count()
+        assignments = db.query(MessageAssignment).join(Message).filter(Message.external_id == external_id).count()
+        return messages, assignments
+    finally:
+        db.close()
+
+
+def check_deferred(client: TestClient) -> list:
+    statuses = [
+        client.post("/api/webhook/telegram", json=TELEGRAM).json()["status"],
+        client.post("/api/webhook/telegram", json=TELEGRAM_GIVE_UP).json()["status"],
+    ]
+    unparsable = client.post(
+        "/api/webhook/zalo", content=b"{not json", headers={"Content-Type": "application/json"}
+    ).json()["status"]
+    rows = list(load_dead_letters().values())
+
+    problems = []
+    if statuses + [unparsable] != ["deferred"] * 3:
+        problems.append(f"deferred: statuses {statuses + [unparsable]}")
+    if [row.status for row in rows] != ["pending", "pending", "dead"]:
+        problems.append(f"deferred: dead letters {[row.status for row in rows]}, expected pending, pending, dead")
+    if rows and rows[0].next_attempt_at <= datetime.utcnow():
+        problems.append("deferred: first retry is already due")
+    if stored("601:1") != (0, 0):
+        problems.append(f"deferred: failed event stored {stored('601:1')}")
+    print(f"[1] Webhook lỗi: {statuses + [unparsable]}, dead letter {[row.status for row in rows]}")
+    return problems
+
+
+def check_not_due() -> list:
+    before = {row.id: row.attempts for row in load_dead_letters().values()}
+    resolved = retry_due_dead_letters()
+    after = {row.id: row.attempts for row in load_dead_letters().values()}
+    problems = []
+    if resolved or after != before:
+        problems.append(f"not due: resolved {resolved}, attempts {before} -> {after}")
+    print(f"[2] Chưa tới hạn: {resolved} dòng được xử lý")
+    return problems
+
+
+def check_backoff(dead_letter_id: int) -> list:
+    problems = []
+    delays = []
+    for attempt in range(1, dead_letters.DEAD_LETTER_MAX_ATTEMPTS + 1):
+        make_due(dead_letter_id)
+        retried_at = datetime.utcnow()
+        retry_due_dead_letters()
+        row = load_dead_letters()[dead_letter_id]
+        if row.attempts != attempt:
+            problems.append(f"backoff: attempts {row.attempts} after retry {attempt}")
+        if attempt < dead_letters.DEAD_LETTER_MAX_ATTEMPTS:
+            delays.append(round((row.next_attempt_at - retried_at).total_seconds()))
+            if row.status != "pending":
+                problems.append(f"backoff: status {row.status} after retry {attempt}")
+        elif row.status != "dead":
+            problems.append(f"backoff: status {row.status} after the last attempt, expected dead")
+
+    expected_delays = [
+        dead_letters.DEAD_LETTER_RETRY_BASE_SECONDS * 2 ** (attempt - 1)
+        for attempt in range(1, dead_letters.DEAD_LETTER_MAX_ATTEMPTS)
+    ]
+    if delays != expected_delays:
+        problems.append(f"backoff: delays {delays}, expected {expected_delays}")
+    print(f"[3] Thử lại vẫn lỗi: chờ {delays} giây, rồi {load_dead_letters()[dead_letter_id].status}")
+    return problems
+
+
+def check_resolved(dead_letter_id: int) -> list:
+    make_due(dead_letter_id)
+    resolved = retry_due_dead_letters()
+    row = load_dead_letters()[dead_letter_id]
+    first = stored("601:1")
+
+    # Chạy lại cùng sự kiện (như admin replay một dòng đã lưu được một phần)
+    db = SessionLocal()
+    db.get(WebhookDeadLetter, dead_letter_id).status = "pending"
+    db.commit()
+    db.close()
+    make_due(dead_letter_id)
+    retry_due_dead_letters()
+    again = stored("601:1")
+
+    problems = []
+    if resolved != 1 or row.status != "resolved" or row.resolved_at is None:
+        problems.append(f"resolved: {resolved} resolved, status {row.status}")
+    if first != (1, 1) or again != (1, 1):
+        problems.append(f"resolved: messages / assignments {first}, after replay {again}, expected (1, 1)")
+    print(f"[4] Thử lại thành công: {row.status}, tin nhắn / assignment {first}, chạy lại {again}")
+    return problems
+
+
+def run() -> list:
+    seed()
+    webhook_ingestion = Failing(webhook.process_inbound_event)
+    retry_ingestion = Failing(dead_letters.process_inbound_batch)
+    webhook.process_inbound_event = webhook_ingestion
+    dead_letters.process_inbound_batch = retry_ingestion
+    try:
+        problems = []
+        with TestClient(app) as client:
+            problems += check_deferred(client)
+        first_id, give_up_id = sorted(load_dead_letters())[:2]
+        problems += check_not_due()
+        problems += check_backoff(give_up_id)
+        # Cho dòng còn lại thử lại thành công; dòng đã "dead" không bị quét lại
+        retry_ingestion.failing = False
+        problems += check_resolved(first_id)
+        if load_dead_letters()[give_up_id].status != "dead":
+            problems.append("dead letter retried after giving up")
+        return problems
+    finally:
+        webhook.process_inbound_event = webhook_ingestion.function
+        dead_letters.process_inbound_batch = retry_ingestion.function
+
+
+def main() -> int:
+    problems = run()
+    if not problems:
+        print("KHỚP")
+        return 0
+
+    for problem in problems[:20]:
+        print(problem, file=sys.stderr)
+    print(f"LỖI: {len(problems)} lỗi", file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,170 @@
+"""
+Kiểm tra tra cứu khách hàng qua customer_identities.
+
+Các trường hợp kiểm tra:
+1. Backfill trong init_db.sql: định danh cũ trên zalo_id / meta_id /
+   telegram_id trỏ tới khách hàng cũ nhất, webhook không tạo khách mới
+2. Upsert: sender mới tạo đúng một khách hàng + một định danh (kể cả khi lô
+   lặp lại sender), lần tra sau trả đúng khách hàng đó, cột cũ vẫn được ghi
+3. Nhiều worker cùng gặp một sender mới: chỉ một khách hàng được tạo
+
+Mặc định dùng SQLite trong thư mục tạm. Script xóa và tạo lại toàn bộ bảng,
+chỉ trỏ VERIFY_DATABASE_URL tới một database dành riêng cho việc kiểm tra:
+    python verify_identities.py
+"""
+from concurrent.futures import ThreadPoolExecutor
+import os
+import re
+import sys
+import tempfile
+
+_tmpdir = tempfile.mkdtemp(prefix="verify_identities_")
+os.environ["DATABASE_URL"] = os.getenv("VERIFY_DATABASE_URL", f"sqlite:///{_tmpdir}/identities.db")
+
+from sqlalchemy import text
+
+from customer_cache import customer_cache
+from database import Base, SessionLocal, engine
+from ingestion import resolve_customers
+from models import Customer, CustomerIdentity
+
+VERIFY_WORKERS = int(os.getenv("VERIFY_WORKERS", "8"))
+
+INIT_DB_SQL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "init_db.sql")
+BACKFILL_MARKER = "-- Backfill from the legacy per-platform columns"
+
+
+def backfill_statements() -> list:
+    """Ba lệnh INSERT ... SELECT backfill, đọc thẳng từ init_db.sql"""
+    with open(INIT_DB_SQL, encoding="utf-8") as sql_file:
+        sql = sql_file.read()
+    section = sql[sql.index(BACKFILL_MARKER):]
+    return re.findall(r"INSERT INTO customer_identities .*?;", section, re.S)[:3]
+
+
+def seed_legacy() -> dict:
+    """Khách hàng có sẵn trước khi có customer_identities; trả về {(platform, id): khách cũ nhất}"""
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    db = SessionLocal()
+    customers = [
+        Customer(name="Zalo cũ", platform="zalo", zalo_id="z-legacy"),
+        # Trùng zalo_id: khách tạo sau không được chọn
+        Customer(name="Zalo trùng", platform="zalo", zalo_id="z-legacy"),
+        Customer(name="Meta cũ", platform="facebook", meta_id="fb-legacy"),
+        Customer(name="Telegram cũ", platform="telegram", telegram_id="900"),
+    ]
+    db.add_all(customers)
+    db.commit()
+    expected = {
+        ("zalo", "z-legacy"): customers[0].id,
+        ("facebook", "fb-legacy"): customers[2].id,
+        ("telegram", "900"): customers[3].id,
+    }
+    db.close()
+    return expected
+
+
+def table_counts(db) -> tuple:
+    return db.query(Customer).count(), db.query(CustomerIdentity).count()
+
+
+def check_backfill() -> list:
+    expected = seed_legacy()
+    db = SessionLocal()
+    problems = []
+    try:
+        statements = backfill_statements()
+        if len(statements) != 3:
+            return [f"backfill: found {len(statements)} statements in init_db.sql, expected 3"]
+        # Chạy hai lần: migration phải chạy lại được
+        for _ in range(2):
+            for statement in statements:
+                db.execute(text(statement))
+        db.commit()
+
+        before = table_counts(db)
+        for (platform, sender_id), customer_id in expected.items():
+            resolved = resolve_customers(db, platform, [sender_id])[sender_id]
+            if resolved.id != customer_id:
+                problems.append(f"backfill: {platform} {sender_id} -> {resolved.id}, expected {customer_id}")
+        db.commit()
+        after = table_counts(db)
+        if after != before or before[1] != len(expected):
+            problems.append(f"backfill: customers / identities {before} -> {after}, expected {len(expected)} identities")
+        print(f"[1] Backfill: {before[1]} định danh, khách hàng / định danh {before} -> {after}")
+    finally:
+        db.close()
+    return problems
+
+
+def check_upsert() -> list:
+    customer_cache.clear()
+    db = SessionLocal()
+    problems = []
+    try:
+        before = table_counts(db)
+        first = resolve_customers(db, "zalo", ["z-new", "z-new", "z-legacy"])
+        db.commit()
+        customer_cache.clear()
+        again = resolve_customers(db, "zalo", ["z-new"])
+        db.commit()
+        after = table_counts(db)
+
+        if after != (before[0] + 1, before[1] + 1):
+            problems.append(f"upsert: customers / identities {before} -> {after}, expected one new of each")
+        if again["z-new"].id != first["z-new"].id:
+            problems.append(f"upsert: z-new resolved to {again['z-new'].id}, then {first['z-new'].id}")
+        if db.get(Customer, first["z-new"].id).zalo_id != "z-new":
+            problems.append("upsert: legacy zalo_id column not written")
+        print(f"[2] Upsert: khách hàng / định danh {before} -> {after}, z-new -> {first['z-new'].id}")
+    finally:
+        db.close()
+    return problems
+
+
+def check_concurrent_workers() -> list:
+    """Mỗi worker một session riêng, cùng gặp một sender chưa có định danh"""
+    customer_cache.clear()
+
+    def resolve(_):
+        db = SessionLocal()
+        try:
+            customer_id = resolve_customers(db, "telegram", ["901"])["901"].id
+            db.commit()
+            return customer_id
+        finally:
+            db.close()
+
+    customer_ids, errors = set(), []
+    with ThreadPoolExecutor(max_workers=VERIFY_WORKERS) as pool:
+        for future in [pool.submit(resolve, index) for index in range(VERIFY_WORKERS)]:
+            try:
+                customer_ids.add(future.result())
+            except Exception as e:
+                errors.append(f"{type(e).__name__}: {e}")
+
+    db = SessionLocal()
+    created = db.query(Customer).filter(Customer.telegram_id == "901").count()
+    db.close()
+    problems = [f"concurrent workers: {error}" for error in errors]
+    if created != 1 or len(customer_ids) != 1:
+        problems.append(f"concurrent workers: {created} customers created, workers saw {sorted(customer_ids)}")
+    print(f"[3] {VERIFY_WORKERS} worker cùng gặp sender mới: {created} khách hàng, {len(errors)} lỗi")
+    return problems
+
+
+def main() -> int:
+    problems = check_backfill() + check_upsert() + check_concurrent_workers()
+    if not problems:
+        print("KHỚP")
+        return 0
+
+    for problem in problems[:20]:
+        print(problem, file=sys.stderr)
+    print(f"LỖI: {len(problems)} lỗi", file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
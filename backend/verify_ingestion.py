@@ -0,0 +1,196 @@
+"""
+Kiểm tra webhook gửi lại không tạo tin nhắn, assignment hay KPI trùng.
+
+Các trường hợp kiểm tra, với cả ba webhook Zalo, Meta và Telegram:
+1. Lần gửi đầu: mỗi (platform, external_id) thành đúng một tin nhắn, kể cả
+   khi một payload Meta chứa cùng mid hai lần
+2. Gửi lại ngay: bộ lọc ID gần đây trả "duplicate", không chạm DB
+3. Gửi lại khi bộ lọc đã trống (restart, worker khác): INSERT ... ON CONFLICT
+   DO NOTHING bỏ qua bản trùng, không giao việc và không cộng KPI lần nữa
+4. Nhiều worker cùng lưu một sự kiện: chỉ một tin nhắn được tạo
+
+Mặc định dùng SQLite trong thư mục tạm. Script xóa và tạo lại toàn bộ bảng,
+chỉ trỏ VERIFY_DATABASE_URL tới một database dành riêng cho việc kiểm tra:
+    python verify_ingestion.py
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date as dt_date, time as dt_time, timedelta
+from decimal import Decimal
+import os
+import sys
+import tempfile
+
+_tmpdir = tempfile.mkdtemp(prefix="verify_ingestion_")
+os.environ["DATABASE_URL"] = os.getenv("VERIFY_DATABASE_URL", f"sqlite:///{_tmpdir}/ingestion.db")
+os.environ["WEBHOOK_INGESTION_MODE"] = "sync"
+
+from fastapi.testclient import TestClient
+from sqlalchemy import func
+
+from database import Base, SessionLocal, engine
+from ingestion import InboundEvent, process_inbound_event
+from kpi_counters import WORKLOAD_METRIC
+from main import app
+from models import CacheVersion, Department, KPI, Keyword, Message, MessageAssignment, Shift, User, UserShift
+from recent_ids import RecentIdFilter
+from routers import webhook
+
+VERIFY_WORKERS = int(os.getenv("VERIFY_WORKERS", "8"))
+
+ZALO = {"event_name": "user_send_text", "sender": {"id": "zalo-1"}, "message": {"text": "hoi gia"}, "message_id": "z-1"}
+META = {"object": "page", "entry": [{"messaging": [
+    {"sender": {"id": "fb-1"}, "message": {"text": "hoi gia", "mid": "m-1"}},
+    {"sender": {"id": "fb-1"}, "message": {"text": "bao hanh", "mid": "m-2"}},
+    # Cùng mid trong một payload (nền tảng gộp lần gửi lại)
+    {"sender": {"id": "fb-1"}, "message": {"text": "hoi gia", "mid": "m-1"}},
+]}]}
+TELEGRAM = {"message": {"chat": {"id": 501}, "text": "bao hanh", "message_id": 9}}
+DELIVERIES = [("zalo", ZALO), ("meta", META), ("telegram", TELEGRAM)]
+EXPECTED_MESSAGES = 4
+
+
+def seed() -> None:
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    db = SessionLocal()
+    db.add_all([CacheVersion(name="keywords", version=0), CacheVersion(name="roster", version=0)])
+    sales, support = Department(name="Kinh doanh"), Department(name="Bảo hành")
+    db.add_all([sales, support])
+    db.flush()
+    db.add_all([
+        Keyword(keyword="hoi gia", department_id=sales.id, priority=3),
+        Keyword(keyword="bao hanh", department_id=support.id, priority=3),
+    ])
+    shift = Shift(name="Cả ngày", start_time=dt_time(0, 0), end_time=dt_time(23, 59, 59))
+    db.add(shift)
+    staff_users = [
+        User(
+            email=f"verify.ingestion{index}@omnichat.com",
+            password_hash="verify",
+            full_name=f"Verify Ingestion {index}",
+            role="staff",
+            department_id=department.id
+        )
+        for index, department in enumerate([sales, sales, support, support])
+    ]
+    db.add_all(staff_users)
+    db.flush()
+    today = dt_date.today()
+    for staff in staff_users:
+        db.add(KPI(
+            user_id=staff.id,
+            metric_name=WORKLOAD_METRIC,
+            target_value=Decimal(100),
+            current_value=Decimal(0),
+            period_start=today - timedelta(days=1),
+            period_end=today + timedelta(days=1)
+        ))
+        db.add(UserShift(user_id=staff.id, shift_id=shift.id, date=today, status="scheduled"))
+    db.commit()
+    db.close()
+
+
+def counts() -> dict:
+    db = SessionLocal()
+    try:
+        return {
+            "messages": db.query(Message).filter(Message.direction == "incoming").count(),
+            "distinct": db.query(Message.platform, Message.external_id).distinct().count(),
+            "assignments": db.query(MessageAssignment).count(),
+            "workload": int(db.query(func.sum(KPI.current_value)).filter(
+                KPI.metric_name == WORKLOAD_METRIC
+            ).scalar() or 0),
+        }
+    finally:
+        db.close()
+
+
+def deliver_all(client: TestClient) -> list:
+    return [client.post(f"/api/webhook/{name}", json=payload).json()["status"] for name, payload in DELIVERIES]
+
+
+def check_first_delivery(client: TestClient) -> list:
+    statuses = deliver_all(client)
+    after = counts()
+    problems = []
+    if statuses != ["success"] * 3:
+        problems.append(f"first delivery: statuses {statuses}")
+    if after["messages"] != EXPECTED_MESSAGES or after["distinct"] != EXPECTED_MESSAGES:
+        problems.append(f"first delivery: {after['messages']} messages, expected {EXPECTED_MESSAGES}")
+    if after["workload"] != after["assignments"]:
+        problems.append(f"first delivery: workload KPI {after['workload']} != {after['assignments']} assignments")
+    print(f"[1] Lần gửi đầu: {statuses}, {after}")
+    return problems
+
+
+def check_redelivery(client: TestClient, label: str, description: str, expected_status: str) -> list:
+    before = counts()
+    statuses = deliver_all(client)
+    after = counts()
+    problems = []
+    if statuses != [expected_status] * 3:
+        problems.append(f"{label}: statuses {statuses}, expected {expected_status}")
+    if after != before:
+        problems.append(f"{label}: counts changed from {before} to {after}")
+    print(f"[{label}] {description}: {statuses}, {after}")
+    return problems
+
+
+def check_concurrent_workers() -> list:
+    """Mỗi worker một session riêng, cùng lưu một sự kiện chưa có trong DB"""
+    before = counts()
+    event = InboundEvent(platform="telegram", sender_id="777", text="hoi gia", external_id="777:1")
+
+    def store(_):
+        db = SessionLocal()
+        try:
+            process_inbound_event(db, event)
+        finally:
+            db.close()
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=VERIFY_WORKERS) as pool:
+        for future in [pool.submit(store, index) for index in range(VERIFY_WORKERS)]:
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(f"{type(e).__name__}: {e}")
+    after = counts()
+
+    problems = [f"concurrent workers: {error}" for error in errors]
+    created = after["messages"] - before["messages"]
+    if created != 1 or after["distinct"] != after["messages"]:
+        problems.append(f"concurrent workers: {created} messages created, expected 1")
+    if after["workload"] - before["workload"] != after["assignments"] - before["assignments"]:
+        problems.append("concurrent workers: workload KPI out of step with assignments")
+    print(f"[4] {VERIFY_WORKERS} worker cùng lưu một sự kiện: {created} tin nhắn, {len(errors)} lỗi")
+    return problems
+
+
+def run() -> list:
+    seed()
+    problems = []
+    with TestClient(app) as client:
+        problems += check_first_delivery(client)
+        problems += check_redelivery(client, "2", "Gửi lại ngay", "duplicate")
+        # Bộ lọc trống như sau khi restart: chỉ còn ràng buộc unique trong DB
+        webhook.recent_ids = RecentIdFilter()
+        problems += check_redelivery(client, "3", "Gửi lại khi bộ lọc trống", "success")
+    problems += check_concurrent_workers()
+    return problems
+
+
+def main() -> int:
+    problems = run()
+    if not problems:
+        print("KHỚP")
+        return 0
+
+    for problem in problems[:20]:
+        print(problem, file=sys.stderr)
+    print(f"LỖI: {len(problems)} lỗi", file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,216 @@
+"""
+Kiểm tra tính lại KPI tin nhắn theo lô và chế độ incremental theo mốc
+updated_at của message_assignments.
+
+Giá trị đúng được đếm lại bằng Python từ từng assignment (reference_values)
+rồi so với recompute_kpis. Các trường hợp kiểm tra:
+1. Lần chạy incremental đầu tiên (chưa có checkpoint): tính mọi KPI trong kỳ,
+   checkpoint = updated_at lớn nhất của message_assignments
+2. Không có assignment mới: chỉ KPI của nhân viên có assignment nằm trong
+   khoảng chồng lấn (KPI_RECOMPUTE_OVERLAP_SECONDS) được quét lại, không ghi
+   gì, checkpoint giữ nguyên
+3. Nhân viên hoàn thành một tin: KPI của người đó được tính lại (cùng các KPI
+   còn trong khoảng chồng lấn), nhân viên khác không bị quét, mốc tiến tới
+   assignment vừa sửa
+4. Tính lại toàn bộ sau đó không còn gì để sửa
+
+Mặc định chạy trên SQLite in-memory. Script xóa và tạo lại toàn bộ bảng,
+chỉ trỏ VERIFY_DATABASE_URL tới một database dành riêng cho việc kiểm tra:
+    python verify_kpi_recompute.py
+"""
+from datetime import date as dt_date, datetime, timedelta
+from decimal import Decimal
+import os
+import sys
+
+os.environ["DATABASE_URL"] = os.getenv("VERIFY_DATABASE_URL", "sqlite://")
+os.environ["KPI_RECOMPUTE_OVERLAP_SECONDS"] = "60"
+
+from database import Base, SessionLocal, engine
+from kpi_counters import (
+    COMPLETED_METRIC, COMPLETION_RATE_METRIC, KPI_RECOMPUTE_JOB, WORKLOAD_METRIC, recompute_kpis
+)
+from models import Customer, Department, JobCheckpoint, KPI, Message, MessageAssignment, User
+
+# Số assignment trong kỳ (số đã hoàn thành) của từng nhân viên và các KPI của họ
+STAFF = {
+    "a": (4, 2, [WORKLOAD_METRIC, COMPLETED_METRIC, COMPLETION_RATE_METRIC]),
+    "b": (2, 0, [WORKLOAD_METRIC, COMPLETED_METRIC]),
+    "c": (1, 0, [WORKLOAD_METRIC]),
+}
+
+
+def seed() -> dict:
+    """Trả về {tên nhân viên: user_id}; mọi KPI bắt đầu với giá trị sai"""
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    db = SessionLocal()
+    department = Department(name="Kinh doanh")
+    customer = Customer(name="Khách hàng", platform="zalo")
+    db.add_all([department, customer])
+    db.flush()
+
+    today = dt_date.today()
+    now = datetime.utcnow()
+    users = {}
+    for order, (name, (assigned, completed, metrics)) in enumerate(STAFF.items()):
+        staff = User(
+            email=f"verify.kpi.{name}@omnichat.com",
+            password_hash="verify",
+            full_name=f"Verify KPI {name}",
+            role="staff",
+            department_id=department.id
+        )
+        db.add(staff)
+        db.flush()
+        users[name] = staff.id
+        for metric_name in metrics:
+            db.add(KPI(
+                user_id=staff.id,
+                metric_name=metric_name,
+                target_value=Decimal(10),
+                current_value=Decimal(99),
+                period_start=today - timedelta(days=3),
+                period_end=today + timedelta(days=3)
+            ))
+        # Assignment cũ ngoài kỳ: không được tính
+        assigned_at = [now] * assigned + [now - timedelta(days=40)]
+        for index, at in enumerate(assigned_at):
+            message = Message(
+                customer_id=customer.id,
+                content=f"{name} {index}",
+                platform="zalo",
+                direction="incoming",
+                status="completed" if index < completed else "assigned"
+            )
+            db.add(message)
+            db.flush()
+            db.add(MessageAssignment(
+                message_id=message.id,
+                assigned_to=staff.id,
+                assigned_at=at,
+                completed_at=at if index < completed else None,
+                # Lần sửa gần nhất cách đây vài giờ; nhân viên sau cùng mới nhất
+                updated_at=now - timedelta(hours=3 - order)
+            ))
+    db.commit()
+    db.close()
+    return users
+
+
+def reference_values(db) -> dict:
+    """Giá trị đúng của từng KPI, đếm từng assignment bằng Python"""
+    values = {}
+    assignments = db.query(MessageAssignment, Message.status).join(Message).all()
+    for kpi in db.query(KPI).all():
+        in_period = [
+            status for assignment, status in assignments
+            if assignment.assigned_to == kpi.user_id
+            and kpi.period_start <= assignment.assigned_at.date() <= kpi.period_end
+        ]
+        assigned = len(in_period)
+        completed = in_period.count("completed")
+        if kpi.metric_name == WORKLOAD_METRIC:
+            values[kpi.id] = Decimal(assigned)
+        elif kpi.metric_name == COMPLETED_METRIC:
+            values[kpi.id] = Decimal(completed)
+        else:
+            values[kpi.id] = (
+                (Decimal(completed) * 100 / Decimal(assigned)).quantize(Decimal("0.01")) if assigned else Decimal(0)
+            )
+    return values
+
+
+def compare(db, label: str) -> list:
+    db.expire_all()
+    expected = reference_values(db)
+    actual = {kpi.id: Decimal(kpi.current_value) for kpi in db.query(KPI).all()}
+    return [
+        f"{label}: KPI {kpi_id} = {actual[kpi_id]}, expected {value}"
+        for kpi_id, value in expected.items()
+        if actual[kpi_id] != value
+    ]
+
+
+def checkpoint_at(db):
+    checkpoint = db.get(JobCheckpoint, KPI_RECOMPUTE_JOB)
+    return checkpoint.checkpoint_at if checkpoint else None
+
+
+def newest_assignment(db):
+    db.expire_all()
+    return db.query(MessageAssignment.updated_at).order_by(MessageAssignment.updated_at.desc()).limit(1).scalar()
+
+
+def kpi_count(db, user_id: int) -> int:
+    return db.query(KPI).filter(KPI.user_id == user_id).count()
+
+
+def run() -> list:
+    users = seed()
+    db = SessionLocal()
+    problems = []
+    try:
+        # 1. Lần đầu: tính toàn bộ
+        first = recompute_kpis(db, incremental=True)
+        db.commit()
+        problems += compare(db, "first run")
+        if first["incremental"] or first["scanned"] != db.query(KPI).count():
+            problems.append(f"first run: {first}")
+        if checkpoint_at(db) != newest_assignment(db):
+            problems.append(f"first run: checkpoint {checkpoint_at(db)}, expected {newest_assignment(db)}")
+        print(f"[1] Lần đầu: quét {first['scanned']}, sửa {first['updated']}, checkpoint {checkpoint_at(db)}")
+
+        # 2. Không có gì mới: chỉ nhân viên "c" (assignment mới nhất) nằm trong khoảng chồng lấn
+        saved = checkpoint_at(db)
+        idle = recompute_kpis(db, incremental=True)
+        db.commit()
+        if (idle["scanned"], idle["updated"]) != (kpi_count(db, users["c"]), 0) or checkpoint_at(db) != saved:
+            problems.append(f"idle run: {idle}, checkpoint {saved} -> {checkpoint_at(db)}")
+        print(f"[2] Không có gì mới: quét {idle['scanned']}, sửa {idle['updated']}")
+
+        # 3. Nhân viên "b" hoàn thành một tin (updated_at của assignment được làm mới)
+        assignment = db.query(MessageAssignment).filter(
+            MessageAssignment.assigned_to == users["b"],
+            MessageAssignment.completed_at.is_(None)
+        ).order_by(MessageAssignment.id).first()
+        assignment.message.status = "completed"
+        assignment.completed_at = datetime.utcnow()
+        db.commit()
+        changed = recompute_kpis(db, incremental=True)
+        db.commit()
+        problems += compare(db, "after completion")
+        # "c" vẫn nằm trong khoảng chồng lấn của mốc cũ; "a" không được quét
+        expected_scanned = kpi_count(db, users["b"]) + kpi_count(db, users["c"])
+        if changed["scanned"] != expected_scanned or changed["updated"] != 1:
+            problems.append(f"after completion: {changed}, expected {expected_scanned} KPIs scanned, 1 updated")
+        if checkpoint_at(db) != newest_assignment(db):
+            problems.append(f"after completion: checkpoint {checkpoint_at(db)}, expected {newest_assignment(db)}")
+        print(f"[3] Sau khi hoàn thành một tin: quét {changed['scanned']}, sửa {changed['updated']}")
+
+        # 4. Tính lại toàn bộ kỳ hiện tại: không còn gì sai
+        full = recompute_kpis(db)
+        db.commit()
+        problems += compare(db, "full run")
+        if full["updated"]:
+            problems.append(f"full run: {full['updated']} KPIs still out of date")
+        print(f"[4] Tính lại toàn bộ: quét {full['scanned']}, sửa {full['updated']}")
+    finally:
+        db.close()
+    return problems
+
+
+def main() -> int:
+    problems = run()
+    if not problems:
+        print("KHỚP")
+        return 0
+
+    for problem in problems[:20]:
+        print(problem, file=sys.stderr)
+    print(f"LỖI: {len(problems)} lỗi", file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,335 @@
+"""
+Kiểm tra outbox Telegram với một server HTTP giả lập Bot API chạy cục bộ.
+
+Server giả lập ghi lại mọi lời gọi sendMessage và trả lỗi theo tên chat:
+- "ratelimit-*": lần đầu trả 429 kèm retry_after
+- "flaky-*": lần đầu trả 500
+- "blocked-*": luôn trả 403 (không gửi lại)
+
+Các trường hợp kiểm tra:
+1. Hai outbox khởi động cùng lúc trên cùng database: mỗi tin chỉ được nhận
+   (claim) bởi một outbox và chỉ được gửi một lần, đúng thứ tự trong mỗi chat,
+   kết quả sent / failed ghi vào dòng Message
+2. Ghi kết quả vào DB bị lỗi: tin không bị bỏ khỏi hàng đợi, không gửi lại,
+   trạng thái được ghi ở lần thử sau
+3. Tắt outbox khi còn tin chưa gửi: tin được trả về "queued"
+4. Chat bị 429 chờ retry_after không giữ worker: với một worker duy nhất,
+   các chat khác vẫn được gửi ngay
+5. DB lỗi lúc khởi động: outbox vẫn khởi động, nhận lại tin ở lần thử sau
+
+Mặc định dùng SQLite trong thư mục tạm. Script xóa và tạo lại toàn bộ bảng,
+chỉ trỏ VERIFY_DATABASE_URL tới một database dành riêng cho việc kiểm tra:
+    python verify_outbox.py
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+_tmpdir = tempfile.mkdtemp(prefix="verify_outbox_")
+os.environ["DATABASE_URL"] = os.getenv("VERIFY_DATABASE_URL", f"sqlite:///{_tmpdir}/outbox.db")
+
+from sqlalchemy import select
+
+from database import Base, SessionLocal, async_engine, engine
+from models import Customer, Message
+from outbox import TelegramOutbox
+
+VERIFY_CHATS = int(os.getenv("VERIFY_CHATS", "12"))
+VERIFY_MESSAGES_PER_CHAT = int(os.getenv("VERIFY_MESSAGES_PER_CHAT", "4"))
+TOKEN = "verify-token"
+
+
+class MockTelegram:
+    """Server Bot API giả lập chạy trong một thread riêng"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.delivered = []  # (chat_id, text) đã gửi thành công, theo thứ tự nhận
+        self.delivered_at = {}  # text -> thời điểm nhận (time.monotonic)
+        self.calls = {}  # chat_id -> số lời gọi
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                status, payload = mock.handle(self.path, body)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def handle(self, path: str, body: dict):
+        if path != f"/bot{TOKEN}/sendMessage":
+            return 404, {"ok": False, "error_code": 404, "description": "Not Found"}
+        chat_id = str(body["chat_id"])
+        with self.lock:
+            calls = self.calls[chat_id] = self.calls.get(chat_id, 0) + 1
+            if chat_id.startswith("ratelimit-") and calls == 1:
+                return 429, {
+                    "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1}
+                }
+            if chat_id.startswith("flaky-") and calls == 1:
+                return 500, {"ok": False, "error_code": 500, "description": "Internal Server Error"}
+            if chat_id.startswith("blocked-"):
+                return 403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+            self.delivered.append((chat_id, body["text"]))
+            self.delivered_at[body["text"]] = time.monotonic()
+            return 200, {"ok": True, "result": {"message_id": len(self.delivered), "chat": {"id": chat_id}}}
+
+    def reset(self):
+        with self.lock:
+            self.delivered = []
+            self.delivered_at = {}
+            self.calls = {}
+
+
+def make_outbox(mock: MockTelegram, **options) -> TelegramOutbox:
+    settings = dict(
+        token=TOKEN, api_base=mock.url, workers=4, rate_per_second=200,
+        per_chat_interval=0.02, max_attempts=3, retry_base=0.05
+    )
+    settings.update(options)
+    return TelegramOutbox(**settings)
+
+
+def seed_queued(chat_ids, per_chat: int):
+    """Tạo khách Telegram và các tin outgoing "queued"; trả về {chat_id: [message_id]}"""
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    db = SessionLocal()
+    customers = [Customer(name=chat_id, telegram_id=chat_id, platform="telegram") for chat_id in chat_ids]
+    db.add_all(customers)
+    db.flush()
+    messages = []
+    # Xen kẽ giữa các chat để thứ tự id không trùng với thứ tự chat
+    for index in range(per_chat):
+        for customer in customers:
+            messages.append(Message(
+                customer_id=customer.id, content=f"{customer.telegram_id} #{index}",
+                platform="telegram", direction="outgoing", status="completed",
+                delivery_status="queued", delivery_attempts=0
+            ))
+    db.add_all(messages)
+    db.commit()
+    expected = {}
+    for message in messages:
+        expected.setdefault(message.content.split(" #")[0], []).append(message.id)
+    db.close()
+    return expected
+
+
+def load_messages():
+    db = SessionLocal()
+    rows = {message.id: message for message in db.scalars(select(Message)).all()}
+    db.close()
+    return rows
+
+
+async def check_concurrent_claims(mock: MockTelegram) -> list:
+    chat_ids = [f"chat-{index}" for index in range(VERIFY_CHATS)] + ["ratelimit-1", "flaky-1", "blocked-1"]
+    expected = seed_queued(chat_ids, VERIFY_MESSAGES_PER_CHAT)
+    mock.reset()
+
+    first, second = make_outbox(mock), make_outbox(mock)
+    await asyncio.gather(first.start(), second.start())
+    started = time.monotonic()
+    await asyncio.gather(first.drain(timeout=30), second.drain(timeout=30))
+    elapsed = time.monotonic() - started
+
+    problems = []
+    claimed = first.enqueued + second.enqueued
+    total = sum(len(ids) for ids in expected.values())
+    if claimed != total:
+        problems.append(f"claims: {claimed} messages enqueued for {total} queued rows")
+
+    texts = [text for _, text in mock.delivered]
+    duplicates = {text for text in texts if texts.count(text) > 1}
+    if duplicates:
+        problems.append(f"duplicates: {sorted(duplicates)[:5]}")
+
+    messages = load_messages()
+    for chat_id, message_ids in expected.items():
+        sent_order = [text for delivered_chat, text in mock.delivered if delivered_chat == chat_id]
+        expected_order = [messages[message_id].content for message_id in message_ids]
+        wanted = "failed" if chat_id.startswith("blocked-") else "sent"
+        if wanted == "sent" and sent_order != expected_order:
+            problems.append(f"order {chat_id}: {sent_order} != {expected_order}")
+        for message_id in message_ids:
+            message = messages[message_id]
+            if message.delivery_status != wanted or message.delivery_claimed_by is not None:
+                problems.append(
+                    f"message {message_id} ({chat_id}): status {message.delivery_status!r}, "
+                    f"claimed by {message.delivery_claimed_by!r}, expected {wanted!r}"
+                )
+            if wanted == "sent" and not (message.external_id or "").startswith(f"{chat_id}:"):
+                problems.append(f"message {message_id}: external_id {message.external_id!r}")
+    retried = messages[expected["ratelimit-1"][0]].delivery_attempts
+    if retried != 2:
+        problems.append(f"ratelimit-1: {retried} attempts, expected 2")
+    if elapsed < 1:
+        problems.append(f"retry_after of 429 not honoured (finished in {elapsed:.2f}s)")
+
+    print(
+        f"[1] {total} tin, {len(chat_ids)} chat: outbox 1 nhận {first.enqueued}, outbox 2 nhận "
+        f"{second.enqueued}, gửi {len(mock.delivered)} trong {elapsed:.2f}s"
+    )
+    return problems
+
+
+class FlakyRecordOutbox(TelegramOutbox):
+    """Outbox có lần ghi kết quả đầu tiên vào DB bị lỗi"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.record_calls = 0
+
+    async def _record(self, job, *args, **kwargs):
+        self.record_calls += 1
+        if self.record_calls == 1:
+            raise RuntimeError("database unavailable")
+        await super()._record(job, *args, **kwargs)
+
+
+async def check_record_failure(mock: MockTelegram) -> list:
+    expected = seed_queued(["chat-record"], 2)
+    mock.reset()
+    outbox = FlakyRecordOutbox(
+        token=TOKEN, api_base=mock.url, workers=1, rate_per_second=200,
+        per_chat_interval=0.02, max_attempts=3, retry_base=0.05
+    )
+    await outbox.start()
+    await outbox.drain(timeout=10)
+
+    problems = []
+    messages = load_messages()
+    statuses = [messages[message_id].delivery_status for message_id in expected["chat-record"]]
+    if statuses != ["sent", "sent"]:
+        problems.append(f"record failure: statuses {statuses}")
+    if len(mock.delivered) != 2:
+        problems.append(f"record failure: {len(mock.delivered)} sends, expected 2 (no resend)")
+    print(f"[2] lỗi ghi DB lần đầu: trạng thái {statuses}, gửi {len(mock.delivered)} lần")
+    return problems
+
+
+async def check_release_on_shutdown(mock: MockTelegram) -> list:
+    expected = seed_queued(["chat-slow"], 3)
+    mock.reset()
+    # Mỗi chat chỉ được gửi một tin mỗi 5 giây: hết thời gian drain khi còn 2 tin
+    outbox = make_outbox(mock, per_chat_interval=5)
+    await outbox.start()
+    await outbox.drain(timeout=0.5)
+
+    messages = load_messages()
+    states = [
+        (messages[message_id].delivery_status, messages[message_id].delivery_claimed_by)
+        for message_id in expected["chat-slow"]
+    ]
+    problems = []
+    if states != [("sent", None), ("queued", None), ("queued", None)]:
+        problems.append(f"release on shutdown: {states}")
+    print(f"[3] tắt khi còn tin: {[status for status, _ in states]}")
+    return problems
+
+
+async def check_rate_limited_chat_does_not_block(mock: MockTelegram) -> list:
+    expected = seed_queued(["ratelimit-2", "chat-a", "chat-b"], 1)
+    mock.reset()
+    outbox = make_outbox(mock, workers=1)
+    started = time.monotonic()
+    await outbox.start()
+    await outbox.drain(timeout=10)
+
+    problems = []
+    texts = {chat_id: f"{chat_id} #0" for chat_id in expected}
+    if set(mock.delivered_at) != set(texts.values()):
+        problems.append(f"rate limited chat: delivered {sorted(mock.delivered_at)}")
+        return problems
+    limited_at = mock.delivered_at[texts["ratelimit-2"]] - started
+    others_at = max(mock.delivered_at[texts[chat_id]] for chat_id in ("chat-a", "chat-b")) - started
+    if not (others_at < 0.5 <= 1 <= limited_at):
+        problems.append(
+            f"rate limited chat: others delivered after {others_at:.2f}s, "
+            f"rate limited chat after {limited_at:.2f}s"
+        )
+    print(f"[4] 1 worker, một chat bị 429: chat khác gửi sau {others_at:.2f}s, chat bị 429 sau {limited_at:.2f}s")
+    return problems
+
+
+class FlakyRecoveryOutbox(TelegramOutbox):
+    """Outbox có lần nhận lại tin đầu tiên (lúc khởi động) bị lỗi DB"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.recover_calls = 0
+
+    async def _recover(self):
+        self.recover_calls += 1
+        if self.recover_calls == 1:
+            raise RuntimeError("database unavailable")
+        await super()._recover()
+
+
+async def check_recovery_retry(mock: MockTelegram) -> list:
+    expected = seed_queued(["chat-recovery"], 2)
+    mock.reset()
+    outbox = FlakyRecoveryOutbox(
+        token=TOKEN, api_base=mock.url, workers=2, rate_per_second=200,
+        per_chat_interval=0.02, max_attempts=3, retry_base=0.05
+    )
+    await outbox.start()
+    # Chờ lần thử lại nhận tin chạy xong rồi mới drain
+    for _ in range(100):
+        if outbox.enqueued:
+            break
+        await asyncio.sleep(0.05)
+    await outbox.drain(timeout=10)
+
+    messages = load_messages()
+    statuses = [messages[message_id].delivery_status for message_id in expected["chat-recovery"]]
+    problems = []
+    if statuses != ["sent", "sent"] or outbox.recover_calls != 2:
+        problems.append(f"recovery retry: {outbox.recover_calls} attempts, statuses {statuses}")
+    print(f"[5] DB lỗi lúc khởi động: nhận lại sau {outbox.recover_calls} lần, trạng thái {statuses}")
+    return problems
+
+
+async def run() -> list:
+    mock = MockTelegram()
+    try:
+        problems = []
+        problems += await check_concurrent_claims(mock)
+        problems += await check_record_failure(mock)
+        problems += await check_release_on_shutdown(mock)
+        problems += await check_rate_limited_chat_does_not_block(mock)
+        problems += await check_recovery_retry(mock)
+        return problems
+    finally:
+        mock.server.shutdown()
+        await async_engine.dispose()
+
+
+def main() -> int:
+    problems = asyncio.run(run())
+    for problem in problems[:20]:
+        print(problem)
+    print("KHỚP" if not problems else f"{len(problems)} lỗi")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,208 @@
+"""
+Kiểm tra chấm điểm theo lô cho ra đúng kết quả của cách chấm cũ.
+
+Cách cũ: mỗi nhân viên một truy vấn KPI + một truy vấn ca làm việc
+(calculate_staff_score ban đầu, chép lại trong legacy_score). Cách mới:
+find_best_staff nạp KPI của mọi ứng viên bằng một truy vấn và tra ca từ chỉ
+mục lịch trực. Script sinh dữ liệu ngẫu nhiên có seed cố định, so sánh điểm
+của từng nhân viên và người được chọn (với mọi scoring engine khả dụng). Khi có
+khác biệt, script in chi tiết ra stderr và thoát với mã 1 để CI dừng lại.
+
+Mặc định chạy trên SQLite in-memory. Script xóa và tạo lại toàn bộ bảng,
+chỉ trỏ VERIFY_DATABASE_URL tới một database dành riêng cho việc kiểm tra:
+    python verify_scoring.py
+    VERIFY_STAFF=1000 VERIFY_SEED=7 python verify_scoring.py
+"""
+from datetime import date as dt_date, datetime, time as dt_time, timedelta
+from decimal import Decimal
+import os
+import random
+import sys
+
+os.environ["DATABASE_URL"] = os.getenv("VERIFY_DATABASE_URL", "sqlite://")
+
+from database import Base, SessionLocal, engine
+from keyword_analyzer import KeywordAnalyzer, np
+from kpi_counters import WORKLOAD_METRIC
+from models import CacheVersion, Department, KPI, Keyword, Shift, User, UserShift
+from shift_roster import get_roster
+
+VERIFY_STAFF = int(os.getenv("VERIFY_STAFF", "300"))
+VERIFY_MESSAGES = int(os.getenv("VERIFY_MESSAGES", "50"))
+VERIFY_SEED = int(os.getenv("VERIFY_SEED", "0"))
+
+DEPARTMENTS = 5
+KEYWORDS = 40
+
+
+def seed(rng: random.Random) -> None:
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    db = SessionLocal()
+    db.add_all([CacheVersion(name="keywords", version=0), CacheVersion(name="roster", version=0)])
+    departments = [Department(name=f"Phòng {index}") for index in range(DEPARTMENTS)]
+    db.add_all(departments)
+    db.flush()
+
+    for index in range(KEYWORDS):
+        db.add(Keyword(
+            keyword=f"tu khoa {index}",
+            department_id=departments[index % DEPARTMENTS].id,
+            priority=rng.randint(1, 5)
+        ))
+
+    # Ca cả ngày (đang trong ca) và ca đã qua (có ca nhưng không trong ca);
+    # không dùng ca qua đêm vì cách chấm cũ không hỗ trợ
+    all_day = Shift(name="Cả ngày", start_time=dt_time(0, 0), end_time=dt_time(23, 59, 59))
+    finished = Shift(name="Đã qua", start_time=dt_time(0, 0), end_time=dt_time(0, 0, 1))
+    db.add_all([all_day, finished])
+
+    staff_users = [
+        User(
+            email=f"verify.staff{index}@omnichat.com",
+            password_hash="verify",
+            full_name=f"Verify Staff {index}",
+            role="staff",
+            department_id=departments[rng.randrange(DEPARTMENTS)].id,
+            is_active=rng.random() > 0.1
+        )
+        for index in range(VERIFY_STAFF)
+    ]
+    db.add_all(staff_users)
+    db.flush()
+
+    today = dt_date.today()
+    for staff in staff_users:
+        # 0, 1 hoặc 2 KPI trong kỳ (nhiều KPI: lấy KPI có id nhỏ nhất)
+        for _ in range(rng.choice([0, 1, 1, 2])):
+            db.add(KPI(
+                user_id=staff.id,
+                metric_name=WORKLOAD_METRIC,
+                target_value=Decimal(rng.choice([0, rng.randint(1, 200)])),
+                current_value=Decimal(rng.randint(0, 250)),
+                period_start=today - timedelta(days=rng.randint(0, 6)),
+                period_end=today + timedelta(days=rng.randint(0, 6))
+            ))
+        shift = rng.choice([None, all_day, finished])
+        if shift is not None:
+            db.add(UserShift(
+                user_id=staff.id,
+                shift_id=shift.id,
+                date=today,
+                status=rng.choice(["scheduled", "scheduled", "cancelled"])
+            ))
+    db.commit()
+    db.close()
+
+
+def legacy_score(db, user: User, matched_keywords, current_date: dt_date) -> Decimal:
+    """calculate_staff_score trước khi nạp theo lô: hai truy vấn cho mỗi nhân viên"""
+    score = Decimal(0)
+
+    keyword_score = Decimal(0)
+    for kw in matched_keywords:
+        if kw.department_id == user.department_id:
+            keyword_score += Decimal(kw.priority * 10)
+    score += min(keyword_score, Decimal(50))
+
+    kpi = db.query(KPI).filter(
+        KPI.user_id == user.id,
+        KPI.metric_name == WORKLOAD_METRIC,
+        KPI.period_start <= current_date,
+        KPI.period_end >= current_date
+    ).order_by(KPI.id).first()
+    if kpi:
+        if kpi.target_value and kpi.target_value > 0:
+            completion_rate = (kpi.current_value / kpi.target_value) * 100
+            score += Decimal(30) * (Decimal(100) - min(completion_rate, Decimal(100))) / Decimal(100)
+        else:
+            score += Decimal(15)
+    else:
+        score += Decimal(20)
+
+    current_time = datetime.now().time()
+    user_shift = db.query(UserShift).join(UserShift.shift).filter(
+        UserShift.user_id == user.id,
+        UserShift.date == current_date,
+        UserShift.status == "scheduled"
+    ).order_by(UserShift.id).first()
+    if user_shift and user_shift.shift:
+        if user_shift.shift.start_time <= current_time <= user_shift.shift.end_time:
+            score += Decimal(20)
+        else:
+            score += Decimal(5)
+
+    return score
+
+
+def verify_message(db, content: str, engines) -> list:
+    """Trả về danh sách mô tả các khác biệt cho một tin nhắn"""
+    current_date = dt_date.today()
+    analyzer = KeywordAnalyzer(db, scoring_engine="scalar", load_mode="kpi")
+    matched_keywords = analyzer.extract_keywords(content)
+    if not matched_keywords:
+        return []
+    department_ids = {kw.department_id for kw in matched_keywords}
+    staff_users = db.query(User).filter(
+        User.role == "staff",
+        User.is_active == True,
+        User.department_id.in_(department_ids)
+    ).order_by(User.id).all()
+
+    # Điểm từng nhân viên: cách cũ và dữ liệu nạp theo lô
+    kpis_by_user = analyzer._load_scoring_context([staff.id for staff in staff_users], current_date)
+    roster = get_roster(db, current_date)
+    current_time = datetime.now().time()
+    problems = []
+    expected_staff, expected_score = None, Decimal(0)
+    for staff in staff_users:
+        expected = legacy_score(db, staff, matched_keywords, current_date)
+        actual = analyzer._score_staff(
+            staff, matched_keywords, kpis_by_user.get(staff.id), roster.shift_status(staff, current_time)
+        )
+        if expected != actual:
+            problems.append(f"{content!r}: staff {staff.id} scored {actual}, expected {expected}")
+        if expected > expected_score:
+            expected_staff, expected_score = staff, expected
+
+    # Người được chọn qua find_best_staff với từng engine
+    for engine_name in engines:
+        best_staff, best_score, _ = KeywordAnalyzer(
+            db, scoring_engine=engine_name, load_mode="kpi"
+        ).find_best_staff(content, current_date)
+        expected_id = expected_staff.id if expected_staff else None
+        actual_id = best_staff.id if best_staff else None
+        if (actual_id, best_score) != (expected_id, expected_score):
+            problems.append(
+                f"{content!r} [{engine_name}]: picked {actual_id} ({best_score}), "
+                f"expected {expected_id} ({expected_score})"
+            )
+    return problems
+
+
+def main() -> int:
+    rng = random.Random(VERIFY_SEED)
+    seed(rng)
+    engines = ["scalar"] + (["numpy"] if np is not None else [])
+
+    db = SessionLocal()
+    problems = []
+    for _ in range(VERIFY_MESSAGES):
+        picked = rng.sample(range(KEYWORDS), rng.randint(1, 4))
+        content = "Xin chào, " + ", ".join(f"tu khoa {index}" for index in picked)
+        problems += verify_message(db, content, engines)
+    db.close()
+
+    summary = f"{VERIFY_STAFF} nhân viên, {VERIFY_MESSAGES} tin nhắn, engine: {', '.join(engines)}"
+    if not problems:
+        print(f"{summary} -> KHỚP")
+        return 0
+
+    for problem in problems[:20]:
+        print(problem, file=sys.stderr)
+    print(f"LỖI: {summary} -> {len(problems)} khác biệt so với cách chấm cũ", file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,187 @@
+from typing import Dict, Optional, Tuple
+import asyncio
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from database import SessionLocal
+from models import Message, MessageAssignment
+
+logger = logging.getLogger(__name__)
+
+# Hệ số làm mượt EWMA cho thời gian xử lý (0 < alpha <= 1)
+WORKLOAD_EWMA_ALPHA = float(os.getenv("WORKLOAD_EWMA_ALPHA", "0.2"))
+# Chu kỳ (giây) đối soát số việc đang mở với bảng message_assignments
+WORKLOAD_RECONCILE_SECONDS = float(os.getenv("WORKLOAD_RECONCILE_SECONDS", "60"))
+# Số message_id mỗi truy vấn khi kiểm tra các tin đang theo dõi mốc thời gian giao
+RECONCILE_CHUNK_SIZE = 1000
+
+
+class WorkloadTracker:
+    """
+    Theo dõi khối lượng công việc thực tế của từng nhân viên trong bộ nhớ.
+
+    - Số tin nhắn đang mở (đã giao, chưa hoàn thành)
+    - EWMA thời gian xử lý một tin nhắn
+
+    Được cập nhật khi giao việc / hoàn thành và đối soát định kỳ với DB bởi
+    WorkloadReconciler để sửa sai lệch (restart, nhiều worker, cập nhật
+    ngoài luồng).
+    """
+
+    def __init__(self, alpha: float = WORKLOAD_EWMA_ALPHA):
+        self.alpha = alpha
+        self._open_counts: Dict[int, int] = {}
+        self._handling_ewma: Dict[int, float] = {}
+        self._ewma_total = 0.0
+        # message_id -> (user_id, thời điểm giao theo monotonic clock)
+        self._opened_at: Dict[int, Tuple[int, float]] = {}
+        self._lock = threading.Lock()
+
+    def assignment_opened(self, user_id: int, message_id: int) -> None:
+        """Ghi nhận một tin nhắn vừa được giao cho nhân viên"""
+        with self._lock:
+            if message_id in self._opened_at:
+                return
+            self._open_counts[user_id] = self._open_counts.get(user_id, 0) + 1
+            self._opened_at[message_id] = (user_id, time.monotonic())
+
+    def assignment_closed(self, user_id: int, message_id: int) -> None:
+        """Ghi nhận nhân viên đã hoàn thành tin nhắn và cập nhật EWMA"""
+        with self._lock:
+            self._open_counts[user_id] = max(self._open_counts.get(user_id, 0) - 1, 0)
+            opened = self._opened_at.pop(message_id, None)
+            if opened is None:
+                # Giao trước khi process khởi động, không có mốc thời gian tin cậy
+                return
+            self._record_handling_time(user_id, time.monotonic() - opened[1])
+
+    def _record_handling_time(self, user_id: int, seconds: float) -> None:
+        previous = self._handling_ewma.get(user_id)
+        if previous is None:
+            current = seconds
+        else:
+            current = self.alpha * seconds + (1 - self.alpha) * previous
+        self._handling_ewma[user_id] = current
+        self._ewma_total += current - (previous or 0.0)
+
+    def open_count(self, user_id: int) -> int:
+        return self._open_counts.get(user_id, 0)
+
+    def handling_time(self, user_id: int) -> Optional[float]:
+        return self._handling_ewma.get(user_id)
+
+    def load(self, user_id: int, extra_open: int = 0) -> float:
+        """
+        Tải hiện tại quy đổi ra "số tin nhắn trung bình":
+        số việc đang mở nhân với tốc độ xử lý tương đối của nhân viên
+        so với trung bình toàn hệ thống.
+
+        extra_open: số việc vừa giao nhưng chưa commit (khi giao theo lô).
+        """
+        open_count = self._open_counts.get(user_id, 0) + extra_open
+        if not open_count:
+            return 0.0
+        ewma = self._handling_ewma.get(user_id)
+        if ewma is None or not self._handling_ewma or self._ewma_total <= 0:
+            return float(open_count)
+        baseline = self._ewma_total / len(self._handling_ewma)
+        return open_count * ewma / baseline
+
+    def reconcile(self, db: Session) -> None:
+        """
+        Tính lại số việc đang mở của mọi nhân viên từ message_assignments bằng
+        một truy vấn GROUP BY; mốc thời gian giao chỉ giữ cho tin nhắn còn mở
+        trong số các tin process này đang theo dõi.
+        """
+        open_assignments = [
+            MessageAssignment.assigned_to.isnot(None),
+            MessageAssignment.completed_at.is_(None),
+            Message.status != "completed"
+        ]
+        open_counts = dict(db.query(
+            MessageAssignment.assigned_to, func.count(MessageAssignment.id)
+        ).join(Message).filter(
+            *open_assignments
+        ).group_by(MessageAssignment.assigned_to).all())
+
+        with self._lock:
+            tracked = list(self._opened_at)
+        still_open = set()
+        for offset in range(0, len(tracked), RECONCILE_CHUNK_SIZE):
+            still_open.update(message_id for message_id, in db.query(
+                MessageAssignment.message_id
+            ).join(Message).filter(
+                MessageAssignment.message_id.in_(tracked[offset:offset + RECONCILE_CHUNK_SIZE]),
+                *open_assignments
+            ))
+
+        closed = set(tracked) - still_open
+        with self._lock:
+            self._open_counts = open_counts
+            for message_id in closed:
+                self._opened_at.pop(message_id, None)
+
+    def stats(self) -> Dict[int, dict]:
+        """Số liệu hiện tại theo nhân viên, phục vụ giám sát"""
+        with self._lock:
+            user_ids = set(self._open_counts) | set(self._handling_ewma)
+            return {
+                user_id: {
+                    "open_assignments": self._open_counts.get(user_id, 0),
+                    "handling_time_ewma": self._handling_ewma.get(user_id),
+                }
+                for user_id in user_ids
+            }
+
+
+# Tracker dùng chung trong process
+workload_tracker = WorkloadTracker()
+
+
+def _reconcile_workload() -> None:
+    db = SessionLocal()
+    try:
+        workload_tracker.reconcile(db)
+    finally:
+        db.close()
+
+
+class WorkloadReconciler:
+    """
+    Task nền đối soát WorkloadTracker với DB: chạy ngay khi khởi động rồi lặp
+    lại mỗi WORKLOAD_RECONCILE_SECONDS, không nằm trên luồng giao việc
+    """
+
+    def __init__(self, interval_seconds: float = WORKLOAD_RECONCILE_SECONDS):
+        self.interval_seconds = interval_seconds
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        if self.interval_seconds <= 0:
+            return
+        self._task = asyncio.create_task(self._run(), name="workload-reconciler")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await run_in_threadpool(_reconcile_workload)
+            except Exception:
+                logger.exception("Workload reconciliation failed")
+            await asyncio.sleep(self.interval_seconds)
+
+
+# Task đối soát dùng chung trong process
+workload_reconciler = WorkloadReconciler()
@@ -41,7 +41,13 @@ const StaffMessages: React.FC = () => {
     const [newMessage, setNewMessage] = useState('');
     const [searchText, setSearchText] = useState('');
     const [loading, setLoading] = useState(false);
+    // Cursor trang khách hàng kế tiếp (header X-Next-Cursor), null khi đã tải hết
+    const [customersCursor, setCustomersCursor] = useState<string | null>(null);
+    const [loadingMoreCustomers, setLoadingMoreCustomers] = useState(false);
     const [sendingMessage, setSendingMessage] = useState(false);
+    // Cursor trang tin nhắn cũ hơn (header X-Next-Cursor), null khi đã tới tin đầu tiên
+    const [olderCursor, setOlderCursor] = useState<string | null>(null);
+    const [loadingOlder, setLoadingOlder] = useState(false);
 
     useEffect(() => {
         fetchCustomers();
@@ -52,6 +58,7 @@ const StaffMessages: React.FC = () => {
             setLoading(true);
             const response = await apiClient.get<Customer[]>('/api/staff/customers');
             setCustomers(response.data);
+            setCustomersCursor(response.headers['x-next-cursor'] || null);
         } catch (error) {
             antdMessage.error('Không thể tải danh sách khách hàng');
         } finally {
@@ -59,12 +66,31 @@ const StaffMessages: React.FC = () => {
         }
     };
 
+    const handleLoadMoreCustomers = async () => {
+        if (!customersCursor) return;
+
+        try {
+            setLoadingMoreCustomers(true);
+            const response = await apiClient.get<Customer[]>('/api/staff/customers', {
+                params: { cursor: customersCursor }
+            });
+            setCustomers(previous => [...previous, ...response.data]);
+            setCustomersCursor(response.headers['x-next-cursor'] || null);
+        } catch (error) {
+            antdMessage.error('Không thể tải thêm khách hàng');
+        } finally {
+            setLoadingMoreCustomers(false);
+        }
+    };
+
     const handleSelectCustomer = async (customer: Customer) => {
         setSelectedCustomer(customer);
+        setOlderCursor(null);
         try {
-            // Lấy lịch sử chat
+            // Lấy lịch sử chat (trang mới nhất)
             const messagesResponse = await apiClient.get<Message[]>(`/api/staff/customers/${customer.id}/messages`);
             setMessages(messagesResponse.data);
+            setOlderCursor(messagesResponse.headers['x-next-cursor'] || null);
 
             // Lấy thông tin chi tiết khách hàng
             const detailResponse = await apiClient.get<CustomerDetail>(`/api/staff/customers/${customer.id}`);
@@ -74,6 +100,23 @@ const StaffMessages: React.FC = () => {
         }
     };
 
+    const handleLoadOlder = async () => {
+        if (!selectedCustomer || !olderCursor) return;
+
+        try {
+            setLoadingOlder(true);
+            const response = await apiClient.get<Message[]>(`/api/staff/customers/${selectedCustomer.id}/messages`, {
+                params: { cursor: olderCursor }
+            });
+            setMessages(previous => [...response.data, ...previous]);
+            setOlderCursor(response.headers['x-next-cursor'] || null);
+        } catch (error) {
+            antdMessage.error('Không thể tải tin nhắn cũ hơn');
+        } finally {
+            setLoadingOlder(false);
+        }
+    };
+
     const handleSendMessage = async () => {
         if (!newMessage.trim() || !selectedCustomer) return;
 
@@ -192,6 +235,13 @@ const StaffMessages: React.FC = () => {
                                             />
                                         </List.Item>
                                     )}
+                                    loadMore={customersCursor && (
+                                        <div style={{ textAlign: 'center', margin: '12px 0' }}>
+                                            <Button size="small" onClick={handleLoadMoreCustomers} loading={loadingMoreCustomers}>
+                                                Tải thêm khách hàng
+                                            </Button>
+                                        </div>
+                                    )}
                                 />
                             )}
                         </div>
@@ -229,6 +279,13 @@ const StaffMessages: React.FC = () => {
                         {selectedCustomer ? (
                             <>
                                 <div className="messages-container" style={{ flex: 1, overflowY: 'auto', padding: '16px 0', marginBottom: 16 }}>
+                                    {olderCursor && (
+                                        <div style={{ textAlign: 'center', marginBottom: 12 }}>
+                                            <Button size="small" onClick={handleLoadOlder} loading={loadingOlder}>
+                                                Tải tin nhắn cũ hơn
+                                            </Button>
+                                        </div>
+                                    )}
                                     {messages.map((msg) => (
                                         <div
                                             key={msg.id}